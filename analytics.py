@@ -0,0 +1,151 @@
+"""Pre-aggregated sales and purchase series.
+
+daily_series holds one row per day, fish_type and direction with the
+quantity, value and number of entries: direction 'OUT' is sales (sales rows
+of type OUT) and 'IN' is purchases (inventory rows of type IN), the same
+rows the summary counters count. Triggers on sales and inventory keep it
+current (see init_db), so a series is read from at most one row per day and
+fish instead of rescanning both tables.
+
+series() rolls the cube up to day, week (starting Monday) or month buckets
+and returns sales and purchases aligned on the same bucket list, with
+zeros for buckets that had no entries. The first and last buckets may be
+partial: only days from `from` to `to` are counted.
+"""
+from datetime import date, timedelta
+
+GRANULARITIES = ('day', 'week', 'month')
+# Longest series one request may ask for (about 13 years of days)
+MAX_BUCKETS = 5000
+
+# SQL for a day's bucket label
+BUCKET_SQL = {
+    'day': 'day',
+    'week': "date(day, '-' || ((CAST(strftime('%w', day) AS INTEGER) + 6) % 7) || ' days')",
+    'month': 'substr(day, 1, 7)',
+}
+
+# (table, direction) pairs that feed the cube
+SOURCES = (('sales', 'OUT'), ('inventory', 'IN'))
+
+
+def rebuild_series(conn):
+    """Recompute daily_series from sales and inventory; call inside a write
+    transaction"""
+    conn.execute('DELETE FROM daily_series')
+    for table, direction in SOURCES:
+        conn.execute(f'''
+        INSERT INTO daily_series (day, fish_type, direction, quantity, value, entries)
+        SELECT date, fish_type, ?, SUM(quantity), SUM(total_price), COUNT(*)
+        FROM {table}
+        WHERE transaction_type = ?
+        GROUP BY date, fish_type
+        ''', (direction, direction))
+
+
+def check_series(conn):
+    """Cube rows that differ from the base tables.
+
+    Returns a list of (day, fish_type, direction, stored value, actual value).
+    """
+    actual = ' UNION ALL '.join(
+        f'''SELECT date AS day, fish_type, '{direction}' AS direction,
+                   SUM(total_price) AS value, COUNT(*) AS entries
+            FROM {table} WHERE transaction_type = '{direction}'
+            GROUP BY date, fish_type'''
+        for table, direction in SOURCES)
+    return conn.execute(f'''
+    WITH actual AS ({actual})
+    SELECT actual.day, actual.fish_type, actual.direction, stored.value, actual.value
+    FROM actual
+    LEFT JOIN daily_series AS stored
+           ON stored.day = actual.day AND stored.fish_type = actual.fish_type
+          AND stored.direction = actual.direction
+    WHERE stored.day IS NULL OR stored.entries != actual.entries
+       OR ABS(stored.value - actual.value) > 0.005
+    UNION ALL
+    SELECT stored.day, stored.fish_type, stored.direction, stored.value, NULL
+    FROM daily_series AS stored
+    WHERE NOT EXISTS (SELECT 1 FROM actual
+                      WHERE actual.day = stored.day AND actual.fish_type = stored.fish_type
+                        AND actual.direction = stored.direction)
+    ''').fetchall()
+
+
+def bucket_of(day, granularity):
+    """Bucket label for a date, matching BUCKET_SQL"""
+    if granularity == 'day':
+        return day.isoformat()
+    if granularity == 'week':
+        return (day - timedelta(days=day.weekday())).isoformat()
+    return day.isoformat()[:7]
+
+
+def bucket_labels(start, end, granularity):
+    """Every bucket label from start to end (dates, inclusive), in order.
+
+    Raises ValueError past MAX_BUCKETS labels.
+    """
+    labels = []
+    if granularity == 'month':
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            labels.append(f'{year:04d}-{month:02d}')
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+            if len(labels) > MAX_BUCKETS:
+                break
+    else:
+        step = timedelta(days=7 if granularity == 'week' else 1)
+        current = date.fromisoformat(bucket_of(start, granularity))
+        while current <= end and len(labels) <= MAX_BUCKETS:
+            labels.append(current.isoformat())
+            current += step
+    if len(labels) > MAX_BUCKETS:
+        raise ValueError(f'Range has more than {MAX_BUCKETS} {granularity} buckets')
+    return labels
+
+
+def series(conn, granularity='day', fish_types=(), start=None, end=None):
+    """Aligned sales and purchase series.
+
+    start and end are dates (inclusive); when missing they default to the
+    first and last day with entries. Raises ValueError for an unknown
+    granularity or a range longer than MAX_BUCKETS buckets.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+
+    where, params = [], []
+    if fish_types:
+        where.append(f"fish_type IN ({','.join('?' * len(fish_types))})")
+        params.extend(fish_types)
+    if start is None or end is None:
+        first, last = conn.execute(
+            f"SELECT MIN(day), MAX(day) FROM daily_series {'WHERE ' + where[0] if where else ''}",
+            params).fetchone()
+        if first is None:
+            return {'from': None, 'to': None, 'buckets': [],
+                    'sales': {'quantity': [], 'value': []},
+                    'purchases': {'quantity': [], 'value': []}}
+        start = start or date.fromisoformat(first)
+        end = end or date.fromisoformat(last)
+
+    labels = bucket_labels(start, end, granularity) if start <= end else []
+
+    where.append('day BETWEEN ? AND ?')
+    params.extend([start.isoformat(), end.isoformat()])
+    totals = {}
+    for bucket, direction, quantity, value in conn.execute(f'''
+    SELECT {BUCKET_SQL[granularity]} AS bucket, direction, SUM(quantity), SUM(value)
+    FROM daily_series
+    WHERE {' AND '.join(where)}
+    GROUP BY bucket, direction
+    ''', params):
+        totals[bucket, direction] = (quantity, value)
+
+    result = {'from': start.isoformat(), 'to': end.isoformat(), 'buckets': labels}
+    for name, direction in (('sales', 'OUT'), ('purchases', 'IN')):
+        points = [totals.get((label, direction), (0, 0)) for label in labels]
+        result[name] = {'quantity': [round(q, 3) for q, _ in points],
+                        'value': [round(v, 2) for _, v in points]}
+    return result
@@ -1,17 +1,121 @@
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, Request, render_template, request, jsonify, Response, send_file
+import click
+import io
+import json
 import sqlite3
-from datetime import datetime
+from datetime import date, datetime, timedelta, timezone
 from zoneinfo import ZoneInfo 
 from flask_cors import CORS
 import os
 from werkzeug.utils import secure_filename
+from db import get_db_connection, pool, statement_listeners
+from group_commit import execute_write, writer as group_commit_writer
+from cache import get_data_version, reference_cache
+import analytics
+import bulk_import
+import compression
+import cost_basis
+import customer_analytics
+import exports
+import metrics
+import receipts
+import row_json
+from slow_queries import slow_query_log
+import stock as stock_ledger
+from stock import InsufficientStock, reserve_stock
+import ledger
+from migrations import Migrator
 
 app = Flask(__name__)
 CORS(app)  # Add this after creating your Flask app
 
-# Initialize database
-def init_db():
-    conn = sqlite3.connect('database.db')
+# Request latency/size/status and SQL timing, served on /metrics
+statement_listeners.append(metrics.record_statement)
+statement_listeners.append(slow_query_log.record)
+
+@app.before_request
+def start_request_metrics():
+    metrics.request_started(request)
+
+@app.after_request
+def record_request_metrics(response):
+    return metrics.request_finished(request, response)
+
+# Compression and conditional GET (see compression.py). Registered after the
+# metrics hook, so it runs first and metrics see the bytes actually sent.
+@app.after_request
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or not compression.is_compressible(response.mimetype)):
+        return response
+    data = response.get_data()
+
+    if request.method in ('GET', 'HEAD') and not response.get_etag()[0]:
+        response.set_etag(compression.content_hash(data))
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    if len(data) >= compression.MIN_BYTES:
+        response.vary.add('Accept-Encoding')
+        encoding = request.accept_encodings.best_match(compression.ENCODINGS)
+        if encoding:
+            response.set_data(compression.compress(data, encoding))
+            response.content_encoding = encoding
+            etag, weak = response.get_etag()
+            if etag and not weak:
+                response.set_etag(etag, weak=True)
+    return response
+
+# Static files are served precompressed from memory; templates link to
+# fingerprinted names via url_for('static', filename=...)
+static_assets = compression.StaticAssets(app.static_folder)
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_filename(values['filename'])
+
+def serve_static(filename):
+    asset, immutable = static_assets.lookup(filename)
+    if asset is None:
+        # Added since startup
+        return app.send_static_file(filename)
+
+    encoding = request.accept_encodings.best_match([e for e in asset.bodies if e])
+    response = app.response_class(asset.bodies[encoding], mimetype=asset.mimetype)
+    if encoding:
+        response.content_encoding = encoding
+    if len(asset.bodies) > 1:
+        response.vary.add('Accept-Encoding')
+    response.set_etag(asset.digest, weak=bool(encoding))
+    if immutable:
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+app.view_functions['static'] = serve_static
+
+# The shop's business day. created_at is stored in UTC (CURRENT_TIMESTAMP);
+# Asia/Kolkata has no DST so a fixed offset converts it exactly.
+SHOP_TZ = ZoneInfo('Asia/Kolkata')
+SHOP_UTC_OFFSET_MINUTES = int(datetime.now(SHOP_TZ).utcoffset().total_seconds() // 60)
+
+# Tables whose writes bump data_versions
+VERSIONED_TABLES = ('inventory', 'sales', 'stock', 'fish_items')
+DASHBOARD_TABLES = ('inventory', 'sales', 'stock')
+
+# Schema migrations, applied in order by init_db() (see migrations.py)
+migrator = Migrator()
+
+@migrator.migration(1)
+def create_schema(conn):
+    """Baseline schema. Every statement is idempotent, so databases created
+    before versioned migrations start from here too."""
     c = conn.cursor()
     
     # inventory table
@@ -127,11 +231,36 @@ def init_db():
     )
     ''')
 
+    # Receipt images moved to the on-disk store (see receipts.py)
+    # table_xinfo, unlike table_info, also lists generated columns
+    columns = {row[1] for row in c.execute('PRAGMA table_xinfo(financial_transactions)')}
+    if 'image_hash' not in columns:
+        c.execute('ALTER TABLE financial_transactions ADD COLUMN image_hash TEXT')
+    if 'image_size' not in columns:
+        c.execute('ALTER TABLE financial_transactions ADD COLUMN image_size INTEGER')
+
+    # Shop-local calendar date, so day filters are index range lookups
+    # instead of date(created_at) evaluated on every row
+    if 'local_date' not in columns:
+        c.execute(f'''
+        ALTER TABLE financial_transactions ADD COLUMN local_date TEXT
+        GENERATED ALWAYS AS (date(created_at, '{SHOP_UTC_OFFSET_MINUTES:+d} minutes')) VIRTUAL
+        ''')
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS idx_transactions_local_date
+    ON financial_transactions (local_date, created_at)
+    ''')
+
     c.execute('''
     CREATE INDEX IF NOT EXISTS idx_transactions_client 
     ON financial_transactions (client_name, client_phone)
     ''')
 
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS idx_transactions_created
+    ON financial_transactions (created_at)
+    ''')
+
     c.execute('''
     CREATE TABLE IF NOT EXISTS advance_orders (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -144,9 +273,679 @@ def init_db():
     )
     ''')
 
-    
-    conn.commit()
+    # Indexes backing the keyset-paginated list endpoints. The rowid is
+    # implicitly the last column of every index, so (date, id) order is free.
+    c.execute('CREATE INDEX IF NOT EXISTS idx_inventory_date ON inventory (date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bills_date ON bills (bill_date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_advance_orders_date ON advance_orders (date)')
+
+    # Running totals for /api/sales/summary, kept current by triggers so every
+    # write path (single entries, bills, imports) updates them in its own
+    # transaction
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS summary_counters (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        total_sales REAL NOT NULL DEFAULT 0,
+        total_purchases REAL NOT NULL DEFAULT 0,
+        sale_count INTEGER NOT NULL DEFAULT 0,
+        inventory_count INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    c.execute('''
+    INSERT OR IGNORE INTO summary_counters
+        (id, total_sales, total_purchases, sale_count, inventory_count)
+    SELECT 1, sales.total, inventory.total, sales.n, inventory.n
+    FROM (SELECT COALESCE(SUM(CASE WHEN transaction_type='OUT' THEN total_price END), 0) AS total,
+                 COUNT(*) AS n FROM sales) AS sales,
+         (SELECT COALESCE(SUM(CASE WHEN transaction_type='IN' THEN total_price END), 0) AS total,
+                 COUNT(*) AS n FROM inventory) AS inventory
+    ''')
+    for table, total_column, count_column, counted_type in (
+            ('sales', 'total_sales', 'sale_count', 'OUT'),
+            ('inventory', 'total_purchases', 'inventory_count', 'IN')):
+        new_value = f"CASE WHEN NEW.transaction_type='{counted_type}' THEN NEW.total_price ELSE 0 END"
+        old_value = f"CASE WHEN OLD.transaction_type='{counted_type}' THEN OLD.total_price ELSE 0 END"
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_summary_insert AFTER INSERT ON {table}
+        BEGIN
+            UPDATE summary_counters
+            SET {total_column} = {total_column} + {new_value},
+                {count_column} = {count_column} + 1
+            WHERE id = 1;
+        END
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_summary_delete AFTER DELETE ON {table}
+        BEGIN
+            UPDATE summary_counters
+            SET {total_column} = {total_column} - {old_value},
+                {count_column} = {count_column} - 1
+            WHERE id = 1;
+        END
+        ''')
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_summary_update
+        AFTER UPDATE OF transaction_type, total_price ON {table}
+        BEGIN
+            UPDATE summary_counters
+            SET {total_column} = {total_column} - {old_value} + {new_value}
+            WHERE id = 1;
+        END
+        ''')
+
+    # Trigram full-text index over customer name and phone for the search
+    # endpoints. External content: the text lives only in customers, and the
+    # triggers keep the index in step with every insert/update/delete.
+    has_fts = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customers_fts'").fetchone()
+    c.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS customers_fts USING fts5(
+        name, phone, content='customers', content_rowid='id', tokenize='trigram'
+    )
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_customers_fts_insert AFTER INSERT ON customers
+    BEGIN
+        INSERT INTO customers_fts (rowid, name, phone) VALUES (NEW.id, NEW.name, NEW.phone);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_customers_fts_delete AFTER DELETE ON customers
+    BEGIN
+        INSERT INTO customers_fts (customers_fts, rowid, name, phone)
+        VALUES ('delete', OLD.id, OLD.name, OLD.phone);
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_customers_fts_update AFTER UPDATE OF name, phone ON customers
+    BEGIN
+        INSERT INTO customers_fts (customers_fts, rowid, name, phone)
+        VALUES ('delete', OLD.id, OLD.name, OLD.phone);
+        INSERT INTO customers_fts (rowid, name, phone) VALUES (NEW.id, NEW.name, NEW.phone);
+    END
+    ''')
+    if not has_fts:
+        c.execute("INSERT INTO customers_fts (customers_fts) VALUES ('rebuild')")
+    c.execute('CREATE INDEX IF NOT EXISTS idx_bills_customer ON bills (customer_id)')
+
+    # Per-table change counters, bumped by triggers on every write. Used as a
+    # cheap ETag for read endpoints; being in the DB they are shared by all
+    # gunicorn workers.
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    for table in VERSIONED_TABLES:
+        c.execute('INSERT OR IGNORE INTO data_versions (name, version) VALUES (?, 0)', (table,))
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{event.lower()}
+            AFTER {event} ON {table}
+            BEGIN
+                UPDATE data_versions SET version = version + 1 WHERE name = '{table}';
+            END
+            ''')
+
+    # Customer ledger (see ledger.py): running balance on customers plus one
+    # statement line per bill or finance entry, written by triggers
+    columns = {row[1] for row in c.execute('PRAGMA table_info(customers)')}
+    if 'balance' not in columns:
+        c.execute('ALTER TABLE customers ADD COLUMN balance REAL NOT NULL DEFAULT 0')
+    columns = {row[1] for row in c.execute('PRAGMA table_info(financial_transactions)')}
+    if 'customer_id' not in columns:
+        c.execute('ALTER TABLE financial_transactions ADD COLUMN customer_id INTEGER REFERENCES customers(id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_customers_phone ON customers (phone)')
+    has_ledger = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'customer_ledger'").fetchone()
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS customer_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        customer_id INTEGER NOT NULL,
+        entry_date TEXT NOT NULL,
+        source TEXT NOT NULL CHECK(source IN ('bill', 'transaction')),
+        source_id INTEGER NOT NULL,
+        description TEXT,
+        debit REAL NOT NULL DEFAULT 0,
+        credit REAL NOT NULL DEFAULT 0,
+        balance REAL NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY (customer_id) REFERENCES customers(id)
+    )
+    ''')
+    c.execute('''
+    CREATE INDEX IF NOT EXISTS idx_customer_ledger_customer
+    ON customer_ledger (customer_id, id)
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_bills_ledger AFTER INSERT ON bills
+    WHEN NEW.customer_id IS NOT NULL
+    BEGIN
+        UPDATE customers
+        SET balance = balance + NEW.total_amount - COALESCE(NEW.amount_paid, 0)
+        WHERE id = NEW.customer_id;
+        INSERT INTO customer_ledger
+            (customer_id, entry_date, source, source_id, description, debit, credit, balance)
+        SELECT id, NEW.bill_date, 'bill', NEW.id, 'Bill #' || NEW.id,
+               NEW.total_amount, COALESCE(NEW.amount_paid, 0), balance
+        FROM customers WHERE id = NEW.customer_id;
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_transactions_ledger AFTER INSERT ON financial_transactions
+    WHEN NEW.customer_id IS NOT NULL
+    BEGIN
+        UPDATE customers
+        SET balance = balance + CASE NEW.transaction_type WHEN 'out' THEN NEW.amount
+                                                          ELSE -NEW.amount END
+        WHERE id = NEW.customer_id;
+        INSERT INTO customer_ledger
+            (customer_id, entry_date, source, source_id, description, debit, credit, balance)
+        SELECT id, NEW.local_date, 'transaction', NEW.id,
+               CASE NEW.transaction_type WHEN 'in' THEN 'Payment received' ELSE 'Paid out' END
+                   || ' (' || NEW.payment_method || ')',
+               CASE NEW.transaction_type WHEN 'out' THEN NEW.amount ELSE 0 END,
+               CASE NEW.transaction_type WHEN 'in' THEN NEW.amount ELSE 0 END,
+               balance
+        FROM customers WHERE id = NEW.customer_id;
+    END
+    ''')
+    if not has_ledger:
+        ledger.rebuild_ledger(conn)
+
+    # Stock ledger (see stock.py): every change to stock as a movement, plus
+    # daily checkpoints for point-in-time queries
+    has_movements = c.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stock_movements'").fetchone()
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS stock_movements (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        fish_type TEXT NOT NULL,
+        delta REAL NOT NULL,
+        at TIMESTAMP NOT NULL,
+        source TEXT NOT NULL,
+        source_id INTEGER
+    )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_movements_fish_at ON stock_movements (fish_type, at)')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS stock_checkpoints (
+        fish_type TEXT NOT NULL,
+        until TIMESTAMP NOT NULL,
+        day TEXT NOT NULL,
+        quantity REAL NOT NULL,
+        PRIMARY KEY (fish_type, until)
+    ) WITHOUT ROWID
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_stock_checkpoints_until ON stock_checkpoints (until)')
+    for table in ('inventory', 'sales'):
+        c.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_stock_movement AFTER INSERT ON {table}
+        BEGIN
+            INSERT INTO stock_movements (fish_type, delta, at, source, source_id)
+            VALUES (NEW.fish_type,
+                    CASE WHEN NEW.transaction_type = 'IN' THEN NEW.quantity ELSE -NEW.quantity END,
+                    COALESCE(NEW.timestamp, CURRENT_TIMESTAMP), '{table}', NEW.id);
+        END
+        ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_bill_items_stock_movement AFTER INSERT ON bill_items
+    BEGIN
+        INSERT INTO stock_movements (fish_type, delta, at, source, source_id)
+        VALUES (NEW.fish_name, -NEW.quantity,
+                COALESCE((SELECT created_at FROM bills WHERE id = NEW.bill_id), CURRENT_TIMESTAMP),
+                'bill_items', NEW.id);
+    END
+    ''')
+    # A backdated movement invalidates the checkpoints it falls before
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS trg_stock_movements_checkpoints AFTER INSERT ON stock_movements
+    WHEN NEW.at < (SELECT MAX(until) FROM stock_checkpoints)
+    BEGIN
+        DELETE FROM stock_checkpoints WHERE until > NEW.at;
+    END
+    ''')
+    if not has_movements:
+        stock_ledger.backfill_movements(conn)
+
+@migrator.migration(2)
+def add_hot_query_indexes(conn):
+    """Indexes for the sales date list, per-fish rollups and bill item
+    lookups (the inventory, bills and advance order indexes come with
+    create_schema)"""
+    for name, table, columns in (
+            ('idx_sales_date', 'sales', 'date'),
+            ('idx_sales_fish_type', 'sales', 'fish_type'),
+            ('idx_bill_items_bill', 'bill_items', 'bill_id')):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})')
+
+@migrator.migration(3)
+def create_daily_series(conn):
+    """Sales/purchase cube per day, fish and direction (see analytics.py),
+    kept current by triggers on sales and inventory"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS daily_series (
+        day TEXT NOT NULL,
+        fish_type TEXT NOT NULL,
+        direction TEXT NOT NULL,
+        quantity REAL NOT NULL DEFAULT 0,
+        value REAL NOT NULL DEFAULT 0,
+        entries INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, fish_type, direction)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_daily_series_fish ON daily_series (fish_type, day)')
+    for table, direction in analytics.SOURCES:
+        add = f'''
+            INSERT INTO daily_series (day, fish_type, direction, quantity, value, entries)
+            SELECT NEW.date, NEW.fish_type, '{direction}', NEW.quantity, NEW.total_price, 1
+            WHERE NEW.transaction_type = '{direction}'
+            ON CONFLICT (day, fish_type, direction) DO UPDATE
+            SET quantity = quantity + excluded.quantity,
+                value = value + excluded.value,
+                entries = entries + 1;'''
+        remove = f'''
+            UPDATE daily_series
+            SET quantity = quantity - OLD.quantity,
+                value = value - OLD.total_price,
+                entries = entries - 1
+            WHERE day = OLD.date AND fish_type = OLD.fish_type AND direction = '{direction}'
+              AND OLD.transaction_type = '{direction}';
+            DELETE FROM daily_series
+            WHERE day = OLD.date AND fish_type = OLD.fish_type AND direction = '{direction}'
+              AND entries <= 0;'''
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_series_insert '
+                     f'AFTER INSERT ON {table} BEGIN {add} END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_series_delete '
+                     f'AFTER DELETE ON {table} BEGIN {remove} END')
+        conn.execute(f'CREATE TRIGGER IF NOT EXISTS trg_{table}_series_update '
+                     f'AFTER UPDATE OF date, fish_type, transaction_type, quantity, total_price '
+                     f'ON {table} BEGIN {remove} {add} END')
+    analytics.rebuild_series(conn)
+
+@migrator.migration(4)
+def create_customer_stats(conn):
+    """Per-buyer purchase rollups (see customer_analytics.py), kept current
+    by insert triggers on sales, bills and bill_items"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS customer_stats (
+        buyer_key TEXT PRIMARY KEY,
+        customer_id INTEGER,
+        name TEXT,
+        phone TEXT,
+        first_purchase TEXT,
+        last_purchase TEXT,
+        orders INTEGER NOT NULL DEFAULT 0,
+        total_spend REAL NOT NULL DEFAULT 0,
+        favourite_fish TEXT
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS customer_fish_stats (
+        buyer_key TEXT NOT NULL,
+        fish_type TEXT NOT NULL,
+        quantity REAL NOT NULL DEFAULT 0,
+        spend REAL NOT NULL DEFAULT 0,
+        PRIMARY KEY (buyer_key, fish_type)
+    ) WITHOUT ROWID
+    ''')
+    # Top-N orderings and the RFM quintile seeks
+    for column in ('total_spend', 'orders', 'last_purchase'):
+        conn.execute(f'CREATE INDEX IF NOT EXISTS idx_customer_stats_{column} '
+                     f'ON customer_stats ({column})')
+
+    def purchase(key, customer_id, name, phone, day, spend):
+        return f'''
+            INSERT INTO customer_stats
+                (buyer_key, customer_id, name, phone, first_purchase, last_purchase,
+                 orders, total_spend)
+            VALUES ({key}, {customer_id}, {name}, {phone}, {day}, {day}, 1, {spend})
+            ON CONFLICT (buyer_key) DO UPDATE
+            SET customer_id = COALESCE(customer_id, excluded.customer_id),
+                first_purchase = MIN(first_purchase, excluded.first_purchase),
+                last_purchase = MAX(last_purchase, excluded.last_purchase),
+                orders = orders + 1,
+                total_spend = total_spend + excluded.total_spend;'''
+
+    # Spend only grows, so the favourite can only become the fish just bought
+    def fish(key, fish_type, quantity, spend):
+        return f'''
+            INSERT INTO customer_fish_stats (buyer_key, fish_type, quantity, spend)
+            VALUES ({key}, {fish_type}, {quantity}, {spend})
+            ON CONFLICT (buyer_key, fish_type) DO UPDATE
+            SET quantity = quantity + excluded.quantity,
+                spend = spend + excluded.spend;
+            UPDATE customer_stats
+            SET favourite_fish = {fish_type}
+            WHERE buyer_key = {key} AND favourite_fish IS NOT {fish_type}
+              AND (favourite_fish IS NULL
+                   OR (SELECT -spend, fish_type FROM customer_fish_stats
+                       WHERE buyer_key = {key} AND fish_type = {fish_type})
+                    < (SELECT -spend, fish_type FROM customer_fish_stats
+                       WHERE buyer_key = {key} AND fish_type = customer_stats.favourite_fish));'''
+
+    sale_key = customer_analytics.buyer_key_sql('NEW.purchaser_name', 'NEW.purchaser_contact')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_customer_stats AFTER INSERT ON sales
+    WHEN NEW.transaction_type = 'OUT'
+    BEGIN
+        {purchase(sale_key, '(SELECT MIN(id) FROM customers WHERE phone = NEW.purchaser_contact)',
+                  'NEW.purchaser_name', 'NEW.purchaser_contact', 'NEW.date', 'NEW.total_price')}
+        {fish(sale_key, 'NEW.fish_type', 'NEW.quantity', 'NEW.total_price')}
+    END
+    ''')
+    bill_key = customer_analytics.buyer_key_sql(
+        '(SELECT name FROM customers WHERE id = NEW.customer_id)',
+        '(SELECT phone FROM customers WHERE id = NEW.customer_id)')
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_bills_customer_stats AFTER INSERT ON bills
+    WHEN NEW.customer_id IS NOT NULL
+    BEGIN
+        {purchase(bill_key, 'NEW.customer_id',
+                  '(SELECT name FROM customers WHERE id = NEW.customer_id)',
+                  '(SELECT phone FROM customers WHERE id = NEW.customer_id)',
+                  'NEW.bill_date', 'NEW.total_amount')}
+    END
+    ''')
+    item_key = f'''(SELECT {customer_analytics.buyer_key_sql('customers.name', 'customers.phone')}
+                    FROM bills JOIN customers ON customers.id = bills.customer_id
+                    WHERE bills.id = NEW.bill_id)'''
+    conn.execute(f'''
+    CREATE TRIGGER IF NOT EXISTS trg_bill_items_customer_stats AFTER INSERT ON bill_items
+    WHEN {item_key} IS NOT NULL
+    BEGIN
+        {fish(item_key, 'NEW.fish_name', 'NEW.quantity', 'NEW.total_price')}
+    END
+    ''')
+    customer_analytics.rebuild_customer_stats(conn)
+    # Version counter for the cached RFM summary
+    conn.execute("INSERT OR IGNORE INTO data_versions (name, version) VALUES ('customer_stats', 0)")
+    for event in ('INSERT', 'UPDATE', 'DELETE'):
+        conn.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS trg_customer_stats_version_{event.lower()}
+        AFTER {event} ON customer_stats
+        BEGIN
+            UPDATE data_versions SET version = version + 1 WHERE name = 'customer_stats';
+        END
+        ''')
+
+@migrator.migration(5)
+def create_cost_basis(conn):
+    """FIFO lots, their matches against sales and the daily margin totals
+    (see cost_basis.py), backfilled from the stock ledger"""
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS cost_lots (
+        id INTEGER PRIMARY KEY,
+        fish_type TEXT NOT NULL,
+        at TIMESTAMP NOT NULL,
+        day TEXT NOT NULL,
+        quantity REAL NOT NULL,
+        remaining REAL NOT NULL,
+        unit_cost REAL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cost_lots_fish_at ON cost_lots (fish_type, at)')
+    conn.execute('''
+    CREATE INDEX IF NOT EXISTS idx_cost_lots_open ON cost_lots (fish_type, at, id)
+    WHERE remaining > 0
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS cost_matches (
+        id INTEGER PRIMARY KEY,
+        movement_id INTEGER NOT NULL,
+        lot_id INTEGER,
+        fish_type TEXT NOT NULL,
+        at TIMESTAMP NOT NULL,
+        day TEXT NOT NULL,
+        kind TEXT NOT NULL CHECK(kind IN ('sale', 'writeoff')),
+        quantity REAL NOT NULL,
+        revenue REAL NOT NULL,
+        cost REAL
+    )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_cost_matches_fish_at ON cost_matches (fish_type, at)')
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS daily_margin (
+        day TEXT NOT NULL,
+        fish_type TEXT NOT NULL,
+        {', '.join(f'{name} REAL NOT NULL DEFAULT 0' for name in cost_basis.TOTALS)},
+        PRIMARY KEY (day, fish_type)
+    ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS cost_state (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        movement_id INTEGER NOT NULL,
+        revenue REAL NOT NULL DEFAULT 0,
+        cost REAL NOT NULL DEFAULT 0
+    )
+    ''')
+    conn.execute('INSERT OR IGNORE INTO cost_state (id, movement_id) VALUES (1, 0)')
+    cost_basis.rebuild(conn, SHOP_UTC_OFFSET_MINUTES)
+
+@migrator.migration(6)
+def add_cost_totals(conn):
+    """All-time revenue and cost on cost_state, so the sales summary reads one
+    row instead of summing daily_margin"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_xinfo(cost_state)')}
+    for name in ('revenue', 'cost'):
+        if name not in columns:
+            conn.execute(f'ALTER TABLE cost_state ADD COLUMN {name} REAL NOT NULL DEFAULT 0')
+    conn.execute('''
+    UPDATE cost_state SET
+        revenue = (SELECT COALESCE(SUM(revenue), 0) FROM daily_margin),
+        cost = (SELECT COALESCE(SUM(cost), 0) FROM daily_margin)
+    ''')
+
+# Initialize database: apply pending migrations (a no-op when the schema is
+# current). Called at startup by python app.py, gunicorn.conf.py and the ASGI
+# lifespan, not on import, so scripts and CLI commands that only want the
+# helpers don't migrate whatever DATABASE_PATH points at.
+def init_db():
+    conn = get_db_connection()
+    try:
+        return migrator.run(conn)
+    finally:
+        conn.close()
+
+@app.cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    conn = get_db_connection()
+    try:
+        current = migrator.current_version(conn)
+    finally:
+        conn.close()
+    applied = init_db()
+    if applied:
+        click.echo(f"Migrated from version {current} to {applied[-1]} "
+                   f"(applied {', '.join(map(str, applied))}), statistics updated.")
+    else:
+        click.echo(f'Schema is current (version {current}).')
+
+@app.cli.command('stock-ledger')
+@click.option('--checkpoint', is_flag=True, help='Write checkpoints for finished days first.')
+@click.option('--fix', is_flag=True, help='Set the stock table to the quantities in the ledger.')
+def stock_ledger_command(checkpoint, fix):
+    """Verify the stock table against the stock ledger."""
+    conn = get_db_connection()
+    try:
+        conn.execute('BEGIN IMMEDIATE')
+        if checkpoint:
+            written = stock_ledger.write_checkpoints(conn, SHOP_UTC_OFFSET_MINUTES)
+            click.echo(f'Wrote {written} checkpoints.')
+        drift = stock_ledger.verify_stock(conn, fix=fix)
+        conn.commit()
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Stock matches the ledger.')
+        return
+    for fish_type, stored, expected in drift:
+        click.echo(f'{fish_type}: stock={stored} ledger={expected}')
+    click.echo('Stock rebuilt from the ledger.' if fix else 'Run with --fix to rebuild.')
+
+@app.cli.command('customer-ledger')
+@click.option('--rebuild', is_flag=True, help='Rebuild the ledger and balances from bills and finance entries.')
+def customer_ledger_command(rebuild):
+    """Verify (and optionally rebuild) customer balances against the ledger."""
+    conn = get_db_connection()
+    try:
+        if rebuild:
+            conn.execute('BEGIN IMMEDIATE')
+            ledger.rebuild_ledger(conn)
+            conn.commit()
+            click.echo('Ledger rebuilt.')
+        drift = ledger.check_ledger(conn)
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Customer balances match the ledger.')
+        return
+    for customer_id, stored, actual in drift:
+        click.echo(f'customer {customer_id}: balance={stored} ledger={actual}')
+    click.echo('Run with --rebuild to rebuild.')
+
+def check_summary_counters(conn, fix=False):
+    """Recompute the summary counters from the base tables.
+
+    Returns a dict of {counter: (stored, actual)} for every counter that has
+    drifted. With fix=True the stored row is overwritten with the actual values.
+    """
+    c = conn.cursor()
+    actual = c.execute('''
+    SELECT (SELECT COALESCE(SUM(total_price), 0) FROM sales WHERE transaction_type='OUT'),
+           (SELECT COALESCE(SUM(total_price), 0) FROM inventory WHERE transaction_type='IN'),
+           (SELECT COUNT(*) FROM sales),
+           (SELECT COUNT(*) FROM inventory)
+    ''').fetchone()
+    stored = c.execute('''
+    SELECT total_sales, total_purchases, sale_count, inventory_count
+    FROM summary_counters WHERE id = 1
+    ''').fetchone()
+
+    names = ('total_sales', 'total_purchases', 'sale_count', 'inventory_count')
+    drift = {}
+    for i, name in enumerate(names):
+        stored_value = stored[i] if stored else None
+        if stored_value is None or abs(stored_value - actual[i]) > 1e-6:
+            drift[name] = (stored_value, actual[i])
+
+    if fix and drift:
+        c.execute('''
+        INSERT OR REPLACE INTO summary_counters
+            (id, total_sales, total_purchases, sale_count, inventory_count)
+        VALUES (1, ?, ?, ?, ?)
+        ''', tuple(actual))
+        conn.commit()
+    return drift
+
+@app.cli.command('summary-counters')
+@click.option('--fix', is_flag=True, help='Rewrite the counters from the base tables.')
+def summary_counters_command(fix):
+    """Verify (and optionally rebuild) the /api/sales/summary counters."""
+    conn = get_db_connection()
+    try:
+        drift = check_summary_counters(conn, fix=fix)
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Summary counters are in sync.')
+        return
+    for name, (stored, actual) in drift.items():
+        click.echo(f'{name}: stored={stored} actual={actual}')
+    click.echo('Counters rebuilt.' if fix else 'Run with --fix to rebuild.')
+
+# Pagination and streaming for list endpoints
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+def get_page_args():
+    """Read ?after=<sort value>,<id> and ?limit= from the query string.
+
+    Returns (after, limit) where after is None or a (value, id) tuple.
+    Raises ValueError on a malformed cursor.
+    """
+    limit = request.args.get('limit', default=None, type=int)
+    after = request.args.get('after', '').strip()
+    cursor = None
+    if after:
+        value, _, last_id = after.rpartition(',')
+        cursor = (value, int(last_id))
+        if not limit:
+            limit = DEFAULT_PAGE_SIZE
+    if limit is not None:
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+    return cursor, limit
+
+def add_keyset(query, params, sort_column, id_column, after, limit):
+    """Append the keyset predicate, newest-first ordering and LIMIT to a
+    query that already ends in a WHERE clause"""
+    if after:
+        query += f' AND ({sort_column}, {id_column}) < (?, ?)'
+        params.extend(after)
+    query += f' ORDER BY {sort_column} DESC, {id_column} DESC'
+    if limit:
+        query += ' LIMIT ?'
+        params.append(limit)
+    return query, params
+
+def encode_rows(cursor, rows, fields=row_json.PLAIN):
+    """JSON array (as a string) for rows of an executed cursor, encoded
+    without per-row dicts (see row_json.py)"""
+    encoder = row_json.encoder_for(cursor, fields, rows[0] if rows else None,
+                                   app.json.sort_keys)
+    return encoder.encode(rows)
+
+def json_rows(cursor, rows, fields=row_json.PLAIN):
+    """JSON array response for rows of an executed cursor; the same bytes
+    jsonify would send"""
+    return app.response_class(encode_rows(cursor, rows, fields) + '\n',
+                              mimetype='application/json')
+
+def rows_response(conn, cursor, fields, cursor_key, limit=None):
+    """Turn an executed cursor into a JSON array response and close conn.
+
+    fields (a row_json.Fields) says how columns map to JSON keys. With
+    ?stream=1 rows are encoded batch by batch as they come off the cursor
+    instead of being collected into a list first. Otherwise a full page
+    sets X-Next-Cursor so the client can ask for the next one.
+    """
+    if request.args.get('stream') in ('1', 'true'):
+        def generate():
+            try:
+                yield '['
+                separator = ''
+                encoder = None
+                while True:
+                    rows = cursor.fetchmany(STREAM_BATCH_SIZE)
+                    if not rows:
+                        break
+                    if encoder is None:
+                        encoder = row_json.encoder_for(cursor, fields, rows[0], app.json.sort_keys)
+                    yield separator + encoder.encode_rows(rows)
+                    separator = ','
+                yield ']'
+            finally:
+                conn.close()
+        return Response(generate(), mimetype='application/json')
+
+    rows = cursor.fetchall()
     conn.close()
+    response = json_rows(cursor, rows, fields)
+    if limit and len(rows) == limit:
+        value, last_id = cursor_key(rows[-1])
+        response.headers['X-Next-Cursor'] = f'{value},{last_id}'
+    return response
+
+# Bring the FIFO cost basis and the daily stock checkpoints up to date with
+# the movements just logged. Call inside the write transaction that logged
+# them, so reads of either never need the write lock.
+def apply_movements(conn):
+    cost_basis.apply_pending(conn, SHOP_UTC_OFFSET_MINUTES)
+    stock_ledger.write_checkpoints(conn, SHOP_UTC_OFFSET_MINUTES)
 
 # API endpoint to save inventory
 @app.route('/api/inventory', methods=['POST'])
@@ -168,36 +967,34 @@ def save_inventory():
         total_price = float(data['quantity']) * float(data['unitPrice'])
         data['totalPrice'] = total_price  # Add to data dict
 
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-
-        # Insert inventory record
-        c.execute('''INSERT INTO inventory 
-                    (date, supplier_name, supplier_contact, fish_type, 
-                     transaction_type, quantity, unit_price, total_price)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (data['date'], data['supplierName'], data['supplierContact'],
-                  data['fishType'], data['type'], data['quantity'],
-                  data['unitPrice'], data['totalPrice']))
-
-        # Update stock
-        quantity_change = data['quantity'] if data['type'] == 'IN' else -data['quantity']
-        c.execute('''INSERT OR IGNORE INTO stock (fish_type, current_quantity)
-                     VALUES (?, 0)''', (data['fishType'],))
-        c.execute('''UPDATE stock 
-                     SET current_quantity = current_quantity + ?
-                     WHERE fish_type = ?''',
-                 (quantity_change, data['fishType']))
-
-        conn.commit()
+        def record_inventory(conn):
+            c = conn.cursor()
+
+            # Insert inventory record
+            c.execute('''INSERT INTO inventory 
+                        (date, supplier_name, supplier_contact, fish_type, 
+                         transaction_type, quantity, unit_price, total_price)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (data['date'], data['supplierName'], data['supplierContact'],
+                      data['fishType'], data['type'], data['quantity'],
+                      data['unitPrice'], data['totalPrice']))
+
+            # Update stock
+            quantity_change = data['quantity'] if data['type'] == 'IN' else -data['quantity']
+            c.execute('''INSERT OR IGNORE INTO stock (fish_type, current_quantity)
+                         VALUES (?, 0)''', (data['fishType'],))
+            c.execute('''UPDATE stock 
+                         SET current_quantity = current_quantity + ?
+                         WHERE fish_type = ?''',
+                     (quantity_change, data['fishType']))
+            apply_movements(conn)
+
+        execute_write(record_inventory)
         return jsonify({"success": True, "message": "Inventory saved!"})
 
     except Exception as e:
         print("Error:", str(e))  # Print the error to console
         return jsonify({"error": str(e)}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 @app.route('/api/salesRecord', methods=['POST'])
 def save_sales():
@@ -214,50 +1011,35 @@ def save_sales():
                 return jsonify({"error": f"Missing required field: {field}"}), 400
 
         # Calculate total price
-        total_price = float(data['quantity']) * float(data['unitPrice'])
-
-        conn = sqlite3.connect('database.db')
-        c = conn.cursor()
-
-        # 1. First check stock availability
-        c.execute('''SELECT current_quantity FROM stock 
-                     WHERE fish_type = ?''', (data['fishType'],))
-        stock = c.fetchone()
-        
-        if not stock or stock[0] < float(data['quantity']):
-            return jsonify({
-                "error": f"Insufficient stock. Available: {stock[0] if stock else 0}"
-            }), 400
-
-        # 2. Record the sale
-        c.execute('''INSERT INTO sales 
-                    (date, purchaser_name, purchaser_contact, fish_type, transaction_type,
-                     quantity, unit_price, total_price)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
-                 (data['date'], data['purchaserName'], data['purchaserContact'],
-                  data['fishType'],data['type'], data['quantity'],
-                  data['unitPrice'], total_price))
-
-        # 3. Update stock (deduct quantity)
-        c.execute('''UPDATE stock 
-                     SET current_quantity = current_quantity - ?,
-                         last_updated = CURRENT_TIMESTAMP
-                     WHERE fish_type = ?''',
-                 (data['quantity'], data['fishType']))
-
-        conn.commit()
+        quantity = float(data['quantity'])
+        total_price = quantity * float(data['unitPrice'])
+
+        def record_sale(conn):
+            # 1. Reserve the stock (check and deduct in one statement)
+            remaining = reserve_stock(conn, data['fishType'], quantity)
+
+            # 2. Record the sale
+            conn.execute('''INSERT INTO sales 
+                        (date, purchaser_name, purchaser_contact, fish_type, transaction_type,
+                         quantity, unit_price, total_price)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                     (data['date'], data['purchaserName'], data['purchaserContact'],
+                      data['fishType'], data.get('type', 'OUT'), data['quantity'],
+                      data['unitPrice'], total_price))
+            apply_movements(conn)
+            return remaining
+
+        remaining = execute_write(record_sale)
         return jsonify({
             "success": True, 
             "message": "Sale recorded successfully!",
-            "remaining_stock": stock[0] - float(data['quantity'])
+            "remaining_stock": remaining
         })
 
+    except InsufficientStock as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
-        conn.rollback()
         return jsonify({"error": str(e)}), 500
-    finally:
-        if 'conn' in locals():
-            conn.close()
 
 # Inventory list page
 @app.route('/inventory')
@@ -267,78 +1049,75 @@ def inventory_list():
 # API endpoint to get all inventory
 @app.route('/api/inventory', methods=['GET'])
 def get_inventory():
-    limit = request.args.get('limit', default=None, type=int)
-    
-    conn = sqlite3.connect('database.db')
+    try:
+        after, limit = get_page_args()
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
+    query, params = add_keyset('SELECT * FROM inventory WHERE 1=1', [],
+                               'date', 'id', after, limit)
+
+    conn = get_db_connection()
     c = conn.cursor()
-    
-    query = 'SELECT * FROM inventory ORDER BY date DESC'
-    if limit:
-        query += f' LIMIT {limit}'
-    
-    c.execute(query)
-    rows = c.fetchall()
-    conn.close()
-    
-    inventory = []
-    for row in rows:
-        inventory.append({
-            'id': row[0],
-            'date': row[1],
-            'supplierName': row[2],
-            'supplierContact': row[3],
-            'fishType': row[4],
-            'type': row[5],
-            'quantity': row[6],
-            'unitPrice': row[7],
-            'totalPrice': row[8],
-            'timestamp': row[9]
-        })
-    
-    return jsonify(inventory)
+    c.execute(query, params)
+    return rows_response(conn, c, INVENTORY_FIELDS, lambda row: (row[1], row[0]), limit)
+
+# inventory columns as the inventory pages expect them
+INVENTORY_FIELDS = row_json.Fields(camel_case=True, rename={'transaction_type': 'type'})
 
 # Add these new routes to your existing app.py
 
 # API for sales summary
 @app.route('/api/sales/summary')
 def sales_summary():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
+    try:
+        return jsonify(fetch_sales_summary(conn))
+    finally:
+        conn.close()
+
+def fetch_sales_summary(conn):
     c = conn.cursor()
-    
-    # Total sales value
-    c.execute("SELECT SUM(total_price) FROM sales WHERE transaction_type='OUT'")
-    total_sales = c.fetchone()[0] or 0
-    
-    # Total purchases value
-    c.execute("SELECT SUM(total_price) FROM inventory WHERE transaction_type='IN'")
-    total_purchases = c.fetchone()[0] or 0
-    
-    # Profit calculation
-    profit = total_sales - total_purchases
-    
-    # Count of transactions
-    c.execute("SELECT COUNT(*) FROM sales")
-    sale_transactions = c.fetchone()[0]
-    c.execute("SELECT COUNT(*) FROM inventory")
-    purchase_transactions = c.fetchone()[0]
 
+    # Running totals maintained by the summary_counters triggers
+    c.execute('''SELECT total_sales, total_purchases, sale_count, inventory_count
+                 FROM summary_counters WHERE id = 1''')
+    counters = c.fetchone()
+    if counters is None:
+        check_summary_counters(conn, fix=True)
+        c.execute('''SELECT total_sales, total_purchases, sale_count, inventory_count
+                     FROM summary_counters WHERE id = 1''')
+        counters = c.fetchone()
+
+    total_sales, total_purchases, sale_transactions, purchase_transactions = counters
+
+    # Profit calculation: "profit" is cash in minus cash out, which counts
+    # stock still on hand as a loss; the realised margin is sales less the
+    # FIFO cost of what was sold (applied with each stock write)
+    profit = total_sales - total_purchases
     total_transactions = sale_transactions + purchase_transactions
-    
-    conn.close()
-    
-    return jsonify({
+    cost_of_goods_sold, realised_margin = cost_basis.summary_totals(conn)
+
+    return {
         'total_sales': total_sales,
         'total_purchases': total_purchases,
         'profit': profit,
+        'cost_of_goods_sold': round(cost_of_goods_sold, 2),
+        'realised_margin': round(realised_margin, 2),
         'total_transactions': total_transactions
-    })
+    }
 
 # API for fish type sales breakdown
 @app.route('/api/sales/by-fish')
 def sales_by_fish():
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
+    try:
+        return jsonify(fetch_sales_by_fish(conn))
+    finally:
+        conn.close()
+
+def fetch_sales_by_fish(conn):
     c = conn.cursor()
-    
     c.execute('''SELECT fish_type, SUM(quantity) as total_quantity, 
                  SUM(total_price) as total_value 
                  FROM sales WHERE transaction_type='OUT' 
@@ -351,44 +1130,182 @@ def sales_by_fish():
             'total_quantity': row[1],
             'total_value': row[2]
         })
-    
-    conn.close()
-    return jsonify(fish_data)
+    return fish_data
 
 # API for monthly sales trend
 @app.route('/api/sales/monthly-trend')
 def monthly_trend():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    
-    c.execute('''SELECT strftime('%Y-%m', date) as month, 
-                 SUM(CASE WHEN transaction_type='OUT' THEN total_price ELSE 0 END) as sales
-                 FROM sales 
-                 GROUP BY month ORDER BY month''')
-    
-    trend_data = []
-    for row in c.fetchall():
-        trend_data.append({
-            'month': row[0],
-            'sales': row[1] or 0
-        })
+    conn = get_db_connection()
+    try:
+        return jsonify(fetch_monthly_trend(conn))
+    finally:
+        conn.close()
 
-    c.execute('''SELECT strftime('%Y-%m', date) as month, 
-                 SUM(CASE WHEN transaction_type='IN' THEN total_price ELSE 0 END) as purchases
-                 FROM inventory 
-                 GROUP BY month ORDER BY month''')
-    for row in c.fetchall():
-        trend_data.append({
-            'month': row[0],
-            'purchases': row[1] or 0
-        })
-    
-    conn.close()
-    return jsonify(trend_data)
+def fetch_monthly_trend(conn):
+    # From the daily_series cube, one entry per month with both totals
+    trend = analytics.series(conn, 'month')
+    return [{'month': month, 'sales': sales, 'purchases': purchases}
+            for month, sales, purchases in zip(trend['buckets'], trend['sales']['value'],
+                                               trend['purchases']['value'])]
+
+# Sales and purchase series at day/week/month granularity, optionally for
+# some fish only (?fish=Rohu or ?fish=Rohu,Katla)
+@app.route('/api/analytics/series')
+def analytics_series():
+    granularity = request.args.get('granularity', 'day')
+    fish_types = [name.strip() for value in request.args.getlist('fish')
+                  for name in value.split(',') if name.strip()]
+    try:
+        start, end = (date.fromisoformat(request.args[name]) if request.args.get(name) else None
+                      for name in ('from', 'to'))
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD'}), 400
+
+    conn = get_db_connection()
+    try:
+        result = analytics.series(conn, granularity, fish_types, start, end)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        conn.close()
+    return jsonify({
+        'granularity': granularity,
+        'fish': fish_types,
+        **result,
+    })
+
+# Top buyers and RFM segments from the customer_stats rollups
+# (?top=20&sort=spend|frequency|recent&segment=champions&as_of=YYYY-MM-DD)
+@app.route('/api/analytics/customers')
+def analytics_customers():
+    top = max(1, min(request.args.get('top', default=20, type=int),
+                     customer_analytics.MAX_TOP))
+    sort = request.args.get('sort', 'spend')
+    segment = request.args.get('segment') or None
+    if sort not in customer_analytics.SORTS:
+        return jsonify({'error': f"sort must be one of {', '.join(customer_analytics.SORTS)}"}), 400
+    if segment and segment not in customer_analytics.SEGMENT_NAMES:
+        names = ', '.join(customer_analytics.SEGMENT_NAMES)
+        return jsonify({'error': f'segment must be one of {names}'}), 400
+    try:
+        as_of = date.fromisoformat(request.args['as_of']) if request.args.get('as_of') \
+            else datetime.now(SHOP_TZ).date()
+    except ValueError:
+        return jsonify({'error': 'as_of must be YYYY-MM-DD'}), 400
+
+    conn = get_db_connection()
+    try:
+        # Boundaries and segment sizes are rebuilt only after customer_stats changes
+        _, summary = reference_cache.get(conn, 'customer-rfm', ('customer_stats',),
+                                         customer_analytics.rfm_summary)
+        report = customer_analytics.customer_report(conn, summary, top, sort, segment, as_of)
+    finally:
+        conn.close()
+    return jsonify(report)
+
+# Realised margin (sales less FIFO cost) per fish and per bucket
+# (?granularity=day|week|month&fish=Rohu&from=YYYY-MM-DD&to=YYYY-MM-DD)
+@app.route('/api/analytics/margin')
+def analytics_margin():
+    granularity = request.args.get('granularity', 'month')
+    fish_types = [name.strip() for value in request.args.getlist('fish')
+                  for name in value.split(',') if name.strip()]
+    try:
+        start, end = (date.fromisoformat(request.args[name]) if request.args.get(name) else None
+                      for name in ('from', 'to'))
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM-DD'}), 400
+
+    conn = get_db_connection()
+    try:
+        result = cost_basis.margin_report(conn, granularity, fish_types, start, end)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    finally:
+        conn.close()
+    return jsonify({
+        'granularity': granularity,
+        'fish': fish_types,
+        **result,
+    })
+
+# Stock on hand valued at FIFO cost
+@app.route('/api/analytics/valuation')
+def analytics_valuation():
+    conn = get_db_connection()
+    try:
+        return jsonify(cost_basis.valuation(conn))
+    finally:
+        conn.close()
+
+@app.cli.command('cost-basis')
+@click.option('--rebuild', is_flag=True, help='Recompute lots and margins from the whole stock ledger.')
+def cost_basis_command(rebuild):
+    """Bring the FIFO cost basis up to date and verify it against the stock ledger."""
+    conn = get_db_connection()
+    try:
+        if rebuild:
+            conn.execute('BEGIN IMMEDIATE')
+            applied = cost_basis.rebuild(conn, SHOP_UTC_OFFSET_MINUTES)
+            conn.commit()
+            click.echo(f'Cost basis rebuilt from {applied} movements.')
+        else:
+            applied = cost_basis.sync(conn, SHOP_UTC_OFFSET_MINUTES)
+            click.echo(f'Applied {applied} movements.')
+        drift = cost_basis.check_cost_basis(conn)
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Cost basis matches the stock ledger.')
+        return
+    for fish_type, what, stored, expected in drift:
+        click.echo(f'{fish_type} {what}: stored={stored} expected={expected}')
+    click.echo('Run with --rebuild to rebuild.')
+
+@app.cli.command('customer-stats')
+@click.option('--rebuild', is_flag=True, help='Recompute the rollups from bills and sales.')
+def customer_stats_command(rebuild):
+    """Verify (and optionally rebuild) the per-customer purchase rollups."""
+    conn = get_db_connection()
+    try:
+        if rebuild:
+            conn.execute('BEGIN IMMEDIATE')
+            customer_analytics.rebuild_customer_stats(conn)
+            conn.commit()
+            click.echo('Customer rollups rebuilt.')
+        drift = customer_analytics.check_customer_stats(conn)
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Customer rollups match bills and sales.')
+        return
+    click.echo(f'{drift} buyers differ from bills and sales. Run with --rebuild to rebuild.')
+
+@app.cli.command('sales-series')
+@click.option('--fix', is_flag=True, help='Rebuild the cube from sales and inventory.')
+def sales_series_command(fix):
+    """Verify (and optionally rebuild) the daily sales/purchase cube."""
+    conn = get_db_connection()
+    try:
+        drift = analytics.check_series(conn)
+        if fix and drift:
+            conn.execute('BEGIN IMMEDIATE')
+            analytics.rebuild_series(conn)
+            conn.commit()
+    finally:
+        conn.close()
+    if not drift:
+        click.echo('Daily series are in sync.')
+        return
+    for day, fish_type, direction, stored, actual in drift[:20]:
+        click.echo(f'{day} {fish_type} {direction}: stored={stored} actual={actual}')
+    if len(drift) > 20:
+        click.echo(f'... and {len(drift) - 20} more')
+    click.echo('Series rebuilt.' if fix else 'Run with --fix to rebuild.')
 
 def update_stock(fish_type, quantity_change):
     """Update stock quantity (positive for IN, negative for OUT)"""
-    conn = sqlite3.connect('database.db')
+    conn = get_db_connection()
     c = conn.cursor()
     
     try:
@@ -404,6 +1321,8 @@ def update_stock(fish_type, quantity_change):
             c.execute('''INSERT INTO stock (fish_type, current_quantity)
                          VALUES (?, ?)''',
                      (fish_type, quantity_change))
+        stock_ledger.record_adjustment(conn, fish_type, quantity_change)
+        apply_movements(conn)
         
         conn.commit()
     except Exception as e:
@@ -412,32 +1331,137 @@ def update_stock(fish_type, quantity_change):
     finally:
         conn.close()
 
+def cached_json(key, tables, loader):
+    """JSON response for reference data served from reference_cache.
+
+    The ETag is the data version of the source tables, so browsers that
+    send If-None-Match get a 304 until one of them is written to.
+    """
+    conn = get_db_connection()
+    try:
+        version, body = reference_cache.get(conn, key, tables,
+                                            lambda conn: app.json.dumps(loader(conn)))
+    finally:
+        conn.close()
+
+    etag = f'{key}-{version}'
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
 @app.route('/api/stock', methods=['GET'])
 def get_stock():
-    conn = sqlite3.connect('database.db')
+    return cached_json('stock', ('stock',), fetch_stock)
+
+def fetch_stock(conn):
     c = conn.cursor()
     c.execute('SELECT * FROM stock ORDER BY fish_type')
-    stock = [{'fish_type': row[1], 'quantity': row[2]} for row in c.fetchall()]
-    conn.close()
-    return jsonify(stock)
+    return [{'fish_type': row[1], 'quantity': row[2], 'last_updated': row[3]}
+            for row in c.fetchall()]
+
+# Everything the sales dashboard needs in one round trip
+@app.route('/api/dashboard', methods=['GET'])
+def dashboard_snapshot():
+    recent_limit = max(1, min(request.args.get('recent', default=5, type=int), MAX_PAGE_SIZE))
+
+    conn = get_db_connection()
+    try:
+        # One read transaction: every part of the payload comes from the same
+        # snapshot, and the ETag describes exactly that snapshot (the cost
+        # basis moves in the same transaction as the stock it follows)
+        conn.execute('BEGIN')
+        c = conn.cursor()
+        etag = f'dashboard-{get_data_version(c, DASHBOARD_TABLES)}-{recent_limit}'
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            c.execute('SELECT * FROM inventory ORDER BY date DESC, id DESC LIMIT ?',
+                      (recent_limit,))
+            # Recent inventory rows go through the same encoder as
+            # /api/inventory; the rest is encoded as jsonify would
+            recent = encode_rows(c, c.fetchall(), INVENTORY_FIELDS)
+            parts = {
+                'summary': fetch_sales_summary(conn),
+                'monthly_trend': fetch_monthly_trend(conn),
+                'by_fish': fetch_sales_by_fish(conn),
+                'stock': fetch_stock(conn)
+            }
+            parts = {key: app.json.dumps(value, separators=(',', ':'))
+                     for key, value in parts.items()}
+            parts['recent_inventory'] = recent
+            keys = sorted(parts) if app.json.sort_keys else parts
+            body = '{' + ','.join(f'"{key}":{parts[key]}' for key in keys) + '}'
+            response = app.response_class(body + '\n', mimetype='application/json')
+        conn.commit()
+    finally:
+        conn.close()
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 # Get fish types for dropdown
 @app.route('/api/fish-types')
 def get_fish_types():
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute("SELECT DISTINCT fish_type FROM stock")
-    types = [row[0] for row in c.fetchall()]
-    conn.close()
-    return jsonify(types)
+    def load(conn):
+        c = conn.cursor()
+        c.execute("SELECT DISTINCT fish_type FROM stock")
+        return [row[0] for row in c.fetchall()]
+    return cached_json('fish-types', ('stock',), load)
+
+# Stock at a past shop date or time (?date= or ?at=, optionally &fish=)
+@app.route('/api/stock/as_of', methods=['GET'])
+def stock_as_of():
+    """Stock per fish from the movements logged before the end of the
+    given shop day (or second). Movements are placed by when they were
+    entered, not by the row's business date, so a backdated inventory or
+    sale entry counts from the moment it was keyed in."""
+    day = request.args.get('date', '').strip()
+    at = request.args.get('at', '').strip()
+    try:
+        if day:
+            local_until = datetime.fromisoformat(day) + timedelta(days=1)
+        elif at:
+            local_until = datetime.fromisoformat(at).replace(microsecond=0) + timedelta(seconds=1)
+        else:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'Pass date=YYYY-MM-DD or at=YYYY-MM-DDTHH:MM:SS'}), 400
+    until = (local_until.replace(tzinfo=SHOP_TZ).astimezone(timezone.utc)
+             .strftime('%Y-%m-%d %H:%M:%S'))
+
+    conn = get_db_connection()
+    try:
+        # Read-only: the writes keep the checkpoints current (apply_movements),
+        # and anything after the latest one is replayed from the ledger
+        quantities = stock_ledger.stock_as_of(conn, until, request.args.get('fish') or None)
+    finally:
+        conn.close()
+    return jsonify({
+        'as_of': day or at,
+        'until_utc': until,
+        'stock': [{'fish_type': fish_type, 'quantity': quantity}
+                  for fish_type, quantity in quantities.items()],
+    })
 
 # Reset all stock to zero
 @app.route('/api/stock/reset', methods=['POST'])
 def reset_stock():
     try:
-        conn = sqlite3.connect('database.db')
+        conn = get_db_connection()
         c = conn.cursor()
+        conn.execute('BEGIN IMMEDIATE')
+        c.execute("""
+        INSERT INTO stock_movements (fish_type, delta, at, source)
+        SELECT fish_type, -current_quantity, CURRENT_TIMESTAMP, 'reset'
+        FROM stock WHERE current_quantity != 0
+        """)
         c.execute("UPDATE stock SET current_quantity = 0")
+        apply_movements(conn)
         conn.commit()
         return jsonify({"success": True})
     except Exception as e:
@@ -445,52 +1469,14 @@ def reset_stock():
     finally:
         conn.close()
 
-# Filter inventory by type
-@app.route('/api/inventory')
-def get_filtered_inventory():
-    type_filter = request.args.get('type', default=None)
-    
-    query = "SELECT * FROM inventory"
-    if type_filter:
-        query += f" WHERE transaction_type = '{type_filter}'"
-    query += " ORDER BY date DESC"
-    
-    conn = sqlite3.connect('database.db')
-    c = conn.cursor()
-    c.execute(query)
-    rows = c.fetchall()
-    conn.close()
-    
-    inventory = []
-    for row in rows:
-        inventory.append({
-            'id': row[0],
-            'date': row[1],
-            'fishType': row[4],
-            'type': row[5],
-            'quantity': row[6],
-            'unitPrice': row[7],
-            'totalPrice': row[8]
-        })
-    
-    return jsonify(inventory)
-
-
-# Helper function to get database connection
-def get_db_connection():
-    conn = sqlite3.connect('database.db')
-    conn.row_factory = sqlite3.Row
-    return conn
-
 # API Routes
 @app.route('/api/fish_items', methods=['GET'])
 def get_fish_items():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM fish_items')
-    fish_items = cursor.fetchall()
-    conn.close()
-    return jsonify([dict(item) for item in fish_items])
+    def load(conn):
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM fish_items')
+        return [dict(item) for item in cursor.fetchall()]
+    return cached_json('fish-items', ('fish_items',), load)
 
 @app.route('/api/customers', methods=['GET', 'POST'])
 def handle_customers():
@@ -500,7 +1486,7 @@ def handle_customers():
         cursor.execute('SELECT * FROM customers')
         customers = cursor.fetchall()
         conn.close()
-        return jsonify([dict(customer) for customer in customers])
+        return json_rows(cursor, customers)
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -517,20 +1503,69 @@ def handle_customers():
         conn.close()
         return jsonify({'id': customer_id, 'name': name, 'phone': phone}), 201
 
+@app.route('/api/customers/<int:customer_id>/balance', methods=['GET'])
+def customer_balance(customer_id):
+    conn = get_db_connection()
+    try:
+        customer = conn.execute('SELECT id, name, phone, balance FROM customers WHERE id = ?',
+                                (customer_id,)).fetchone()
+    finally:
+        conn.close()
+    if customer is None:
+        return jsonify({'error': 'Customer not found'}), 404
+    return jsonify(dict(customer))
+
+# Statement lines, newest first; ?after=<ledger id> for the next page
+@app.route('/api/customers/<int:customer_id>/ledger', methods=['GET'])
+def customer_ledger(customer_id):
+    after = request.args.get('after', type=int)
+    limit = max(1, min(request.args.get('limit', default=DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+
+    conn = get_db_connection()
+    try:
+        customer = conn.execute('SELECT id, name, phone, balance FROM customers WHERE id = ?',
+                                (customer_id,)).fetchone()
+        if customer is None:
+            return jsonify({'error': 'Customer not found'}), 404
+        query = '''
+        SELECT id, entry_date, source, source_id, description, debit, credit, balance, created_at
+        FROM customer_ledger WHERE customer_id = ?
+        '''
+        params = [customer_id]
+        if after:
+            query += ' AND id < ?'
+            params.append(after)
+        query += ' ORDER BY id DESC LIMIT ?'
+        params.append(limit)
+        entries = [dict(row) for row in conn.execute(query, params).fetchall()]
+    finally:
+        conn.close()
+
+    response = jsonify(dict(customer, entries=entries))
+    if len(entries) == limit:
+        response.headers['X-Next-Cursor'] = str(entries[-1]['id'])
+    return response
+
 @app.route('/api/bills', methods=['GET', 'POST'])
 def handle_bills():
     if request.method == 'GET':
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        cursor.execute('''
+        try:
+            after, limit = get_page_args()
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
+
+        query, params = add_keyset('''
         SELECT bills.*, customers.name as customer_name, customers.phone as customer_phone
         FROM bills
         LEFT JOIN customers ON bills.customer_id = customers.id
-        ORDER BY bills.bill_date DESC
-        ''')
-        bills = cursor.fetchall()
-        conn.close()
-        return jsonify([dict(bill) for bill in bills])
+        WHERE 1=1
+        ''', [], 'bills.bill_date', 'bills.id', after, limit)
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return rows_response(conn, cursor, row_json.PLAIN,
+                             lambda bill: (bill['bill_date'], bill['id']), limit)
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -540,69 +1575,134 @@ def handle_bills():
         customer_name = data.get('customer_name')
         customer_phone = data.get('customer_phone')
         bill_date = data.get('bill_date', datetime.now().date().isoformat())
-        items = data.get('items', [])
         subtotal = data.get('subtotal', 0)
         tax = data.get('tax', 0)
         total_amount = data.get('total_amount', 0)
         previous_balance = data.get('previous_balance', 0)
         amount_paid = data.get('amount_paid', 0)
         balance_due = data.get('balance_due', 0)
+
+        # Validate line items up front and total the quantity per fish
+        items = []
+        required_qty = {}
+        try:
+            for item in data.get('items', []):
+                fish_name = item.get('fish_name')
+                quantity = float(item.get('quantity'))
+                if not fish_name or quantity <= 0:
+                    raise ValueError
+                items.append({
+                    'fish_item_id': item.get('fish_item_id'),
+                    'fish_name': fish_name,
+                    'quantity': quantity,
+                    'unit_price': float(item.get('unit_price')),
+                    'total_price': float(item.get('total_price'))
+                })
+                required_qty[fish_name] = required_qty.get(fish_name, 0) + quantity
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid bill item'}), 400
         
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        # If customer doesn't exist, create a new one
-        if not customer_id and customer_name:
+        try:
+            # Take the write lock first so the stock check and deduction
+            # can't interleave with another sale
+            conn.execute('BEGIN IMMEDIATE')
+            cursor = conn.cursor()
+            required_json = json.dumps(required_qty)
+
             cursor.execute('''
-            INSERT INTO customers (name, phone) VALUES (?, ?)
-            ''', (customer_name, customer_phone))
-            customer_id = cursor.lastrowid
-        
-        # Insert bill
-        cursor.execute('''
-        INSERT INTO bills (
-            customer_id, bill_date, subtotal, tax, total_amount,
-            previous_balance, amount_paid, balance_due
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        ''', (
-            customer_id, bill_date, subtotal, tax, total_amount,
-            previous_balance, amount_paid, balance_due
-        ))
-        bill_id = cursor.lastrowid
-        
-        # Insert bill items
-        for item in items:
-            fish_item_id = item.get('fish_item_id')
-            fish_name = item.get('fish_name')
-            quantity = item.get('quantity')
-            unit_price = item.get('unit_price')
-            total_price = item.get('total_price')
+            SELECT wanted.key, wanted.value, stock.current_quantity
+            FROM json_each(?) AS wanted
+            LEFT JOIN stock ON stock.fish_type = wanted.key
+            WHERE stock.current_quantity IS NULL OR stock.current_quantity < wanted.value
+            ''', (required_json,))
+            shortages = cursor.fetchall()
+            if shortages:
+                conn.rollback()
+                return jsonify({
+                    'error': 'Insufficient stock for ' + ', '.join(
+                        f'{fish} (available {available or 0}, requested {wanted})'
+                        for fish, wanted, available in shortages),
+                    'shortages': [
+                        {'fish_name': fish, 'requested': wanted, 'available': available or 0}
+                        for fish, wanted, available in shortages]
+                }), 400
+
+            # Reuse the customer with this phone number so every bill lands
+            # on one ledger; otherwise create a new one
+            if not customer_id:
+                customer_id = ledger.find_customer_by_phone(conn, customer_phone)
+            if not customer_id and customer_name:
+                cursor.execute('''
+                INSERT INTO customers (name, phone) VALUES (?, ?)
+                ''', (customer_name, customer_phone))
+                customer_id = cursor.lastrowid
+            elif customer_id:
+                customer = cursor.execute('SELECT name, phone FROM customers WHERE id = ?',
+                                          (customer_id,)).fetchone()
+                if customer:
+                    customer_name, customer_phone = customer
+                else:
+                    customer_name = customer_phone = None
+
+            # The ledger, not the browser, knows what the customer owed
+            if customer_id:
+                balance = cursor.execute('SELECT balance FROM customers WHERE id = ?',
+                                         (customer_id,)).fetchone()
+                if balance:
+                    previous_balance = balance[0]
+                    balance_due = previous_balance + float(total_amount) - float(amount_paid or 0)
             
+            # Insert bill
             cursor.execute('''
+            INSERT INTO bills (
+                customer_id, bill_date, subtotal, tax, total_amount,
+                previous_balance, amount_paid, balance_due
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING *
+            ''', (
+                customer_id, bill_date, subtotal, tax, total_amount,
+                previous_balance, amount_paid, balance_due
+            ))
+            bill = dict(cursor.fetchone())
+            bill_id = bill['id']
+            
+            # Insert bill items
+            cursor.executemany('''
             INSERT INTO bill_items (
                 bill_id, fish_item_id, fish_name, quantity, unit_price, total_price
             ) VALUES (?, ?, ?, ?, ?, ?)
-            ''', (bill_id, fish_item_id, fish_name, quantity, unit_price, total_price))
-        
-        conn.commit()
-        
-        # Get the complete bill data to return
-        cursor.execute('''
-        SELECT bills.*, customers.name as customer_name, customers.phone as customer_phone
-        FROM bills
-        LEFT JOIN customers ON bills.customer_id = customers.id
-        WHERE bills.id = ?
-        ''', (bill_id,))
-        bill = cursor.fetchone()
-        
-        cursor.execute('SELECT * FROM bill_items WHERE bill_id = ?', (bill_id,))
-        bill_items = cursor.fetchall()
-        
-        conn.close()
+            ''', [(bill_id, item['fish_item_id'], item['fish_name'], item['quantity'],
+                   item['unit_price'], item['total_price']) for item in items])
+            # Rows were inserted back to back under the write lock, so their
+            # ids are consecutive and end at last_insert_rowid()
+            last_item_id = cursor.execute('SELECT last_insert_rowid()').fetchone()[0]
+
+            # Deduct stock for every fish on the bill in one statement
+            if required_qty:
+                cursor.execute('''
+                UPDATE stock
+                SET current_quantity = current_quantity - wanted.value,
+                    last_updated = CURRENT_TIMESTAMP
+                FROM json_each(?) AS wanted
+                WHERE stock.fish_type = wanted.key
+                ''', (required_json,))
+            apply_movements(conn)
+
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
         
-        response = dict(bill)
-        response['items'] = [dict(item) for item in bill_items]
-        return jsonify(response), 201
+        # Build the response from what was just written
+        first_item_id = last_item_id - len(items) + 1
+        bill['customer_name'] = customer_name
+        bill['customer_phone'] = customer_phone
+        bill['items'] = [dict(item, id=first_item_id + i, bill_id=bill_id)
+                         for i, item in enumerate(items)]
+        return jsonify(bill), 201
 
 @app.route('/api/bills/<int:bill_id>', methods=['GET'])
 def get_bill(bill_id):
@@ -633,62 +1733,94 @@ def get_bill(bill_id):
 
 # Add these new routes to app.py
 
+# Search results are ranked and capped; ?limit= overrides
+SEARCH_LIMIT = 50
+
+def fts_phrase(term):
+    return '"' + term.replace('"', '""') + '"'
+
+def customer_matches(name, phone, limit):
+    """Subquery selecting (id, rank) of the customers matching name/phone.
+
+    Uses the trigram index when every term is at least three characters
+    long (trigrams can't match anything shorter), otherwise falls back to
+    LIKE. Returns (sql, params).
+    """
+    terms = [(column, term) for column, term in (('name', name), ('phone', phone)) if term]
+    if all(len(term) >= 3 for _, term in terms):
+        match = ' AND '.join(f'{column} : {fts_phrase(term)}' for column, term in terms)
+        return ('SELECT rowid AS id, rank FROM customers_fts '
+                'WHERE customers_fts MATCH ? ORDER BY rank LIMIT ?'), [match, limit]
+
+    query = 'SELECT id, 0 AS rank FROM customers WHERE 1=1'
+    params = []
+    for column, term in terms:
+        query += f' AND {column} LIKE ?'
+        params.append(f'%{term}%')
+    return query + ' LIMIT ?', params + [limit]
+
 @app.route('/api/bills/search', methods=['GET'])
 def search_bills():
     name = request.args.get('name', '').strip()
     phone = request.args.get('phone', '').strip()
+    limit = max(1, min(request.args.get('limit', default=SEARCH_LIMIT, type=int), MAX_PAGE_SIZE))
     
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    query = '''
-    SELECT bills.*, customers.name as customer_name, customers.phone as customer_phone
-    FROM bills
-    LEFT JOIN customers ON bills.customer_id = customers.id
-    WHERE 1=1
-    '''
-    params = []
-    
-    if name:
-        query += ' AND customers.name LIKE ?'
-        params.append(f'%{name}%')
-    
-    if phone:
-        query += ' AND customers.phone LIKE ?'
-        params.append(f'%{phone}%')
-    
-    query += ' ORDER BY bills.bill_date DESC'
+    if name or phone:
+        matches, params = customer_matches(name, phone, limit)
+        query = f'''
+        SELECT bills.*, customers.name as customer_name, customers.phone as customer_phone
+        FROM ({matches}) AS matches
+        JOIN bills ON bills.customer_id = matches.id
+        LEFT JOIN customers ON bills.customer_id = customers.id
+        ORDER BY matches.rank, bills.bill_date DESC, bills.id DESC
+        LIMIT ?
+        '''
+    else:
+        params = []
+        query = '''
+        SELECT bills.*, customers.name as customer_name, customers.phone as customer_phone
+        FROM bills
+        LEFT JOIN customers ON bills.customer_id = customers.id
+        ORDER BY bills.bill_date DESC, bills.id DESC
+        LIMIT ?
+        '''
+    params.append(limit)
     
     cursor.execute(query, params)
     bills = cursor.fetchall()
     conn.close()
     
-    return jsonify([dict(bill) for bill in bills])
+    return json_rows(cursor, bills)
 
 @app.route('/api/customers/search', methods=['GET'])
 def search_customers():
     name = request.args.get('name', '').strip()
     phone = request.args.get('phone', '').strip()
+    limit = max(1, min(request.args.get('limit', default=SEARCH_LIMIT, type=int), MAX_PAGE_SIZE))
     
     conn = get_db_connection()
     cursor = conn.cursor()
     
-    query = 'SELECT * FROM customers WHERE 1=1'
-    params = []
-    
-    if name:
-        query += ' AND name LIKE ?'
-        params.append(f'%{name}%')
-    
-    if phone:
-        query += ' AND phone LIKE ?'
-        params.append(f'%{phone}%')
+    if name or phone:
+        matches, params = customer_matches(name, phone, limit)
+        query = f'''
+        SELECT customers.*
+        FROM ({matches}) AS matches
+        JOIN customers ON customers.id = matches.id
+        ORDER BY matches.rank
+        '''
+    else:
+        query = 'SELECT * FROM customers ORDER BY id DESC LIMIT ?'
+        params = [limit]
     
     cursor.execute(query, params)
     customers = cursor.fetchall()
     conn.close()
     
-    return jsonify([dict(customer) for customer in customers])
+    return json_rows(cursor, customers)
 
 # Configuration
 
@@ -710,14 +1842,10 @@ def allowed_file(file):
 def create_transaction():
     try:
         file = request.files.get('receipt_image')
-        image_data = image_name = image_type = None
+        image_hash = image_size = image_name = image_type = None
         
-        if file:
-            if not allowed_file(file):
-                return jsonify({'error': 'Invalid file type'}), 400
-            image_data = file.stream.read()  # More memory efficient
-            image_name = secure_filename(file.filename)
-            image_type = file.mimetype
+        if file and not allowed_file(file):
+            return jsonify({'error': 'Invalid file type'}), 400
         
         # Validate required fields
         try:
@@ -730,27 +1858,38 @@ def create_transaction():
         transaction_type = request.form.get('transaction_type')
         if transaction_type not in ('in', 'out'):
             return jsonify({'error': 'Invalid transaction type'}), 400
+
+        # Stream the receipt into the content-addressed store
+        if file:
+            image_hash, image_size = receipts.store_receipt(file.stream)
+            image_name = secure_filename(file.filename)
+            image_type = file.mimetype
             
         # Save to database
         conn = get_db_connection()
         try:
             cursor = conn.cursor()
+            # Payments from a known customer go on their ledger
+            customer_id = (request.form.get('customer_id', type=int)
+                           or ledger.find_customer_by_phone(conn, request.form.get('client_phone')))
             cursor.execute('''
             INSERT INTO financial_transactions (
                 transaction_type, payment_method, amount, 
-                client_name, client_phone, image_data, 
-                image_name, image_type, notes
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                client_name, client_phone, image_hash, image_size,
+                image_name, image_type, notes, customer_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 transaction_type,
                 request.form.get('payment_method'),
                 amount,
                 request.form.get('client_name'),
                 request.form.get('client_phone'),
-                image_data,
+                image_hash,
+                image_size,
                 image_name,
                 image_type,
-                request.form.get('notes')
+                request.form.get('notes'),
+                customer_id
             ))
             conn.commit()
             transaction_id = cursor.lastrowid
@@ -763,7 +1902,8 @@ def create_transaction():
         return jsonify({
             'id': transaction_id,
             'status': 'success',
-            'client_name': request.form.get('client_name')
+            'client_name': request.form.get('client_name'),
+            'customer_id': customer_id
         }), 201
         
     except Exception as e:
@@ -774,18 +1914,70 @@ def get_receipt(tx_id):
     conn = get_db_connection()
     try:
         tx = conn.execute("""
-            SELECT image_data, image_type 
+            SELECT image_hash, image_type, image_data IS NOT NULL AS has_blob
             FROM financial_transactions 
             WHERE id = ?
         """, (tx_id,)).fetchone()
-        
-        if not tx or not tx['image_data']:
-            return jsonify({'error': 'Receipt not found'}), 404
-            
-        return Response(tx['image_data'], mimetype=tx['image_type'])
+
+        # Rows not yet moved by `flask migrate-receipts`
+        if tx and not tx['image_hash'] and tx['has_blob']:
+            blob = conn.execute('SELECT image_data FROM financial_transactions WHERE id = ?',
+                                (tx_id,)).fetchone()[0]
+            return Response(blob, mimetype=tx['image_type'])
     finally:
         conn.close()
 
+    if not tx or not tx['image_hash']:
+        return jsonify({'error': 'Receipt not found'}), 404
+
+    path = receipts.receipt_path(tx['image_hash'])
+    if not os.path.exists(path):
+        return jsonify({'error': 'Receipt not found'}), 404
+
+    # The file is named by its hash, so it can be cached forever. send_file
+    # streams via wsgi.file_wrapper (sendfile under gunicorn) and handles Range.
+    response = send_file(path, mimetype=tx['image_type'], etag=tx['image_hash'],
+                         conditional=True, max_age=31536000)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.cli.command('migrate-receipts')
+@click.option('--batch-size', default=100, show_default=True)
+@click.option('--vacuum', is_flag=True, help='VACUUM afterwards to shrink the database file.')
+def migrate_receipts_command(batch_size, vacuum):
+    """Move receipt BLOBs out of the database into the receipt store."""
+    conn = get_db_connection()
+    try:
+        moved, moved_bytes = receipts.migrate_blobs(conn, batch_size)
+        click.echo(f'Moved {moved} receipts ({moved_bytes} bytes) to {receipts.RECEIPT_DIR}')
+        if vacuum and moved:
+            conn.execute('VACUUM')
+            click.echo('Database vacuumed.')
+    finally:
+        conn.close()
+
+@app.cli.command('receipt-orphans')
+@click.option('--delete', is_flag=True, help='Delete the files found.')
+@click.option('--grace', default=receipts.ORPHAN_GRACE_SECONDS, show_default=True,
+              help='Skip files modified within this many seconds.')
+def receipt_orphans_command(delete, grace):
+    """Find (and optionally delete) stored receipts no transaction refers to."""
+    conn = get_db_connection()
+    try:
+        orphans = receipts.find_orphans(conn, grace)
+    finally:
+        conn.close()
+    total = sum(size for _, size in orphans)
+    if not orphans:
+        click.echo('No orphaned receipt files.')
+    elif delete:
+        removed, removed_bytes = receipts.remove_orphans(orphans)
+        click.echo(f'Deleted {removed} orphaned receipt files ({removed_bytes} bytes).')
+    else:
+        click.echo(f'{len(orphans)} orphaned receipt files ({total} bytes). '
+                   f'Run with --delete to remove them.')
+
 # Get all transactions
 @app.route('/api/transactions', methods=['GET'])
 def get_all_transactions():
@@ -804,7 +1996,7 @@ def get_all_transactions():
         """)
         
         transactions = cursor.fetchall()
-        return jsonify([dict(tx) for tx in transactions])
+        return json_rows(cursor, transactions)
         
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -812,6 +2004,9 @@ def get_all_transactions():
         if conn:
             conn.close()
 
+# Search results: amount always as a number, never the receipt bytes
+TRANSACTION_FIELDS = row_json.Fields(exclude={'image_data'}, convert={'amount': float})
+
 @app.route('/api/transactions/search', methods=['GET'])
 def search_transactions():
     conn = None
@@ -819,9 +2014,10 @@ def search_transactions():
         # Get and sanitize search parameters
         start_date = request.args.get('start_date', '').strip()
         end_date = request.args.get('end_date', '').strip()
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        try:
+            after, limit = get_page_args()
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
         # Build parameterized query
         query = """
@@ -842,33 +2038,28 @@ def search_transactions():
         params = []
 
 
-        # Date filtering
+        # Date filtering on the shop-local date (indexed)
         if start_date:
-            query += " AND date(created_at) >= ?"
+            query += " AND local_date >= ?"
             params.append(start_date)
         
         if end_date:
-            query += " AND date(created_at) <= ?"
+            query += " AND local_date <= ?"
             params.append(end_date)
 
-        query += " ORDER BY created_at DESC"
+        # Qualified so the ordering uses the stored column, not the alias
+        query, params = add_keyset(query, params, 'financial_transactions.created_at',
+                                   'financial_transactions.id', after, limit)
 
         # Execute query
+        conn = get_db_connection()
+        cursor = conn.cursor()
         cursor.execute(query, params)
-        transactions = cursor.fetchall()
-
-        # Convert to JSON-serializable format
-        results = []
-        for tx in transactions:
-            tx_dict = dict(tx)
-            # Convert Decimal to float if needed
-            if 'amount' in tx_dict:
-                tx_dict['amount'] = float(tx_dict['amount'])
-            # Remove binary data from response
-            tx_dict.pop('image_data', None)
-            results.append(tx_dict)
 
-        return jsonify(results)
+        response = rows_response(conn, cursor, TRANSACTION_FIELDS,
+                                 lambda tx: (tx['created_at'], tx['id']), limit)
+        conn = None  # closed by rows_response
+        return response
 
     except sqlite3.Error as e:
         app.logger.error(f"Database error in search: {str(e)}")
@@ -901,7 +2092,7 @@ def transaction_summary():
             SUM(CASE WHEN transaction_type = 'in' THEN amount ELSE 0 END) as total_in,
             SUM(CASE WHEN transaction_type = 'out' THEN amount ELSE 0 END) as total_out
         FROM financial_transactions
-        WHERE date(created_at) = ?
+        WHERE local_date = ?
         """
         cursor.execute(summary_query, (date,))
         summary = cursor.fetchone()
@@ -917,8 +2108,8 @@ def transaction_summary():
             client_phone,
             strftime('%Y-%m-%d %H:%M:%S', created_at) as created_at
         FROM financial_transactions
-        WHERE date(created_at) = ?
-        ORDER BY created_at DESC
+        WHERE local_date = ?
+        ORDER BY financial_transactions.created_at DESC
         """
         cursor.execute(transactions_query, (date,))
         transactions = cursor.fetchall()
@@ -988,24 +2179,23 @@ def save_advance_order():
 def get_all_orders():
     try:
         date_filter = request.args.get('date')
-        conn = get_db_connection()
-        cursor = conn.cursor()
+        try:
+            after, limit = get_page_args()
+        except ValueError:
+            return jsonify({'error': 'Invalid cursor'}), 400
 
+        query = "SELECT * FROM advance_orders WHERE 1=1"
+        params = []
         if date_filter:
-            cursor.execute("SELECT * FROM advance_orders WHERE date = ?", (date_filter,))
-        else:
-            cursor.execute("SELECT * FROM advance_orders ORDER BY date DESC")
-
-        orders = cursor.fetchall()
-        conn.close()
+            query += " AND date = ?"
+            params.append(date_filter)
+        query, params = add_keyset(query, params, 'date', 'id', after, limit)
 
-        # Convert the result to a JSON-serializable format
-        orders_list = []
-        for order in orders:
-            order_dict = dict(order)
-            orders_list.append(order_dict)
-
-        return jsonify(orders_list)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+        return rows_response(conn, cursor, row_json.PLAIN,
+                             lambda order: (order['date'], order['id']), limit)
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -1026,12 +2216,162 @@ def delete_order(order_id):
         # Delete the order
         cursor.execute("DELETE FROM advance_orders WHERE id = ?", (order_id,))
         conn.commit()
-        conn.close()
 
         return jsonify({'message': 'Order deleted successfully'})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    finally:
+        if 'conn' in locals():
+            conn.close()
+
+
+
+# Streaming CSV/NDJSON export of a whole table (optionally a date range)
+@app.route('/api/export/<table>', methods=['GET'])
+def export_table(table):
+    if table not in exports.EXPORTS:
+        return jsonify({'error': f"Unknown export, use one of: {', '.join(exports.EXPORTS)}"}), 404
+    fmt = request.args.get('format', 'csv')
+    if fmt not in exports.FORMATS:
+        return jsonify({'error': 'format must be csv or ndjson'}), 400
+    start_date = request.args.get('start_date', '').strip()
+    end_date = request.args.get('end_date', '').strip()
+    compress = request.args.get('gzip') in ('1', 'true')
+
+    conn = get_db_connection()
+    try:
+        cursor = exports.open_export(conn, table, start_date, end_date)
+    except Exception as e:
+        conn.close()
+        return jsonify({'error': str(e)}), 500
+
+    def generate():
+        try:
+            chunks = exports.encode(cursor, table, fmt)
+            if compress:
+                chunks = exports.gzip_chunks(chunks)
+            yield from chunks
+        finally:
+            conn.close()
+
+    filename = f'{table}.{fmt}'
+    mimetype = exports.FORMATS[fmt]
+    if compress:
+        filename += '.gz'
+        mimetype = 'application/gzip'
+    response = Response(generate(), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+# Bulk CSV import: multipart field "file" or a raw text/csv body
+IMPORT_MAX_BYTES = int(os.environ.get('IMPORT_MAX_BYTES', 64 * 1024 * 1024))
+
+class ShopRequest(Request):
+    # Imports are far bigger than the 2MB receipt upload limit
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'import_table':
+            return IMPORT_MAX_BYTES
+        return super().max_content_length
+
+app.request_class = ShopRequest
+
+@app.route('/api/import/<kind>', methods=['POST'])
+def import_table(kind):
+    if kind not in bulk_import.KINDS:
+        return jsonify({'error': f"Unknown import, use one of: {', '.join(bulk_import.KINDS)}"}), 404
+    dry_run = request.args.get('dry_run') in ('1', 'true')
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    lines = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    conn = get_db_connection()
+    try:
+        report = bulk_import.import_csv(conn, kind, lines, SHOP_UTC_OFFSET_MINUTES,
+                                        dry_run=dry_run)
+    except UnicodeDecodeError:
+        return jsonify({'error': 'File must be UTF-8 CSV'}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+    status = 400 if report['errors'] or report['shortages'] else 200
+    return jsonify(report), status
+
+@app.cli.command('import-csv')
+@click.argument('kind', type=click.Choice(list(bulk_import.KINDS)))
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Validate and roll back instead of committing.')
+def import_csv_command(kind, path, dry_run):
+    """Import inventory or sales rows from a CSV file."""
+    conn = get_db_connection()
+    try:
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            report = bulk_import.import_csv(conn, kind, f, SHOP_UTC_OFFSET_MINUTES,
+                                            dry_run=dry_run)
+    finally:
+        conn.close()
+    for error in report['errors']:
+        click.echo(f"line {error['line']}: {'; '.join(error['errors'])}")
+    if report['error_count'] > len(report['errors']):
+        click.echo(f"... {report['error_count'] - len(report['errors'])} more rows with errors")
+    for shortage in report['shortages']:
+        click.echo(f"{shortage['fish_type']}: requested {shortage['requested']}, "
+                   f"available {shortage['available']}")
+    if report['errors'] or report['shortages']:
+        raise click.ClickException('Nothing imported.')
+    verb = 'Validated' if dry_run else 'Imported'
+    click.echo(f"{verb} {report['rows']} {kind} rows; stock changes: {report['stock_changes']}")
+
+# Connection pool and group-commit statistics for this worker
+@app.route('/api/db/stats', methods=['GET'])
+def db_stats():
+    stats = pool.stats()
+    stats['group_commit'] = group_commit_writer.stats()
+    stats['reference_cache'] = reference_cache.stats()
+    if 'db_executor' in app.extensions:
+        stats['async_executor'] = app.extensions['db_executor'].stats()
+    return jsonify(stats)
+
+
+# Prometheus scrape endpoint, aggregated over all workers
+@app.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+# Statements over SLOW_QUERY_MS, grouped by fingerprint
+@app.route('/debug/slow-queries')
+def slow_queries():
+    sort = request.args.get('sort', 'total')
+    if sort not in ('total', 'max', 'count'):
+        return jsonify({'error': 'sort must be total, max or count'}), 400
+    limit = request.args.get('limit', default=20, type=int)
+    return jsonify({
+        'threshold_ms': slow_query_log.threshold_ms,
+        'log': slow_query_log.path,
+        'queries': slow_query_log.top(limit=limit, sort=sort),
+    })
 
+@app.cli.command('slow-queries')
+@click.option('--limit', default=10, show_default=True)
+@click.option('--sort', type=click.Choice(['total', 'max', 'count']), default='total', show_default=True)
+@click.option('--clear', is_flag=True, help='Empty the log afterwards.')
+def slow_queries_command(limit, sort, clear):
+    """Show the slowest statements from the slow-query log."""
+    queries = slow_query_log.top(limit=limit, sort=sort)
+    if not queries:
+        click.echo(f'No statements over {slow_query_log.threshold_ms}ms in {slow_query_log.path}')
+    for query in queries:
+        click.echo(f"[{query['fingerprint']}] {query['count']}x total={query['total_ms']}ms "
+                   f"avg={query['avg_ms']}ms max={query['max_ms']}ms rows<={query['max_rows']}")
+        click.echo(f"  {query['sql']}")
+        click.echo(f"  parameters: {', '.join(json.dumps(shape) for shape in query['parameters'])}")
+        for line in query['plan'] or ['(no plan)']:
+            click.echo(f'    {line}')
+    if clear:
+        slow_query_log.clear()
+        click.echo('Slow-query log cleared.')
 
 
 @app.route('/dashboard')
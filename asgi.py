@@ -0,0 +1,247 @@
+"""ASGI entry point for the async serving mode.
+
+    uvicorn asgi:application --workers 4
+    gunicorn asgi:application -k uvicorn.workers.UvicornWorker -w 4
+
+The event loop owns the sockets: request bodies are read and responses are
+written asynchronously, so a slow upload or a slow client downloading an
+export holds no thread. Only the Flask view itself (which is where the
+SQLite work happens) runs on a bounded thread pool. Reads run there
+concurrently on their own pooled connections (WAL lets readers proceed
+alongside a writer); writes are capped at ASYNC_MAX_WRITERS at a time so
+they can't occupy every thread while they wait for the write lock. When
+more than ASYNC_MAX_PENDING requests are waiting, new ones get a 503.
+
+The sync deployment (gunicorn app:app) is unchanged.
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, init_db
+from db import pool
+
+DB_THREADS = int(os.environ.get('ASYNC_DB_THREADS', 16))
+MAX_WRITERS = int(os.environ.get('ASYNC_MAX_WRITERS', 2))
+MAX_PENDING = int(os.environ.get('ASYNC_MAX_PENDING', 256))
+MAX_BODY_BYTES = int(os.environ.get('ASYNC_MAX_BODY_BYTES', 64 * 1024 * 1024))
+# Bodies bigger than this are spooled to a temp file while they arrive
+SPOOL_BYTES = 1024 * 1024
+
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+
+
+class DBExecutor:
+    """Bounded thread pool for blocking (SQLite) work.
+
+    run() admits at most `max_pending` callers at once and at most
+    `max_writers` of them with write=True; everything else queues on the
+    pool's `threads` threads.
+    """
+
+    def __init__(self, threads=DB_THREADS, max_writers=MAX_WRITERS, max_pending=MAX_PENDING):
+        self.threads = threads
+        self.max_writers = max_writers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(threads, thread_name_prefix='db')
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._writers = None
+        self._stats = {'completed': 0, 'rejected': 0, 'max_pending_seen': 0}
+        # Every thread can hold a connection without the pool closing it
+        pool.max_idle = max(pool.max_idle, threads)
+
+    def try_admit(self):
+        with self._lock:
+            if self._pending >= self.max_pending:
+                self._stats['rejected'] += 1
+                return False
+            self._pending += 1
+            self._stats['max_pending_seen'] = max(self._stats['max_pending_seen'], self._pending)
+            return True
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            self._stats['completed'] += 1
+
+    async def run(self, fn, *args, write=False):
+        loop = asyncio.get_running_loop()
+        if not write:
+            return await loop.run_in_executor(self._executor, fn, *args)
+        # One semaphore per event loop (uvicorn runs one per worker process)
+        if self._writers is None or self._writers[0] is not loop:
+            self._writers = (loop, asyncio.Semaphore(self.max_writers))
+        async with self._writers[1]:
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, pending=self._pending, threads=self.threads,
+                        max_writers=self.max_writers, max_pending=self.max_pending)
+
+
+executor = DBExecutor()
+# Reported by /api/db/stats
+app.extensions['db_executor'] = executor
+
+
+class ClientDisconnected(Exception):
+    """The client went away before sending the whole request body"""
+
+
+async def read_body(receive):
+    """Collect the request body; None if it exceeds MAX_BODY_BYTES.
+
+    Raises ClientDisconnected rather than returning a truncated body, so a
+    half-sent upload is never handed to a view.
+    """
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_BYTES)
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            body.close()
+            raise ClientDisconnected()
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            body.close()
+            return None
+        body.write(chunk)
+        if not message.get('more_body'):
+            break
+    body.seek(0)
+    return body
+
+
+def build_environ(scope, body):
+    """PEP 3333 environ for an ASGI http scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name == 'CONTENT_TYPE':
+            environ['CONTENT_TYPE'] = value
+        elif name == 'CONTENT_LENGTH':
+            environ['CONTENT_LENGTH'] = value
+        else:
+            key = f'HTTP_{name}'
+            # Repeated headers are comma-joined, except Cookie (RFC 6265)
+            separator = '; ' if key == 'HTTP_COOKIE' else ','
+            environ[key] = f'{environ[key]}{separator}{value}' if key in environ else value
+    return environ
+
+
+def call_app(environ):
+    """Run the Flask app up to its first body chunk.
+
+    Returns (status, headers, result, iterator, first chunk); the first
+    chunk is fetched here so a non-streamed view runs in one executor hop.
+    """
+    started = {}
+
+    def start_response(status, headers, exc_info=None):
+        started['status'], started['headers'] = status, headers
+        return lambda data: None
+
+    result = app(environ, start_response)
+    iterator = iter(result)
+    try:
+        first = next(iterator, None)
+    except BaseException:
+        close_result(result)
+        raise
+    return started['status'], started['headers'], result, iterator, first
+
+
+def close_result(result):
+    if hasattr(result, 'close'):
+        result.close()
+
+
+async def send_simple(send, status, text, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain; charset=utf-8'), *headers]})
+    await send({'type': 'http.response.body', 'body': text.encode()})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Concurrent workers are fine: each migration re-checks the
+            # version inside its write transaction
+            await asyncio.get_running_loop().run_in_executor(None, init_db)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown()
+            pool.close_all()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] != 'http':
+        return
+
+    if not executor.try_admit():
+        return await send_simple(send, 503, 'Server busy, retry shortly', [(b'retry-after', b'1')])
+    body = None
+    try:
+        try:
+            body = await read_body(receive)
+        except ClientDisconnected:
+            return
+        if body is None:
+            return await send_simple(send, 413, 'Request body too large')
+        write = scope['method'] in WRITE_METHODS
+        status, headers, result, iterator, chunk = await executor.run(
+            call_app, build_environ(scope, body), write=write)
+        try:
+            await send({
+                'type': 'http.response.start',
+                'status': int(status.split(' ', 1)[0]),
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                            for name, value in headers],
+            })
+            # Streamed bodies (exports, stream=1 lists) are pulled one chunk
+            # per executor hop so the loop is free while the client reads
+            while chunk is not None:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+                chunk = await executor.run(next, iterator, None)
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            await executor.run(close_result, result)
+    finally:
+        if body is not None:
+            body.close()
+        executor.release()
@@ -0,0 +1,8 @@
+"""Benchmarks and load tests for the shop backend.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 10
+    python -m benchmarks.load --database /tmp/bench.db --output run.json
+    python -m benchmarks.async_serving --database /tmp/bench.db --levels 4,16,64
+    python -m benchmarks.row_json --database /tmp/bench.db
+    python -m benchmarks.cost_basis --database /tmp/bench.db
+"""
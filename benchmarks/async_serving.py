@@ -0,0 +1,184 @@
+"""Sync workers vs the async serving mode under rising concurrency.
+
+Both modes serve the same request mix in this process:
+
+- sync: a pool of --sync-workers threads, each handling one request from
+  start to finish like a gunicorn sync worker, including the time spent
+  receiving a slow client's upload
+- async: asgi.application on an event loop, with the view on the bounded
+  DB executor (ASYNC_DB_THREADS etc. apply)
+
+The mix is mostly fast reads, a share of slow whole-range searches and a
+share of receipt uploads from clients that take --upload-seconds to send
+their body. For each concurrency level it reports throughput and
+p50/p99 latency of the fast reads, which is what queueing behind slow
+work shows up in.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 10
+    python -m benchmarks.async_serving --database /tmp/bench.db --levels 4,16,64
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.load import HttpTransport, RECEIPT_IMAGE, git_commit, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def request_mix(rng, count, slow_share, upload_share):
+    """[(kind, method, path, headers, body)]"""
+    body, content_type = HttpTransport.multipart(
+        {'amount': '250', 'transaction_type': 'in', 'payment_method': 'cash',
+         'client_name': 'Bench'},
+        {'receipt_image': ('receipt.png', 'image/png', RECEIPT_IMAGE)})
+    fast = ['/api/stock', '/api/sales/summary', '/api/fish_items',
+            '/api/bills?limit=50', '/api/transactions/summary?date=2024-06-01']
+    # Whole-table scans
+    slow = ['/api/transactions/search?start_date=2000-01-01&end_date=2100-01-01',
+            '/api/sales/monthly-trend', '/api/sales/by-fish']
+    requests = []
+    for _ in range(count):
+        roll = rng.random()
+        if roll < upload_share:
+            requests.append(('upload', 'POST', '/api/transactions',
+                             [(b'content-type', content_type.encode())], body))
+        elif roll < upload_share + slow_share:
+            requests.append(('slow', 'GET', rng.choice(slow), [], b''))
+        else:
+            requests.append(('fast', 'GET', rng.choice(fast), [], b''))
+    return requests
+
+
+def scope_for(method, path, headers, body):
+    path, _, query = path.partition('?')
+    return {
+        'type': 'http', 'http_version': '1.1', 'method': method, 'scheme': 'http',
+        'path': path, 'root_path': '', 'query_string': query.encode(),
+        'headers': headers + [(b'content-length', str(len(body)).encode())],
+        'server': ('bench', 80), 'client': ('127.0.0.1', 0),
+    }
+
+
+def run_sync(asgi, requests, concurrency, workers, upload_seconds):
+    """Closed loop: `concurrency` clients share `workers` sync workers"""
+    from io import BytesIO
+
+    results = []
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(workers)
+
+    def handle(request):
+        kind, method, path, headers, body = request
+        started = time.perf_counter()
+        with slots:
+            # A sync worker is busy for the whole upload
+            if kind == 'upload':
+                time.sleep(upload_seconds)
+            environ = asgi.build_environ(scope_for(method, path, headers, body), BytesIO(body))
+            status, _, result, iterator, _ = asgi.call_app(environ)
+            for _ in iterator:
+                pass
+            asgi.close_result(result)
+        with lock:
+            results.append((kind, int(status.split()[0]), time.perf_counter() - started))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as clients:
+        list(clients.map(handle, requests))
+    return results, time.perf_counter() - started
+
+
+def run_async(asgi, requests, concurrency, upload_seconds):
+    results = []
+
+    async def handle(request):
+        kind, method, path, headers, body = request
+        sent = False
+        status = {}
+
+        async def receive():
+            nonlocal sent
+            if sent:
+                return {'type': 'http.disconnect'}
+            # The event loop waits for a slow upload without a thread
+            if kind == 'upload':
+                await asyncio.sleep(upload_seconds)
+            sent = True
+            return {'type': 'http.request', 'body': body, 'more_body': False}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+
+        started = time.perf_counter()
+        await asgi.application(scope_for(method, path, headers, body), receive, send)
+        results.append((kind, status.get('code', 0), time.perf_counter() - started))
+
+    async def client(queue):
+        while queue:
+            await handle(queue.pop())
+
+    async def main():
+        queue = list(reversed(requests))
+        await asyncio.gather(*(client(queue) for _ in range(concurrency)))
+
+    started = time.perf_counter()
+    asyncio.run(main())
+    return results, time.perf_counter() - started
+
+
+def summarize(results, elapsed):
+    fast = sorted(seconds * 1000 for kind, _, seconds in results if kind == 'fast')
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': len(results),
+        'statuses': statuses,
+        'throughput_rps': round(len(results) / elapsed, 1),
+        'fast_p50_ms': round(percentile(fast, 0.50), 2) if fast else None,
+        'fast_p99_ms': round(percentile(fast, 0.99), 2) if fast else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--levels', default='4,16,64', help='client concurrency levels')
+    parser.add_argument('--requests', type=int, default=400, help='requests per level and mode')
+    parser.add_argument('--sync-workers', type=int, default=4, help='like gunicorn -w')
+    parser.add_argument('--slow-share', type=float, default=0.05)
+    parser.add_argument('--upload-share', type=float, default=0.05)
+    parser.add_argument('--upload-seconds', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+    sys.path.insert(0, ROOT)
+    import asgi
+
+    report = {'commit': git_commit(), 'database': args.database,
+              'sync_workers': args.sync_workers, 'async_executor': asgi.executor.stats(),
+              'levels': {}}
+    for level in [int(value) for value in args.levels.split(',')]:
+        requests = request_mix(random.Random(args.seed), args.requests,
+                               args.slow_share, args.upload_share)
+        sync = summarize(*run_sync(asgi, requests, level, args.sync_workers, args.upload_seconds))
+        async_ = summarize(*run_async(asgi, requests, level, args.upload_seconds))
+        report['levels'][level] = {'sync': sync, 'async': async_}
+        print(f"concurrency {level:4d}: sync {sync['throughput_rps']:8.1f} rps "
+              f"p99 {sync['fast_p99_ms']}ms | async {async_['throughput_rps']:8.1f} rps "
+              f"p99 {async_['fast_p99_ms']}ms", file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+"""Throughput of POST /api/bills for large bills.
+
+Seeds stock for 50 fish types in a throwaway database, then creates bills
+with 50 line items each through the Flask test client and reports bills and
+line items per second.
+
+    python benchmarks/bill_throughput.py [--bills 500] [--items 50]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bills', type=int, default=500)
+    parser.add_argument('--items', type=int, default=50)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'bills.db')
+    sys.path.insert(0, ROOT)
+    import app
+
+    app.init_db()
+    fish = [f'Fish {i:02d}' for i in range(args.items)]
+    conn = app.get_db_connection()
+    conn.executemany('INSERT INTO stock (fish_type, current_quantity) VALUES (?, ?)',
+                     [(name, 1e9) for name in fish])
+    conn.commit()
+    conn.close()
+
+    rng = random.Random(7)
+    client = app.app.test_client()
+    payloads = []
+    for b in range(args.bills):
+        items = []
+        for name in fish:
+            quantity = round(rng.uniform(0.5, 5), 2)
+            price = round(rng.uniform(100, 900), 2)
+            items.append({'fish_name': name, 'quantity': quantity,
+                          'unit_price': price, 'total_price': round(quantity * price, 2)})
+        subtotal = sum(item['total_price'] for item in items)
+        payloads.append({'customer_name': f'Customer {b % 100}', 'customer_phone': str(9000000000 + b),
+                         'bill_date': '2024-06-01', 'items': items, 'subtotal': subtotal,
+                         'tax': 0, 'total_amount': subtotal, 'balance_due': subtotal})
+
+    latencies = []
+    start = time.perf_counter()
+    for payload in payloads:
+        t0 = time.perf_counter()
+        response = client.post('/api/bills', json=payload)
+        latencies.append(time.perf_counter() - t0)
+        if response.status_code != 201:
+            print(response.get_json(), file=sys.stderr)
+            return 1
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(json.dumps({
+        'bills': args.bills,
+        'items_per_bill': args.items,
+        'seconds': round(elapsed, 3),
+        'bills_per_second': round(args.bills / elapsed, 1),
+        'items_per_second': round(args.bills * args.items / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p95_ms': round(latencies[int(len(latencies) * 0.95)] * 1000, 2),
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""FIFO cost-basis benchmark: full rebuild, incremental sync and reports.
+
+Times cost_basis.rebuild() over the whole stock ledger (movements/s), then
+adds sales one at a time and times the sync() that applies each one: at the
+end of a fish's history (the usual case) and backdated by --backdate-days,
+which replays the fish from that point. Finally times the margin and
+valuation reports and checks the result against the ledger.
+
+--scale 7 gives about a million stock movements (sales, inventory and bill
+items). The run adds 2 x --sales rows to the sales table, so point it at a
+generated database, not a real one.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 7
+    python -m benchmarks.cost_basis --database /tmp/bench.db
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+from benchmarks.load import git_commit, percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - started, result
+
+
+def latencies(values):
+    values = sorted(values)
+    return {'p50_ms': round(percentile(values, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(values, 0.95) * 1000, 2),
+            'max_ms': round(values[-1] * 1000, 2)}
+
+
+def add_sale(conn, rng, fish, at):
+    quantity = round(rng.uniform(0.5, 5), 2)
+    conn.execute('BEGIN IMMEDIATE')
+    conn.execute('''INSERT INTO sales
+                    (date, purchaser_name, purchaser_contact, fish_type, transaction_type,
+                     quantity, unit_price, total_price, timestamp)
+                    VALUES (date(?), 'Benchmark', '0000000000', ?, 'OUT', ?, 500, ?, ?)''',
+                 (at, fish, quantity, quantity * 500, at))
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--sales', type=int, default=200, help='sales added per sync case')
+    parser.add_argument('--backdate-days', type=int, default=7)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+    sys.path.insert(0, ROOT)
+    import app
+    import cost_basis
+
+    app.init_db()
+    offset = app.SHOP_UTC_OFFSET_MINUTES
+    rng = random.Random(args.seed)
+    report = {'commit': git_commit(), 'database': args.database}
+    conn = app.get_db_connection()
+    try:
+        cost_basis.sync(conn, offset)
+        movements = conn.execute('SELECT COUNT(*) FROM stock_movements').fetchone()[0]
+
+        def rebuild():
+            conn.execute('BEGIN IMMEDIATE')
+            applied = cost_basis.rebuild(conn, offset)
+            conn.commit()
+            return applied
+
+        seconds, applied = timed(rebuild)
+        report['rebuild'] = {
+            'movements': applied,
+            'matches': conn.execute('SELECT COUNT(*) FROM cost_matches').fetchone()[0],
+            'seconds': round(seconds, 2),
+            'movements_per_s': round(applied / seconds),
+        }
+        print(f'rebuild: {applied} movements in {seconds:.2f}s '
+              f'({applied / seconds:,.0f}/s)', file=sys.stderr)
+
+        fish = [row[0] for row in conn.execute('SELECT DISTINCT fish_type FROM cost_lots')]
+        latest = conn.execute('SELECT MAX(at) FROM stock_movements').fetchone()[0]
+        cases = {
+            'append': lambda: latest,
+            'backdated': lambda: conn.execute(
+                "SELECT datetime(?, ?)", (latest, f'-{args.backdate_days} days')).fetchone()[0],
+        }
+        for name, at in cases.items():
+            times, applied = [], 0
+            for _ in range(args.sales):
+                add_sale(conn, rng, rng.choice(fish), at())
+                seconds, count = timed(lambda: cost_basis.sync(conn, offset))
+                times.append(seconds)
+                applied += count
+            report[f'sync_{name}'] = {'sales': args.sales,
+                                      'movements_applied': applied, **latencies(times)}
+            print(f'sync {name}: {report[f"sync_{name}"]}', file=sys.stderr)
+
+        reports = {
+            'margin_month': lambda: cost_basis.margin_report(conn, 'month'),
+            'margin_day_one_fish': lambda: cost_basis.margin_report(conn, 'day', fish[:1]),
+            'valuation': lambda: cost_basis.valuation(conn),
+            'summary_totals': lambda: cost_basis.summary_totals(conn),
+        }
+        report['reports_ms'] = {}
+        for name, fn in reports.items():
+            seconds = min(timed(fn)[0] for _ in range(5))
+            report['reports_ms'][name] = round(seconds * 1000, 2)
+
+        report['movements'] = movements
+        report['drift'] = cost_basis.check_cost_basis(conn)
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Before/after EXPLAIN QUERY PLAN for the finance date filters.
+
+Builds a throwaway database with the app schema, fills it with synthetic
+financial transactions and compares the old date(created_at) predicates with
+the local_date range predicates. Exits non-zero if a new query still scans
+the table.
+
+    python benchmarks/finance_query_plan.py [--rows 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+QUERIES = {
+    'search': (
+        "SELECT id FROM financial_transactions "
+        "WHERE date(created_at) >= ? AND date(created_at) <= ? ORDER BY created_at DESC",
+        "SELECT id FROM financial_transactions "
+        "WHERE local_date >= ? AND local_date <= ? ORDER BY created_at DESC",
+        ('2024-03-01', '2024-03-07'),
+    ),
+    'summary': (
+        "SELECT COUNT(*), SUM(amount) FROM financial_transactions WHERE date(created_at) = ?",
+        "SELECT COUNT(*), SUM(amount) FROM financial_transactions WHERE local_date = ?",
+        ('2024-03-05',),
+    ),
+}
+
+
+def fill(conn, rows):
+    rng = random.Random(42)
+    start = time.mktime((2024, 1, 1, 0, 0, 0, 0, 0, 0))
+    conn.executemany('''
+        INSERT INTO financial_transactions
+            (transaction_type, payment_method, amount, client_name, created_at)
+        VALUES (?, ?, ?, ?, datetime(?, 'unixepoch'))
+    ''', ((rng.choice(('in', 'out')), rng.choice(('cash', 'online')),
+           round(rng.uniform(50, 5000), 2), f'client{rng.randrange(2000)}',
+           int(start + i * 60)) for i in range(rows)))
+    conn.commit()
+    conn.execute('ANALYZE')
+
+
+def plan(conn, sql, params):
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+
+def timed(conn, sql, params, repeat=5):
+    best = float('inf')
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - t0)
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'plan.db')
+    sys.path.insert(0, ROOT)
+    import app
+
+    app.init_db()
+    conn = app.get_db_connection()
+    fill(conn, args.rows)
+
+    failed = False
+    for name, (old_sql, new_sql, params) in QUERIES.items():
+        old_plan, new_plan = plan(conn, old_sql, params), plan(conn, new_sql, params)
+        print(f'== {name}')
+        print(f'  before ({timed(conn, old_sql, params):.2f} ms): {"; ".join(old_plan)}')
+        print(f'  after  ({timed(conn, new_sql, params):.2f} ms): {"; ".join(new_plan)}')
+        if any(step.startswith('SCAN financial_transactions') and 'INDEX' not in step
+               for step in new_plan):
+            print('  !! new query still scans the table')
+            failed = True
+    conn.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,274 @@
+"""Deterministic synthetic dataset generator.
+
+Fills inventory, sales, bills/bill_items, customers, financial_transactions
+(with receipt images in the receipt store) and advance_orders. The same
+--seed and --scale always produce the same rows, so runs on different
+commits can be compared. Row counts at --scale 1 are listed in BASE_COUNTS;
+use --scale 50 or more for millions of rows.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 10
+"""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BASE_COUNTS = {
+    'customers': 2000,
+    'inventory': 20000,
+    'sales': 50000,
+    'bills': 20000,
+    'financial_transactions': 10000,
+    'advance_orders': 2000,
+}
+
+FISH = {
+    'Pomfret': 350, 'Salmon': 850, 'Tuna': 600, 'Sardine': 200, 'Mackerel': 250,
+    'Rohu': 220, 'Catla': 240, 'Hilsa': 1200, 'Prawns': 700, 'Crab': 500,
+    'Seer Fish': 900, 'Bombay Duck': 180,
+}
+FIRST_NAMES = ['Ravi', 'Sita', 'Arjun', 'Priya', 'Rahul', 'Anita', 'Vijay', 'Kavya', 'Suresh',
+               'Meena', 'Amit', 'Pooja', 'Kiran', 'Deepa', 'Manoj', 'Lakshmi', 'Ganesh', 'Asha']
+LAST_NAMES = ['Nayak', 'Patil', 'Shetty', 'Rao', 'Kumar', 'Das', 'Pillai', 'Naik', 'Gowda',
+              'Iyer', 'Menon', 'Kamath', 'Bhat', 'Sharma', 'Reddy', 'Hegde']
+SUPPLIERS = ['Malpe Harbour Traders', 'Mangalore Catch Co', 'Karwar Fisheries',
+             'Udupi Sea Foods', 'Goa Coastal Supply', 'Kochi Marine Exports']
+
+CHUNK = 10000
+
+
+def chunked(rows, size=CHUNK):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Generator:
+    def __init__(self, conn, scale=1.0, seed=42, days=730, end=date(2024, 12, 31),
+                 receipt_ratio=0.2, distinct_receipts=100, items_per_bill=4):
+        self.conn = conn
+        self.counts = {name: max(1, int(count * scale)) for name, count in BASE_COUNTS.items()}
+        self.seed = seed
+        self.start = end - timedelta(days=days - 1)
+        self.days = days
+        self.receipt_ratio = receipt_ratio
+        self.distinct_receipts = distinct_receipts
+        self.items_per_bill = items_per_bill
+
+    def rng(self, table):
+        # One stream per table keeps each table stable when another changes
+        return random.Random(f'{self.seed}:{table}')
+
+    def day(self, rng):
+        return (self.start + timedelta(days=rng.randrange(self.days))).isoformat()
+
+    def timestamp(self, rng, day=None):
+        day = day or self.day(rng)
+        return f'{day} {rng.randrange(5, 21):02d}:{rng.randrange(60):02d}:{rng.randrange(60):02d}'
+
+    def person(self, rng):
+        return (f'{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}',
+                str(rng.randrange(7000000000, 9999999999)))
+
+    def insert(self, sql, rows):
+        for chunk in chunked(rows):
+            self.conn.executemany(sql, chunk)
+            self.conn.commit()
+
+    def run(self):
+        timings = {}
+        for step in ('fish_items', 'customers', 'inventory', 'sales', 'bills',
+                     'financial_transactions', 'advance_orders', 'stock'):
+            t0 = time.perf_counter()
+            getattr(self, f'generate_{step}')()
+            timings[step] = round(time.perf_counter() - t0, 2)
+        self.conn.execute('ANALYZE')
+        self.conn.commit()
+        return timings
+
+    def generate_fish_items(self):
+        self.conn.executemany('INSERT OR IGNORE INTO fish_items (name, current_price) VALUES (?, ?)',
+                              list(FISH.items()))
+        self.conn.commit()
+
+    def generate_customers(self):
+        rng = self.rng('customers')
+        self.insert('INSERT INTO customers (name, phone, created_at) VALUES (?, ?, ?)',
+                    (self.person(rng) + (self.timestamp(rng),)
+                     for _ in range(self.counts['customers'])))
+
+    def generate_inventory(self):
+        rng = self.rng('inventory')
+        fish = list(FISH)
+
+        def rows():
+            for _ in range(self.counts['inventory']):
+                name = rng.choice(fish)
+                quantity = round(rng.uniform(20, 200), 2)
+                price = round(FISH[name] * rng.uniform(0.5, 0.8), 2)
+                day = self.day(rng)
+                yield (day, rng.choice(SUPPLIERS), str(rng.randrange(7000000000, 9999999999)),
+                       name, 'IN', quantity, price, round(quantity * price, 2),
+                       self.timestamp(rng, day))
+        self.insert('''INSERT INTO inventory
+                       (date, supplier_name, supplier_contact, fish_type, transaction_type,
+                        quantity, unit_price, total_price, timestamp)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+
+    def generate_sales(self):
+        rng = self.rng('sales')
+        fish = list(FISH)
+
+        def rows():
+            for _ in range(self.counts['sales']):
+                name = rng.choice(fish)
+                quantity = round(rng.uniform(0.5, 20), 2)
+                price = round(FISH[name] * rng.uniform(0.9, 1.2), 2)
+                day = self.day(rng)
+                yield (day,) + self.person(rng) + (name, 'OUT', quantity, price,
+                                                   round(quantity * price, 2),
+                                                   self.timestamp(rng, day))
+        self.insert('''INSERT INTO sales
+                       (date, purchaser_name, purchaser_contact, fish_type, transaction_type,
+                        quantity, unit_price, total_price, timestamp)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+
+    def generate_bills(self):
+        rng = self.rng('bills')
+        fish = list(FISH)
+        item_ids = {row[1]: row[0] for row in self.conn.execute('SELECT id, name FROM fish_items')}
+        first_bill = (self.conn.execute('SELECT COALESCE(MAX(id), 0) FROM bills').fetchone()[0]) + 1
+        bills, items = [], []
+
+        def flush():
+            self.conn.executemany('''INSERT INTO bills
+                (id, customer_id, bill_date, subtotal, tax, total_amount, previous_balance,
+                 amount_paid, balance_due, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', bills)
+            self.conn.executemany('''INSERT INTO bill_items
+                (bill_id, fish_item_id, fish_name, quantity, unit_price, total_price)
+                VALUES (?, ?, ?, ?, ?, ?)''', items)
+            self.conn.commit()
+            bills.clear()
+            items.clear()
+
+        for bill_id in range(first_bill, first_bill + self.counts['bills']):
+            subtotal = 0
+            for _ in range(rng.randint(1, self.items_per_bill * 2 - 1)):
+                name = rng.choice(fish)
+                quantity = round(rng.uniform(0.5, 10), 2)
+                price = round(FISH[name] * rng.uniform(0.9, 1.2), 2)
+                total = round(quantity * price, 2)
+                subtotal += total
+                items.append((bill_id, item_ids.get(name), name, quantity, price, total))
+            subtotal = round(subtotal, 2)
+            paid = round(subtotal * rng.choice((1, 1, 1, 0.5, 0)), 2)
+            day = self.day(rng)
+            bills.append((bill_id, rng.randint(1, self.counts['customers']), day, subtotal, 0,
+                          subtotal, 0, paid, round(subtotal - paid, 2), self.timestamp(rng, day)))
+            if len(items) >= CHUNK:
+                flush()
+        flush()
+
+    def generate_financial_transactions(self):
+        import receipts
+
+        rng = self.rng('financial_transactions')
+        image_rng = self.rng('receipt_images')
+        images = []
+        for i in range(self.distinct_receipts):
+            body = b'\x89PNG\r\n\x1a\n' + image_rng.randbytes(image_rng.randrange(20000, 60000))
+            digest, size = receipts.store_receipt(io.BytesIO(body))
+            images.append((digest, size, f'receipt_{i}.png'))
+
+        def rows():
+            for _ in range(self.counts['financial_transactions']):
+                name, phone = self.person(rng)
+                image = rng.choice(images) if rng.random() < self.receipt_ratio else (None, None, None)
+                yield (rng.choice(('in', 'out')), rng.choice(('cash', 'online')),
+                       round(rng.uniform(100, 50000), 2), name, phone) + image + (
+                       'image/png' if image[0] else None, None, self.timestamp(rng))
+        self.insert('''INSERT INTO financial_transactions
+                       (transaction_type, payment_method, amount, client_name, client_phone,
+                        image_hash, image_size, image_name, image_type, notes, created_at)
+                       VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', rows())
+
+    def generate_advance_orders(self):
+        rng = self.rng('advance_orders')
+        fish = list(FISH)
+
+        def rows():
+            for _ in range(self.counts['advance_orders']):
+                amount = round(rng.uniform(500, 20000), 2)
+                yield ((self.day(rng), amount, rng.choice(fish), round(amount * rng.uniform(0.1, 0.5), 2))
+                       + self.person(rng))
+        self.insert('''INSERT INTO advance_orders (date, amount, fish_type, advance, name, contact)
+                       VALUES (?, ?, ?, ?, ?, ?)''', rows())
+
+    def generate_stock(self):
+        # Current stock is what the generated history implies
+        self.conn.execute('''
+            INSERT INTO stock (fish_type, current_quantity)
+            SELECT fish_type, SUM(delta) FROM (
+                SELECT fish_type, CASE WHEN transaction_type = 'IN' THEN quantity ELSE -quantity END AS delta
+                FROM inventory
+                UNION ALL SELECT fish_type, -quantity FROM sales
+                UNION ALL SELECT fish_name, -quantity FROM bill_items
+            ) GROUP BY fish_type
+            ON CONFLICT (fish_type) DO UPDATE SET current_quantity = excluded.current_quantity
+        ''')
+        self.conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='SQLite file to create')
+    parser.add_argument('--scale', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--days', type=int, default=730, help='history length ending 2024-12-31')
+    parser.add_argument('--receipt-ratio', type=float, default=0.2,
+                        help='share of finance transactions with a receipt image')
+    parser.add_argument('--distinct-receipts', type=int, default=100)
+    parser.add_argument('--items-per-bill', type=int, default=4, help='average line items per bill')
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+    sys.path.insert(0, ROOT)
+    import app
+
+    app.init_db()
+    conn = app.get_db_connection()
+    generator = Generator(conn, scale=args.scale, seed=args.seed, days=args.days,
+                          receipt_ratio=args.receipt_ratio,
+                          distinct_receipts=args.distinct_receipts,
+                          items_per_bill=args.items_per_bill)
+    started = time.perf_counter()
+    timings = generator.run()
+    counts = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+              for table in list(BASE_COUNTS) + ['bill_items', 'stock']}
+    conn.close()
+    print(json.dumps({
+        'database': args.database,
+        'generated_at': datetime.now().isoformat(timespec='seconds'),
+        'seed': args.seed,
+        'scale': args.scale,
+        'rows': counts,
+        'seconds': round(time.perf_counter() - started, 2),
+        'step_seconds': timings,
+    }, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
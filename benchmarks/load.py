@@ -0,0 +1,362 @@
+"""Load driver for every /api/* route.
+
+Refuses to run while any /api/ rule in app.url_map has no endpoint here,
+so new routes can't silently drop out of the benchmark. Runs a fixed
+number of requests against each endpoint and reports
+throughput and p50/p95/p99 latency per endpoint as JSON, so runs on
+different commits can be diffed. Request parameters (ids, names, dates) are
+sampled from the dataset with a fixed seed.
+
+By default requests go through the Flask test client in this process. With
+--url they go over HTTP to a running server (e.g. gunicorn) that uses the
+same --database, and --concurrency requests are kept in flight.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 10
+    python -m benchmarks.load --database /tmp/bench.db --output before.json
+    python -m benchmarks.load --database /tmp/bench.db --url http://127.0.0.1:8000 --concurrency 16
+"""
+import argparse
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+RECEIPT_IMAGE = b'\x89PNG\r\n\x1a\n' + bytes(range(256)) * 64
+EXPORT_TABLES = ('sales', 'inventory', 'bills', 'transactions')
+
+
+class Request:
+    def __init__(self, method, path, json=None, form=None, files=None):
+        self.method = method
+        self.path = path
+        self.json = json
+        self.form = form
+        self.files = files or {}
+
+
+def sample_context(database, seed):
+    """Pull ids and values from the dataset to build realistic requests"""
+    conn = sqlite3.connect(f'file:{database}?mode=ro', uri=True)
+    rng = random.Random(seed)
+
+    def column(sql):
+        return [row[0] for row in conn.execute(sql)]
+
+    # Read in a stable order and sample with rng: SQL random() is unseeded
+    def sample(rows, k=1000):
+        return rng.sample(rows, min(k, len(rows)))
+
+    ctx = {
+        'bill_ids': sample(column('SELECT id FROM bills ORDER BY id')),
+        'receipt_ids': sample(column('SELECT id FROM financial_transactions '
+                                     'WHERE image_hash IS NOT NULL ORDER BY id')),
+        'customers': sample(conn.execute('SELECT name, phone FROM customers '
+                                         'ORDER BY id').fetchall()),
+        'customer_ids': sample(column('SELECT id FROM customers ORDER BY id')),
+        'order_ids': column('SELECT id FROM advance_orders ORDER BY id DESC LIMIT 5000'),
+        'dates': column('SELECT DISTINCT date FROM sales ORDER BY date'),
+        'fish': column('SELECT fish_type FROM stock ORDER BY fish_type'),
+    }
+    conn.close()
+    ctx['dates'] = ctx['dates'] or [datetime.now().date().isoformat()]
+    ctx['fish'] = ctx['fish'] or ['Pomfret']
+    ctx['rng'] = rng
+    return ctx
+
+
+def endpoints(ctx, include_writes):
+    rng = ctx['rng']
+
+    def pick(values, default=1):
+        return rng.choice(values) if values else default
+
+    def date_range():
+        start = rng.randrange(len(ctx['dates']))
+        end = min(start + rng.randrange(1, 8), len(ctx['dates']) - 1)
+        return ctx['dates'][start], ctx['dates'][end]
+
+    def customer():
+        return pick(ctx['customers'], ('Walk-in', '0000000000'))
+
+    reads = {
+        'GET /api/inventory': lambda: Request('GET', '/api/inventory?limit=100'),
+        'GET /api/inventory (stream)': lambda: Request('GET', '/api/inventory?stream=1'),
+        'GET /api/sales/summary': lambda: Request('GET', '/api/sales/summary'),
+        'GET /api/sales/by-fish': lambda: Request('GET', '/api/sales/by-fish'),
+        'GET /api/sales/monthly-trend': lambda: Request('GET', '/api/sales/monthly-trend'),
+        'GET /api/stock': lambda: Request('GET', '/api/stock'),
+        'GET /api/dashboard': lambda: Request('GET', '/api/dashboard'),
+        'GET /api/fish-types': lambda: Request('GET', '/api/fish-types'),
+        'GET /api/fish_items': lambda: Request('GET', '/api/fish_items'),
+        'GET /api/customers': lambda: Request('GET', '/api/customers'),
+        'GET /api/bills': lambda: Request('GET', '/api/bills?limit=100'),
+        'GET /api/bills/<id>': lambda: Request('GET', f'/api/bills/{pick(ctx["bill_ids"])}'),
+        'GET /api/bills/search': lambda: Request(
+            'GET', '/api/bills/search?' + urllib.parse.urlencode({'name': customer()[0][:5]})),
+        'GET /api/customers/search': lambda: Request(
+            'GET', '/api/customers/search?' + urllib.parse.urlencode({'phone': customer()[1][-4:]})),
+        'GET /api/transactions': lambda: Request('GET', '/api/transactions'),
+        'GET /api/transactions/<id>/receipt': lambda: Request(
+            'GET', f'/api/transactions/{pick(ctx["receipt_ids"])}/receipt'),
+        'GET /api/transactions/search': lambda: Request(
+            'GET', '/api/transactions/search?' + urllib.parse.urlencode(
+                dict(zip(('start_date', 'end_date'), date_range())))),
+        'GET /api/transactions/summary': lambda: Request(
+            'GET', f'/api/transactions/summary?date={pick(ctx["dates"])}'),
+        'GET /api/get_advance_orders': lambda: Request('GET', '/api/get_advance_orders?limit=100'),
+        'GET /api/db/stats': lambda: Request('GET', '/api/db/stats'),
+        'GET /api/customers/<id>/balance': lambda: Request(
+            'GET', f'/api/customers/{pick(ctx["customer_ids"])}/balance'),
+        'GET /api/customers/<id>/ledger': lambda: Request(
+            'GET', f'/api/customers/{pick(ctx["customer_ids"])}/ledger?limit=100'),
+        'GET /api/stock/as_of': lambda: Request(
+            'GET', f'/api/stock/as_of?date={pick(ctx["dates"])}'),
+        'GET /api/export/<table>': lambda: Request(
+            'GET', f'/api/export/{rng.choice(EXPORT_TABLES)}?' + urllib.parse.urlencode({
+                'format': rng.choice(('csv', 'ndjson')),
+                **dict(zip(('start_date', 'end_date'), date_range()))})),
+        'GET /api/analytics/series': lambda: Request(
+            'GET', '/api/analytics/series?' + urllib.parse.urlencode({
+                'granularity': rng.choice(('day', 'week', 'month')), 'fish': pick(ctx['fish']),
+                **dict(zip(('from', 'to'), date_range()))})),
+        'GET /api/analytics/customers': lambda: Request(
+            'GET', '/api/analytics/customers?sort=' + rng.choice(('spend', 'frequency', 'recent'))),
+        'GET /api/analytics/margin': lambda: Request(
+            'GET', '/api/analytics/margin?granularity=' + rng.choice(('day', 'week', 'month'))),
+        'GET /api/analytics/valuation': lambda: Request('GET', '/api/analytics/valuation'),
+    }
+    if not include_writes:
+        return reads
+
+    def bill():
+        items = []
+        for _ in range(rng.randint(1, 6)):
+            quantity = round(rng.uniform(0.5, 3), 2)
+            items.append({'fish_name': pick(ctx['fish']), 'quantity': quantity,
+                          'unit_price': 300, 'total_price': round(quantity * 300, 2)})
+        subtotal = round(sum(item['total_price'] for item in items), 2)
+        name, phone = customer()
+        return {'customer_name': name, 'customer_phone': phone, 'items': items,
+                'subtotal': subtotal, 'tax': 0, 'total_amount': subtotal,
+                'amount_paid': subtotal, 'balance_due': 0}
+
+    def import_csv():
+        lines = ['date,supplier_name,supplier_contact,fish_type,type,quantity,unit_price']
+        lines += [f'{pick(ctx["dates"])},Load Test,0,{pick(ctx["fish"])},IN,20,200'
+                  for _ in range(20)]
+        return ('\n'.join(lines) + '\n').encode()
+
+    writes = {
+        'POST /api/inventory': lambda: Request('POST', '/api/inventory', json={
+            'date': pick(ctx['dates']), 'supplierName': 'Load Test', 'supplierContact': '0',
+            'fishType': pick(ctx['fish']), 'type': 'IN', 'quantity': 50, 'unitPrice': 200}),
+        'POST /api/salesRecord': lambda: Request('POST', '/api/salesRecord', json={
+            'date': pick(ctx['dates']), 'purchaserName': customer()[0], 'purchaserContact': '0',
+            'fishType': pick(ctx['fish']), 'type': 'OUT', 'quantity': 1, 'unitPrice': 300}),
+        'POST /api/customers': lambda: Request('POST', '/api/customers', json=dict(
+            zip(('name', 'phone'), customer()))),
+        'POST /api/bills': lambda: Request('POST', '/api/bills', json=bill()),
+        'POST /api/transactions': lambda: Request('POST', '/api/transactions', form={
+            'transaction_type': rng.choice(('in', 'out')), 'payment_method': 'cash',
+            'amount': str(rng.randrange(100, 5000)), 'client_name': customer()[0]},
+            files={'receipt_image': ('receipt.png', 'image/png', RECEIPT_IMAGE)}),
+        'POST /api/save_advance_order': lambda: Request('POST', '/api/save_advance_order', json={
+            'date': pick(ctx['dates']), 'amount': 1000, 'fishType': pick(ctx['fish']),
+            'advance': 200, 'name': customer()[0], 'contact': '0'}),
+        'DELETE /api/delete_order/<id>': lambda: Request(
+            'DELETE', f'/api/delete_order/{ctx["order_ids"].pop() if ctx["order_ids"] else 0}'),
+        'POST /api/import/<kind>': lambda: Request('POST', '/api/import/inventory', form={},
+                                                   files={'file': ('import.csv', 'text/csv',
+                                                                   import_csv())}),
+        # Last: it zeroes stock, so any sale after it would be refused
+        'POST /api/stock/reset': lambda: Request('POST', '/api/stock/reset'),
+    }
+    return {**reads, **writes}
+
+
+def load_app(database):
+    os.environ['DATABASE_PATH'] = os.path.abspath(database)
+    sys.path.insert(0, ROOT)
+    import app
+
+    return app.app
+
+
+def route_key(name):
+    """'GET /api/bills/<id>' and 'GET /api/bills/<int:bill_id>' both become
+    ('GET', '/api/bills/<>'); a ' (variant)' suffix is dropped"""
+    method, path = name.split(' (')[0].split(' ', 1)
+    return method, re.sub(r'<[^>]*>', '<>', path)
+
+
+def uncovered_routes(flask_app, names):
+    """'METHOD rule' for every /api/ route no endpoint in names exercises"""
+    covered = {route_key(name) for name in names}
+    return sorted(f'{method} {rule.rule}' for rule in flask_app.url_map.iter_rules()
+                  if rule.rule.startswith('/api/')
+                  for method in rule.methods - {'HEAD', 'OPTIONS'}
+                  if route_key(f'{method} {rule.rule}') not in covered)
+
+
+class TestClientTransport:
+    def __init__(self, database):
+        self.client = load_app(database).test_client()
+
+    def send(self, req):
+        kwargs = {}
+        if req.json is not None:
+            kwargs['json'] = req.json
+        if req.form is not None:
+            data = dict(req.form)
+            for field, (filename, mimetype, body) in req.files.items():
+                data[field] = (io.BytesIO(body), filename, mimetype)
+            kwargs['data'] = data
+            kwargs['content_type'] = 'multipart/form-data'
+        response = self.client.open(req.path, method=req.method, **kwargs)
+        return response.status_code, len(response.get_data())
+
+
+class HttpTransport:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+
+    def send(self, req):
+        headers = {}
+        body = None
+        if req.json is not None:
+            body = json.dumps(req.json).encode()
+            headers['Content-Type'] = 'application/json'
+        elif req.form is not None:
+            body, headers['Content-Type'] = self.multipart(req.form, req.files)
+        request = urllib.request.Request(self.base_url + req.path, data=body,
+                                         headers=headers, method=req.method)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                return response.status, len(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, len(e.read())
+
+    @staticmethod
+    def multipart(form, files):
+        boundary = uuid.uuid4().hex
+        parts = []
+        for name, value in form.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"'
+                         f'\r\n\r\n{value}\r\n'.encode())
+        for name, (filename, mimetype, content) in files.items():
+            parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; '
+                         f'filename="{filename}"\r\nContent-Type: {mimetype}\r\n\r\n'.encode()
+                         + content + b'\r\n')
+        parts.append(f'--{boundary}--\r\n'.encode())
+        return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+def percentile(sorted_values, fraction):
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_endpoint(transport, make_request, count, concurrency):
+    requests = [make_request() for _ in range(count)]
+
+    def timed(req):
+        t0 = time.perf_counter()
+        status, size = transport.send(req)
+        return time.perf_counter() - t0, status, size
+
+    started = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(concurrency) as pool:
+            results = list(pool.map(timed, requests))
+    else:
+        results = [timed(req) for req in requests]
+    elapsed = time.perf_counter() - started
+
+    latencies = sorted(r[0] * 1000 for r in results)
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': count,
+        'errors': sum(1 for _, status, _ in results if status >= 500),
+        'statuses': statuses,
+        'throughput_rps': round(count / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'mean_bytes': round(sum(r[2] for r in results) / count),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True, help='dataset to sample request parameters from')
+    parser.add_argument('--url', help='base URL of a running server; default is the Flask test client')
+    parser.add_argument('--requests', type=int, default=100, help='requests per endpoint')
+    parser.add_argument('--concurrency', type=int, default=1, help='requests in flight (HTTP mode)')
+    parser.add_argument('--read-only', action='store_true', help='skip POST/DELETE endpoints')
+    parser.add_argument('--only', help='only run endpoints whose name contains this text')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    args = parser.parse_args()
+
+    ctx = sample_context(args.database, args.seed)
+    uncovered = uncovered_routes(load_app(args.database), endpoints(ctx, True))
+    if uncovered:
+        print('No load endpoint for: ' + ', '.join(uncovered), file=sys.stderr)
+        return 2
+    transport = HttpTransport(args.url) if args.url else TestClientTransport(args.database)
+    concurrency = args.concurrency if args.url else 1
+
+    results = {}
+    for name, make_request in endpoints(ctx, not args.read_only).items():
+        if args.only and args.only not in name:
+            continue
+        results[name] = run_endpoint(transport, make_request, args.requests, concurrency)
+        print(f'{name:40s} {results[name]["throughput_rps"]:>9} rps  '
+              f'p50 {results[name]["p50_ms"]:>8} ms  p99 {results[name]["p99_ms"]:>8} ms',
+              file=sys.stderr)
+
+    report = {
+        'commit': git_commit(),
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'mode': 'http' if args.url else 'test_client',
+        'url': args.url,
+        'concurrency': concurrency,
+        'database': args.database,
+        'requests_per_endpoint': args.requests,
+        'endpoints': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+    return 1 if any(r['errors'] for r in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
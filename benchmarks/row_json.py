@@ -0,0 +1,97 @@
+"""Row-to-JSON microbenchmark: generated row encoders vs dicts + jsonify.
+
+For each list query it times, over the same fetched rows, the previous path
+(a dict per row, then jsonify) against json_rows, which uses
+row_json.RowEncoder, checks both produce the same bytes and reports rows/s
+and the speedup. Fetching is not timed.
+
+    python -m benchmarks.generate --database /tmp/bench.db --scale 10
+    python -m benchmarks.row_json --database /tmp/bench.db
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from benchmarks.load import git_commit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def cases(app):
+    """(name, query, dict builder, Fields)"""
+    import row_json
+    return [
+        ('inventory', 'SELECT * FROM inventory ORDER BY date DESC, id DESC',
+         app.inventory_to_dict, app.INVENTORY_FIELDS),
+        ('bills', '''SELECT bills.*, customers.name as customer_name,
+                            customers.phone as customer_phone
+                     FROM bills LEFT JOIN customers ON bills.customer_id = customers.id
+                     ORDER BY bills.bill_date DESC, bills.id DESC''',
+         dict, row_json.PLAIN),
+        ('transactions', '''SELECT id, transaction_type, payment_method, amount, client_name,
+                                   client_phone, image_name, image_type, notes,
+                                   strftime('%Y-%m-%d %H:%M:%S', created_at) as created_at
+                            FROM financial_transactions ORDER BY created_at DESC, id DESC''',
+         lambda tx: dict(tx, amount=float(tx['amount'])), app.TRANSACTION_FIELDS),
+    ]
+
+
+def best_of(repeat, fn):
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--database', required=True)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.abspath(args.database)
+    sys.path.insert(0, ROOT)
+    import app
+
+    report = {'commit': git_commit(), 'database': args.database, 'cases': {}}
+    # jsonify needs an application context
+    app.app.app_context().push()
+    conn = app.get_db_connection()
+    try:
+        for name, query, to_dict, fields in cases(app):
+            cursor = conn.execute(query)
+            rows = cursor.fetchall()
+
+            def old():
+                return app.jsonify([to_dict(row) for row in rows]).get_data()
+
+            def new():
+                # Includes the per-shape encoder lookup, as a request does
+                return app.json_rows(cursor, rows, fields).get_data()
+
+            old_seconds, old_body = best_of(args.repeat, old)
+            new_seconds, new_body = best_of(args.repeat, new)
+            report['cases'][name] = {
+                'rows': len(rows),
+                'bytes': len(new_body),
+                'identical': old_body == new_body,
+                'dicts_rows_per_s': round(len(rows) / old_seconds),
+                'encoder_rows_per_s': round(len(rows) / new_seconds),
+                'speedup': round(old_seconds / new_seconds, 2),
+            }
+            print(f"{name:13s} {len(rows):8d} rows: dicts {old_seconds * 1000:8.1f}ms "
+                  f"encoder {new_seconds * 1000:8.1f}ms "
+                  f"x{old_seconds / new_seconds:.2f}", file=sys.stderr)
+    finally:
+        conn.close()
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,128 @@
+"""Multi-process stress test for concurrent sales against limited stock.
+
+Several worker processes hammer POST /api/salesRecord for the same fish
+until it runs out. Reports request throughput and latency percentiles, then
+checks that stock never went negative and that every kilo sold is
+accounted for.
+
+    python benchmarks/stock_stress.py [--workers 8] [--sales 300] [--stock 500]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FISH = 'Pomfret'
+
+
+def worker(seed, sales, start_event, results):
+    import app
+
+    client = app.app.test_client()
+    rng = random.Random(seed)
+    ok = rejected = errors = 0
+    latencies = []
+    start_event.wait()
+    for _ in range(sales):
+        quantity = round(rng.uniform(0.5, 3), 2)
+        t0 = time.perf_counter()
+        response = client.post('/api/salesRecord', json={
+            'date': '2024-06-01', 'purchaserName': f'counter {seed}',
+            'purchaserContact': '0', 'fishType': FISH, 'type': 'OUT',
+            'quantity': quantity, 'unitPrice': 350})
+        latencies.append(time.perf_counter() - t0)
+        if response.status_code == 200:
+            ok += 1
+        elif response.status_code == 400:
+            rejected += 1
+        else:
+            errors += 1
+    results.put({'ok': ok, 'rejected': rejected, 'errors': errors, 'latencies': latencies})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--sales', type=int, default=300, help='attempts per worker')
+    parser.add_argument('--stock', type=float, default=500.0)
+    args = parser.parse_args()
+
+    os.environ['DATABASE_PATH'] = os.path.join(tempfile.mkdtemp(), 'stress.db')
+    sys.path.insert(0, ROOT)
+    import app
+
+    app.init_db()
+    conn = app.get_db_connection()
+    conn.execute('INSERT INTO stock (fish_type, current_quantity) VALUES (?, ?)',
+                 (FISH, args.stock))
+    # Record the lowest value stock ever takes, to prove it never dips below 0
+    conn.execute('CREATE TABLE stress_low_water (quantity REAL)')
+    conn.execute('INSERT INTO stress_low_water VALUES (?)', (args.stock,))
+    conn.execute('''CREATE TRIGGER stress_low_water AFTER UPDATE ON stock
+                    BEGIN
+                        UPDATE stress_low_water SET quantity = MIN(quantity, NEW.current_quantity);
+                    END''')
+    conn.commit()
+    conn.close()
+    app.pool.close_all()
+
+    ctx = multiprocessing.get_context('fork')
+    start_event = ctx.Event()
+    results = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(i, args.sales, start_event, results))
+             for i in range(args.workers)]
+    for proc in procs:
+        proc.start()
+    started = time.perf_counter()
+    start_event.set()
+    collected = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - started
+
+    conn = app.get_db_connection()
+    final = conn.execute('SELECT current_quantity FROM stock WHERE fish_type = ?', (FISH,)).fetchone()[0]
+    sold, sale_count = conn.execute('SELECT COALESCE(SUM(quantity), 0), COUNT(*) FROM sales').fetchone()
+    low_water = conn.execute('SELECT quantity FROM stress_low_water').fetchone()[0]
+    conn.close()
+
+    latencies = sorted(l for r in collected for l in r['latencies'])
+    ok = sum(r['ok'] for r in collected)
+    report = {
+        'workers': args.workers,
+        'attempts': len(latencies),
+        'sales_ok': ok,
+        'rejected_insufficient': sum(r['rejected'] for r in collected),
+        'errors': sum(r['errors'] for r in collected),
+        'seconds': round(elapsed, 3),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 2),
+        'initial_stock': args.stock,
+        'final_stock': round(final, 6),
+        'lowest_stock_seen': round(low_water, 6),
+        'sold_quantity': round(sold, 6),
+    }
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if low_water < -1e-9:
+        failures.append('stock went negative')
+    if abs(args.stock - sold - final) > 1e-6:
+        failures.append('sold quantity does not reconcile with stock')
+    if sale_count != ok:
+        failures.append('sales rows do not match successful responses')
+    if report['errors']:
+        failures.append('requests failed with server errors')
+    for failure in failures:
+        print('FAIL:', failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
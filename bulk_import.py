@@ -0,0 +1,194 @@
+"""Bulk CSV import for inventory and sales.
+
+The whole file is parsed and validated before anything is written; if any
+row is invalid nothing is imported and every bad row is reported. Valid
+files are inserted with executemany in one BEGIN IMMEDIATE transaction and
+stock gets one aggregated update per fish_type instead of one per row. The
+FIFO cost basis (see cost_basis.py) and the daily stock checkpoints (see
+stock.py) catch up in the same transaction.
+
+Headers are matched loosely, so the API field names (supplierName), the
+column names (supplier_name) and spreadsheet headings (Supplier Name) all
+work, and a file from /api/export/<table> can be imported back.
+"""
+import csv
+import json
+from datetime import date
+
+import cost_basis
+import stock
+
+MAX_REPORTED_ERRORS = 100
+
+KINDS = {
+    'inventory': {
+        'fields': ['date', 'supplier_name', 'supplier_contact', 'fish_type', 'type',
+                   'quantity', 'unit_price'],
+        'defaults': {},
+        'insert': '''INSERT INTO inventory
+                     (date, supplier_name, supplier_contact, fish_type, transaction_type,
+                      quantity, unit_price, total_price)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+    },
+    'sales': {
+        'fields': ['date', 'purchaser_name', 'purchaser_contact', 'fish_type', 'type',
+                   'quantity', 'unit_price'],
+        'defaults': {'type': 'OUT'},
+        'insert': '''INSERT INTO sales
+                     (date, purchaser_name, purchaser_contact, fish_type, transaction_type,
+                      quantity, unit_price, total_price)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+        # Sales take stock out, so they must not oversell (like reserve_stock)
+        'check_stock': True,
+    },
+}
+
+# Extra header spellings, after normalize_header()
+ALIASES = {
+    'transactiontype': 'type',
+}
+
+
+def normalize_header(name):
+    return ''.join(ch for ch in name.lower() if ch.isalnum())
+
+
+def parse_csv(kind, lines):
+    """Validate a CSV for kind.
+
+    Returns (rows, errors, stock_changes): rows are ready for the INSERT,
+    errors is a list of {'line', 'errors'} and stock_changes maps fish_type
+    to its net quantity change.
+    """
+    spec = KINDS[kind]
+    reader = csv.reader(lines)
+    header = next(reader, None)
+    if header is None:
+        return [], [{'line': 1, 'errors': ['File is empty']}], {}
+
+    wanted = {normalize_header(field): field for field in spec['fields']}
+    positions = {}
+    for i, name in enumerate(header):
+        key = normalize_header(name)
+        field = wanted.get(ALIASES.get(key, key))
+        if field and field not in positions:
+            positions[field] = i
+    missing = [f for f in spec['fields'] if f not in positions and f not in spec['defaults']]
+    if missing:
+        return [], [{'line': 1, 'errors': [f"Missing column: {', '.join(missing)}"]}], {}
+
+    fields = spec['fields']
+    getters = [(field, positions.get(field), spec['defaults'].get(field, '')) for field in fields]
+    rows, errors, stock_changes = [], [], {}
+    for line_no, record in enumerate(reader, start=2):
+        if not any(cell.strip() for cell in record):
+            continue  # blank spreadsheet line
+        values = {}
+        for field, position, default in getters:
+            value = record[position].strip() if position is not None and position < len(record) else ''
+            values[field] = value or default
+
+        problems = [f'{field} is required' for field in fields if not values[field]]
+        if values['date']:
+            try:
+                date.fromisoformat(values['date'])
+            except ValueError:
+                problems.append('date must be YYYY-MM-DD')
+        direction = values['type'].upper()
+        if direction and direction not in ('IN', 'OUT'):
+            problems.append('type must be IN or OUT')
+        quantity = unit_price = None
+        try:
+            quantity = float(values['quantity'])
+            if not quantity > 0:
+                problems.append('quantity must be positive')
+        except ValueError:
+            if values['quantity']:
+                problems.append('quantity must be a number')
+        try:
+            unit_price = float(values['unit_price'])
+            if unit_price < 0:
+                problems.append('unit_price cannot be negative')
+        except ValueError:
+            if values['unit_price']:
+                problems.append('unit_price must be a number')
+
+        if problems:
+            errors.append({'line': line_no, 'errors': problems})
+            continue
+        fish_type = values['fish_type']
+        delta = quantity if direction == 'IN' else -quantity
+        stock_changes[fish_type] = stock_changes.get(fish_type, 0) + delta
+        rows.append((values['date'], values[fields[1]], values[fields[2]], fish_type,
+                     direction, quantity, unit_price, quantity * unit_price))
+    return rows, errors, stock_changes
+
+
+def apply_import(conn, kind, rows, stock_changes, utc_offset_minutes, dry_run=False):
+    """Insert rows and apply stock_changes in one transaction.
+
+    Returns a list of shortages (empty on success). With dry_run, or when
+    there are shortages, everything is rolled back.
+    """
+    spec = KINDS[kind]
+    changes_json = json.dumps(stock_changes)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        if spec.get('check_stock'):
+            shortages = conn.execute('''
+            SELECT change.key, -change.value, COALESCE(stock.current_quantity, 0)
+            FROM json_each(?) AS change
+            LEFT JOIN stock ON stock.fish_type = change.key
+            WHERE COALESCE(stock.current_quantity, 0) + change.value < 0
+            ''', (changes_json,)).fetchall()
+            if shortages:
+                conn.rollback()
+                return [{'fish_type': fish, 'requested': wanted, 'available': available}
+                        for fish, wanted, available in shortages]
+
+        conn.executemany(spec['insert'], rows)
+        conn.execute('''
+        INSERT OR IGNORE INTO stock (fish_type, current_quantity)
+        SELECT key, 0 FROM json_each(?)
+        ''', (changes_json,))
+        conn.execute('''
+        UPDATE stock
+        SET current_quantity = current_quantity + change.value,
+            last_updated = CURRENT_TIMESTAMP
+        FROM json_each(?) AS change
+        WHERE stock.fish_type = change.key
+        ''', (changes_json,))
+
+        if dry_run:
+            conn.rollback()
+        else:
+            cost_basis.apply_pending(conn, utc_offset_minutes)
+            stock.write_checkpoints(conn, utc_offset_minutes)
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return []
+
+
+def import_csv(conn, kind, lines, utc_offset_minutes, dry_run=False):
+    """Validate and import a CSV (any iterable of text lines); returns a report.
+    utc_offset_minutes is the shop's, for the cost basis and checkpoint days."""
+    rows, errors, stock_changes = parse_csv(kind, lines)
+    report = {
+        'kind': kind,
+        'dry_run': dry_run,
+        'rows': len(rows) + len(errors),
+        'imported': 0,
+        'error_count': len(errors),
+        'errors': errors[:MAX_REPORTED_ERRORS],
+        'stock_changes': {fish: round(change, 3) for fish, change in stock_changes.items()},
+        'shortages': [],
+    }
+    if errors or not rows:
+        return report
+    report['shortages'] = apply_import(conn, kind, rows, stock_changes, utc_offset_minutes,
+                                       dry_run=dry_run)
+    if not report['shortages'] and not dry_run:
+        report['imported'] = len(rows)
+    return report
@@ -0,0 +1,58 @@
+import threading
+
+
+def get_data_version(cursor, tables):
+    """Combined change counter for the given tables, usable as an ETag"""
+    placeholders = ','.join('?' * len(tables))
+    cursor.execute(f'SELECT name, version FROM data_versions WHERE name IN ({placeholders})',
+                   list(tables))
+    versions = dict(cursor.fetchall())
+    return '-'.join(str(versions.get(table, 0)) for table in tables)
+
+
+class VersionedCache:
+    """In-process read-through cache for small reference data.
+
+    Entries are tagged with the data_versions counters of the tables they
+    were built from. The triggers bump those counters on every write, from
+    any worker process, so a lookup costs one primary-key read and a stale
+    entry is reloaded as soon as its tables have changed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, conn, key, tables, loader):
+        """Return (version, value) for key, calling loader(conn) on a miss"""
+        # Version and value come from the same snapshot, so a value is never
+        # cached under a newer version than the data it was built from
+        conn.execute('BEGIN')
+        try:
+            version = get_data_version(conn.cursor(), tables)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry and entry[0] == version:
+                    self._hits += 1
+                    return entry
+                self._misses += 1
+            value = loader(conn)
+        finally:
+            conn.commit()
+
+        with self._lock:
+            self._entries[key] = (version, value)
+        return version, value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self._hits, 'misses': self._misses}
+
+
+reference_cache = VersionedCache()
@@ -0,0 +1,114 @@
+"""Response compression, content-hash ETags and fingerprinted static files.
+
+Dynamic responses (JSON and text) bigger than COMPRESS_MIN_BYTES are
+gzipped or deflated at COMPRESS_LEVEL, whichever the client prefers, and
+GET responses without a validator of their own get an ETag hashed from the
+body, so a repeat request that hasn't changed is a 304 with no body.
+
+Static files are read and compressed once at startup (COMPRESS_STATIC_LEVEL,
+gzip and deflate) and served from memory. url_for('static', ...) links to a
+fingerprinted name (style.<hash>.css) which is served with a one-year
+immutable Cache-Control; the plain name still works but is revalidated on
+every load. Editing a file changes its hash and therefore its URL.
+
+As nginx does, a compressed body's ETag is weak, since it names the same
+content as the identity body's strong one.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import zlib
+
+MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+LEVEL = int(os.environ.get('COMPRESS_LEVEL', 6))
+STATIC_LEVEL = int(os.environ.get('COMPRESS_STATIC_LEVEL', 9))
+
+ENCODINGS = ('gzip', 'deflate')
+COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'text/javascript',
+                      'text/css', 'text/html', 'text/plain', 'text/csv', 'image/svg+xml'}
+# name.<16 hex>.ext
+FINGERPRINT = re.compile(r'^(?P<stem>.+)\.(?P<hash>[0-9a-f]{16})(?P<ext>\.[^./]+)$')
+
+
+def content_hash(data):
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+
+def compress(data, encoding, level=LEVEL):
+    if encoding == 'gzip':
+        # mtime=0 keeps the output (and so the bytes sent) deterministic
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'deflate':
+        # HTTP "deflate" is the zlib format, not raw deflate
+        return zlib.compress(data, level)
+    raise ValueError(f'Unknown encoding: {encoding}')
+
+
+def is_compressible(mimetype):
+    return mimetype in COMPRESSIBLE_TYPES
+
+
+def fingerprinted(filename, digest):
+    stem, ext = os.path.splitext(filename)
+    return f'{stem}.{digest}{ext}'
+
+
+class StaticAsset:
+    __slots__ = ('filename', 'mimetype', 'digest', 'bodies')
+
+    def __init__(self, filename, mimetype, data, level):
+        self.filename = filename
+        self.mimetype = mimetype
+        self.digest = content_hash(data)
+        # encoding -> bytes; None is the identity body
+        self.bodies = {None: data}
+        if is_compressible(mimetype):
+            for encoding in ENCODINGS:
+                body = compress(data, encoding, level)
+                if len(body) < len(data):
+                    self.bodies[encoding] = body
+
+
+class StaticAssets:
+    """The static folder, loaded and precompressed in memory"""
+
+    def __init__(self, folder, level=STATIC_LEVEL):
+        self.folder = folder
+        self.assets = {}
+        if not folder or not os.path.isdir(folder):
+            return
+        for root, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, '/')
+                mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+                with open(path, 'rb') as f:
+                    self.assets[filename] = StaticAsset(filename, mimetype, f.read(), level)
+
+    def url_filename(self, filename):
+        """The fingerprinted name to link to (unknown files are left alone)"""
+        asset = self.assets.get(filename)
+        return fingerprinted(filename, asset.digest) if asset else filename
+
+    def lookup(self, filename):
+        """(asset, immutable) for a requested name, or (None, False).
+
+        immutable is true when the name carries the asset's current
+        fingerprint; a stale fingerprint still gets the current content.
+        """
+        asset = self.assets.get(filename)
+        if asset:
+            return asset, False
+        match = FINGERPRINT.match(filename)
+        if match:
+            asset = self.assets.get(match['stem'] + match['ext'])
+            if asset:
+                return asset, asset.digest == match['hash']
+        return None, False
+
+    def stats(self):
+        identity = sum(len(a.bodies[None]) for a in self.assets.values())
+        gzipped = sum(len(a.bodies.get('gzip', a.bodies[None])) for a in self.assets.values())
+        return {'files': len(self.assets), 'bytes': identity, 'gzip_bytes': gzipped}
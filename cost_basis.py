@@ -0,0 +1,517 @@
+"""FIFO cost basis: realised margin per fish and inventory valuation.
+
+Every stock movement (see stock.py) is replayed against lots, per fish in
+(at, id) order. A movement that adds stock opens a lot; an inventory IN row
+costs its total_price, anything else (customer returns, adjustments) opens
+a lot of unknown cost. A movement that takes stock consumes the oldest open
+lots first: sales and bill items are 'sale' matches carrying their share of
+the line's total_price as revenue, everything else (inventory OUT, resets,
+adjustments) is a 'writeoff'. Quantity with nothing left to consume, or
+taken from a lot of unknown cost, is matched with cost NULL and reported as
+unmatched rather than as free stock.
+
+cost_lots holds every lot with what is still on hand, cost_matches one row
+per (consumption, lot) piece, and daily_margin the per-day, per-fish
+totals the reports read. cost_state holds the last movement applied and
+the all-time revenue and cost, so the sales summary reads one row.
+apply_pending() applies the movements logged since then, reading open lots
+a page at a time, oldest first, only as far as the new sales take from
+them. A movement dated before something already applied for its fish
+replays that fish from the movement's time (the matches from there on are
+undone and redone), so the result is always what rebuild() would give.
+rebuild() is one pass over the ledger in index order.
+
+Every write that logs movements calls apply_pending() in its own
+transaction, so the reports are always current and never write. sync() is
+the catch-up for anything logged outside the app (flask cost-basis).
+"""
+from collections import deque
+from datetime import date
+
+from analytics import BUCKET_SQL, GRANULARITIES, bucket_labels
+from db import run_in_transaction
+
+# Quantities are REAL; anything smaller is rounding left over
+EPSILON = 1e-9
+BATCH_SIZE = 10000
+# Stored open lots read at a time when a sale reaches them
+LOT_PAGE = 32
+
+# Sources whose negative movements are sales; the rest are write-offs
+SALE_SOURCES = ('sales', 'bill_items')
+
+# daily_margin columns after (day, fish_type), in the order of _totals()
+TOTALS = ('quantity', 'revenue', 'cost', 'unmatched_quantity', 'unmatched_revenue',
+          'writeoff_quantity', 'writeoff_cost')
+
+# Movements with the date and value of the row behind them; {where} is
+# filled in by the caller. Ordered by the (fish_type, at) index, so the
+# full ledger streams without a sort.
+MOVEMENTS_SQL = '''
+SELECT m.id, m.fish_type, m.delta, m.at, m.source,
+       CASE m.source WHEN 'inventory' THEN inventory.date
+                     WHEN 'sales' THEN sales.date
+                     WHEN 'bill_items' THEN bills.bill_date
+       END AS day,
+       CASE m.source WHEN 'inventory' THEN inventory.total_price
+                     WHEN 'sales' THEN sales.total_price
+                     WHEN 'bill_items' THEN bill_items.total_price
+       END AS value
+FROM stock_movements AS m
+LEFT JOIN inventory ON m.source = 'inventory' AND inventory.id = m.source_id
+LEFT JOIN sales ON m.source = 'sales' AND sales.id = m.source_id
+LEFT JOIN bill_items ON m.source = 'bill_items' AND bill_items.id = m.source_id
+LEFT JOIN bills ON bills.id = bill_items.bill_id
+{where}
+ORDER BY m.fish_type, m.at, m.id
+'''
+
+
+class Lot:
+    __slots__ = ('id', 'fish_type', 'at', 'day', 'quantity', 'remaining', 'unit_cost', 'stored')
+
+    def __init__(self, id, fish_type, at, day, quantity, remaining, unit_cost, stored):
+        self.id = id
+        self.fish_type = fish_type
+        self.at = at
+        self.day = day
+        self.quantity = quantity
+        self.remaining = remaining
+        self.unit_cost = unit_cost
+        # Whether the row already exists in cost_lots (UPDATE, not INSERT)
+        self.stored = stored
+
+
+class _Book:
+    """Open lots of one fish, oldest first.
+
+    Lots already in cost_lots (opened before `until`, when given) are read a
+    page at a time as consumption reaches them, so a sale only loads the
+    lots it takes from; lots opened in this pass queue up behind them.
+    """
+
+    def __init__(self, conn=None, fish_type=None, until=None):
+        self.conn = conn
+        self.fish_type = fish_type
+        self.until = until
+        self.stored = deque()
+        self.opened = deque()
+        # (at, id) of the last stored lot read; None once there are no more
+        self.after = ('', 0) if conn is not None else None
+
+    def append(self, lot):
+        self.opened.append(lot)
+
+    def first(self):
+        if not self.stored and self.after is not None:
+            self.read_page()
+        if self.stored:
+            return self.stored[0]
+        return self.opened[0] if self.opened else None
+
+    def pop(self):
+        (self.stored or self.opened).popleft()
+
+    def read_page(self):
+        where = 'fish_type = ? AND remaining > 0 AND (at, id) > (?, ?)'
+        params = [self.fish_type, *self.after]
+        if self.until is not None:
+            where += ' AND at < ?'
+            params.append(self.until)
+        lots = _lots(self.conn, where + f' ORDER BY at, id LIMIT {LOT_PAGE}', params)
+        self.stored.extend(lots)
+        self.after = (lots[-1].at, lots[-1].id) if len(lots) == LOT_PAGE else None
+
+
+def _totals(kind, quantity, revenue, cost):
+    """A match as daily_margin increments, in TOTALS order"""
+    if kind == 'writeoff':
+        return (0, 0, 0, 0, 0, quantity, cost or 0)
+    if cost is None:
+        return (0, 0, 0, quantity, revenue, 0, 0)
+    return (quantity, revenue, cost, 0, 0, 0, 0)
+
+
+class _Pass:
+    """Applies movements to per-fish lot queues and buffers the writes"""
+
+    def __init__(self, conn, to_local):
+        self.conn = conn
+        self.to_local = to_local
+        self.matches = []
+        self.totals = {}
+        self.lots = {}      # id -> Lot touched in this pass
+        self.applied = 0
+
+    def apply(self, book, movement, lot=None):
+        """Apply one MOVEMENTS_SQL row to a _Book.
+
+        lot is the existing cost_lots row when an already applied receipt
+        is replayed.
+        """
+        movement_id, fish_type, delta, at, source, day, value = movement
+        if day is None:
+            day = self.local_day(at)
+        self.applied += 1
+        if delta > EPSILON:
+            if lot is None:
+                unit_cost = value / delta if source == 'inventory' and value is not None else None
+                lot = Lot(movement_id, fish_type, at, day, delta, delta, unit_cost, False)
+            lot.remaining = lot.quantity
+            self.lots[lot.id] = lot
+            book.append(lot)
+        elif delta < -EPSILON:
+            kind = 'sale' if source in SALE_SOURCES else 'writeoff'
+            self.consume(book, movement_id, fish_type, at, day, -delta,
+                         (value or 0) if kind == 'sale' else 0, kind)
+
+    def consume(self, book, movement_id, fish_type, at, day, quantity, revenue, kind):
+        left = quantity
+        while left > EPSILON:
+            lot = book.first()
+            if lot is None:
+                break
+            take = min(left, lot.remaining)
+            cost = take * lot.unit_cost if lot.unit_cost is not None else None
+            self.match(movement_id, lot.id, fish_type, at, day, kind, take,
+                       revenue * take / quantity, cost)
+            lot.remaining -= take
+            self.lots[lot.id] = lot
+            if lot.remaining <= EPSILON:
+                lot.remaining = 0
+                book.pop()
+            left -= take
+        if left > EPSILON:
+            self.match(movement_id, None, fish_type, at, day, kind, left,
+                       revenue * left / quantity, None)
+
+    def match(self, movement_id, lot_id, fish_type, at, day, kind, quantity, revenue, cost):
+        self.matches.append((movement_id, lot_id, fish_type, at, day, kind, quantity, revenue, cost))
+        self.add_totals(day, fish_type, _totals(kind, quantity, revenue, cost))
+        if len(self.matches) >= BATCH_SIZE:
+            self.flush_matches()
+
+    def add_totals(self, day, fish_type, increments, sign=1):
+        current = self.totals.get((day, fish_type))
+        if current is None:
+            current = self.totals[day, fish_type] = [0] * len(TOTALS)
+        for i, value in enumerate(increments):
+            current[i] += sign * value
+
+    def local_day(self, at):
+        return self.conn.execute('SELECT date(?, ?)', (at, self.to_local)).fetchone()[0]
+
+    def flush_matches(self):
+        self.conn.executemany('''
+        INSERT INTO cost_matches
+            (movement_id, lot_id, fish_type, at, day, kind, quantity, revenue, cost)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', self.matches)
+        self.matches = []
+
+    def flush(self):
+        self.flush_matches()
+        lots = self.lots.values()
+        self.conn.executemany('''
+        INSERT INTO cost_lots (id, fish_type, at, day, quantity, remaining, unit_cost)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ''', [(lot.id, lot.fish_type, lot.at, lot.day, lot.quantity, lot.remaining, lot.unit_cost)
+              for lot in lots if not lot.stored])
+        self.conn.executemany('UPDATE cost_lots SET remaining = ? WHERE id = ?',
+                              [(lot.remaining, lot.id) for lot in lots if lot.stored])
+        self.lots = {}
+        columns = ', '.join(TOTALS)
+        self.conn.executemany(f'''
+        INSERT INTO daily_margin (day, fish_type, {columns})
+        VALUES (?, ?, {', '.join('?' * len(TOTALS))})
+        ON CONFLICT (day, fish_type) DO UPDATE
+        SET {', '.join(f'{name} = {name} + excluded.{name}' for name in TOTALS)}
+        ''', [key + tuple(values) for key, values in self.totals.items()])
+        revenue = sum(values[TOTALS.index('revenue')] for values in self.totals.values())
+        cost = sum(values[TOTALS.index('cost')] for values in self.totals.values())
+        self.conn.execute('UPDATE cost_state SET revenue = revenue + ?, cost = cost + ?',
+                          (revenue, cost))
+        self.totals = {}
+
+
+def _offset(utc_offset_minutes):
+    return f'{utc_offset_minutes:+d} minutes'
+
+
+def rebuild(conn, utc_offset_minutes):
+    """Recompute lots, matches and daily_margin from the whole stock ledger
+    in one pass; call inside a write transaction. Returns the number of
+    movements applied."""
+    for table in ('cost_matches', 'cost_lots', 'daily_margin'):
+        conn.execute(f'DELETE FROM {table}')
+    conn.execute('UPDATE cost_state SET revenue = 0, cost = 0')
+    last = conn.execute('SELECT COALESCE(MAX(id), 0) FROM stock_movements').fetchone()[0]
+    run = _Pass(conn, _offset(utc_offset_minutes))
+    fish_type, book = None, None
+    cursor = conn.cursor()
+    cursor.row_factory = None
+    cursor.execute(MOVEMENTS_SQL.format(where='WHERE m.id <= ?'), (last,))
+    while True:
+        movements = cursor.fetchmany(BATCH_SIZE)
+        if not movements:
+            break
+        for movement in movements:
+            if movement[1] != fish_type:
+                fish_type, book = movement[1], _Book()
+                # A fish's lots are final once the stream has moved past it
+                if len(run.lots) >= BATCH_SIZE:
+                    run.flush()
+            run.apply(book, movement)
+    run.flush()
+    conn.execute('UPDATE cost_state SET movement_id = ?', (last,))
+    return run.applied
+
+
+def _processed_at(conn, fish_type):
+    """Latest movement time already applied for a fish"""
+    return conn.execute('''
+    SELECT MAX(at) FROM (
+        SELECT MAX(at) AS at FROM cost_lots WHERE fish_type = :fish
+        UNION ALL
+        SELECT MAX(at) FROM cost_matches WHERE fish_type = :fish
+    )
+    ''', {'fish': fish_type}).fetchone()[0]
+
+
+def _unwind(run, fish_type, since):
+    """Undo a fish's matches from `since` on, giving their quantity back to
+    the lots they came from"""
+    conn = run.conn
+    restored = {}
+    for lot_id, day, kind, quantity, revenue, cost in conn.execute('''
+    SELECT lot_id, day, kind, quantity, revenue, cost FROM cost_matches
+    WHERE fish_type = ? AND at >= ?
+    ''', (fish_type, since)):
+        run.add_totals(day, fish_type, _totals(kind, quantity, revenue, cost), sign=-1)
+        if lot_id is not None:
+            restored[lot_id] = restored.get(lot_id, 0) + quantity
+    conn.execute('DELETE FROM cost_matches WHERE fish_type = ? AND at >= ?', (fish_type, since))
+    conn.executemany('UPDATE cost_lots SET remaining = remaining + ? WHERE id = ?',
+                     [(quantity, lot_id) for lot_id, quantity in restored.items()])
+
+
+def _lots(conn, where, params):
+    return [Lot(*row, True) for row in conn.execute(f'''
+    SELECT id, fish_type, at, day, quantity, remaining, unit_cost FROM cost_lots
+    WHERE {where}
+    ''', params)]
+
+
+def has_pending(conn):
+    """Whether movements were logged since the last sync (two index lookups)"""
+    mark = conn.execute('SELECT movement_id FROM cost_state').fetchone()[0]
+    latest = conn.execute('SELECT MAX(id) FROM stock_movements').fetchone()[0]
+    return latest is not None and latest > mark
+
+
+def apply_pending(conn, utc_offset_minutes):
+    """Apply the movements logged since the last sync; call inside a write
+    transaction. Returns the number of movements applied, counting
+    replayed ones."""
+    mark = conn.execute('SELECT movement_id FROM cost_state').fetchone()[0]
+    latest = conn.execute('SELECT MAX(id) FROM stock_movements').fetchone()[0]
+    if latest is None or latest <= mark:
+        return 0
+    run = _Pass(conn, _offset(utc_offset_minutes))
+    for fish_type, since in conn.execute('''
+    SELECT fish_type, MIN(at) FROM stock_movements
+    WHERE id > ? AND id <= ? GROUP BY fish_type
+    ''', (mark, latest)).fetchall():
+        processed_at = _processed_at(conn, fish_type)
+        replay = processed_at is not None and since < processed_at
+        if replay:
+            _unwind(run, fish_type, since)
+        # Replaying, lots opened from `since` on come back, full, as the
+        # replay reaches their movement; appending, all open lots are
+        # older (or as old) and stay in the book
+        book = _Book(conn, fish_type, since if replay else None)
+        later = {lot.id: lot for lot in _lots(conn, 'fish_type = ? AND at >= ?',
+                                              (fish_type, since))} if replay else {}
+        for movement in conn.execute(MOVEMENTS_SQL.format(
+                where='WHERE m.fish_type = ? AND m.at >= ? AND m.id <= ?'),
+                (fish_type, since, latest)).fetchall():
+            if movement[0] <= mark and not replay:
+                continue
+            run.apply(book, movement, later.get(movement[0]))
+    run.flush()
+    conn.execute('UPDATE cost_state SET movement_id = ?', (latest,))
+    return run.applied
+
+
+def sync(conn, utc_offset_minutes):
+    """apply_pending() in a write transaction of its own, retried while the
+    database is busy (see db.run_in_transaction). conn is only used to
+    check, without locking, whether there is anything to do."""
+    if not has_pending(conn):
+        return 0
+    return run_in_transaction(lambda conn: apply_pending(conn, utc_offset_minutes))
+
+
+def check_cost_basis(conn):
+    """Fish whose lots or daily totals disagree with the ledger.
+
+    What is on hand in lots, less quantity consumed with no lot behind it,
+    must equal the ledger's stock for the movements applied so far, and
+    daily_margin must add up to the matches, and the cost_state totals
+    to daily_margin (reported last, under fish_type None). Returns [(fish_type,
+    what, stored, expected)].
+    """
+    mark = conn.execute('SELECT movement_id FROM cost_state').fetchone()[0]
+    drift = conn.execute('''
+    SELECT fish_type, 'quantity', SUM(lots), SUM(ledger) FROM (
+        SELECT fish_type, remaining AS lots, 0 AS ledger FROM cost_lots
+        UNION ALL
+        SELECT fish_type, -quantity, 0 FROM cost_matches WHERE lot_id IS NULL
+        UNION ALL
+        SELECT fish_type, 0, delta FROM stock_movements WHERE id <= ?
+    )
+    GROUP BY fish_type
+    HAVING ABS(SUM(lots) - SUM(ledger)) > 1e-6
+    ''', (mark,)).fetchall()
+    drift += conn.execute('''
+    SELECT fish_type, 'revenue', SUM(stored), SUM(actual) FROM (
+        SELECT fish_type, revenue + unmatched_revenue AS stored, 0 AS actual FROM daily_margin
+        UNION ALL
+        SELECT fish_type, 0, revenue FROM cost_matches
+    )
+    GROUP BY fish_type
+    HAVING ABS(SUM(stored) - SUM(actual)) > 0.005
+    UNION ALL
+    SELECT fish_type, 'cost', SUM(stored), SUM(actual) FROM (
+        SELECT fish_type, cost + writeoff_cost AS stored, 0 AS actual FROM daily_margin
+        UNION ALL
+        SELECT fish_type, 0, COALESCE(cost, 0) FROM cost_matches
+    )
+    GROUP BY fish_type
+    HAVING ABS(SUM(stored) - SUM(actual)) > 0.005
+    ''').fetchall()
+    stored = conn.execute('SELECT revenue, cost FROM cost_state').fetchone()
+    expected = conn.execute(
+        'SELECT COALESCE(SUM(revenue), 0), COALESCE(SUM(cost), 0) FROM daily_margin').fetchone()
+    totals = [(None, f'total {name}', stored[i], expected[i])
+              for i, name in enumerate(('revenue', 'cost'))
+              if abs(stored[i] - expected[i]) > 0.005]
+    return sorted(tuple(row) for row in drift) + totals
+
+
+def _figures(quantity, revenue, cost, unmatched_quantity, unmatched_revenue,
+             writeoff_quantity, writeoff_cost):
+    margin = revenue - cost
+    return {
+        'quantity': round(quantity, 3),
+        'revenue': round(revenue, 2),
+        'cost': round(cost, 2),
+        'margin': round(margin, 2),
+        'margin_pct': round(100 * margin / revenue, 2) if revenue else None,
+        'unmatched_quantity': round(unmatched_quantity, 3),
+        'unmatched_revenue': round(unmatched_revenue, 2),
+        'writeoff_quantity': round(writeoff_quantity, 3),
+        'writeoff_cost': round(writeoff_cost, 2),
+    }
+
+
+def margin_report(conn, granularity='month', fish_types=(), start=None, end=None):
+    """Realised margin per fish over a range, and per bucket.
+
+    revenue, cost and margin count only quantity matched to a lot of known
+    cost; the rest is reported as unmatched. start and end are dates
+    (inclusive) and default to the first and last day with sales. Raises
+    ValueError like analytics.series().
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {', '.join(GRANULARITIES)}")
+
+    where, params = [], []
+    if fish_types:
+        where.append(f"fish_type IN ({','.join('?' * len(fish_types))})")
+        params.extend(fish_types)
+    if start is None or end is None:
+        first, last = conn.execute(
+            f"SELECT MIN(day), MAX(day) FROM daily_margin {'WHERE ' + where[0] if where else ''}",
+            params).fetchone()
+        if first is None:
+            return {'from': None, 'to': None, 'buckets': [], 'revenue': [], 'cost': [],
+                    'margin': [], 'by_fish': [], 'totals': _figures(0, 0, 0, 0, 0, 0, 0)}
+        start = start or date.fromisoformat(first)
+        end = end or date.fromisoformat(last)
+
+    labels = bucket_labels(start, end, granularity) if start <= end else []
+    where.append('day BETWEEN ? AND ?')
+    params.extend([start.isoformat(), end.isoformat()])
+    sums = ', '.join(f'SUM({name})' for name in TOTALS)
+    by_bucket, by_fish = {}, {}
+    for bucket, fish_type, *values in conn.execute(f'''
+    SELECT {BUCKET_SQL[granularity]} AS bucket, fish_type, {sums}
+    FROM daily_margin
+    WHERE {' AND '.join(where)}
+    GROUP BY bucket, fish_type
+    ''', params):
+        for totals, key in ((by_bucket, bucket), (by_fish, fish_type)):
+            current = totals.setdefault(key, [0] * len(TOTALS))
+            for i, value in enumerate(values):
+                current[i] += value
+
+    points = [_figures(*by_bucket.get(label, [0] * len(TOTALS))) for label in labels]
+    overall = [sum(values[i] for values in by_fish.values()) for i in range(len(TOTALS))]
+    return {
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'buckets': labels,
+        'revenue': [point['revenue'] for point in points],
+        'cost': [point['cost'] for point in points],
+        'margin': [point['margin'] for point in points],
+        'by_fish': [{'fish_type': fish_type, **_figures(*values)}
+                    for fish_type, values in sorted(by_fish.items())],
+        'totals': _figures(*overall),
+    }
+
+
+def valuation(conn):
+    """Stock on hand per fish at FIFO cost, from the open lots.
+
+    value counts lots of known cost; unknown_cost_quantity is on hand from
+    lots without one. stock_quantity is the stock table's figure for
+    comparison.
+    """
+    fish = []
+    totals = {'quantity': 0, 'value': 0, 'unknown_cost_quantity': 0}
+    for row in conn.execute('''
+    SELECT lots.fish_type, lots.quantity, lots.value, lots.unknown, lots.open_lots,
+           lots.oldest, stock.current_quantity
+    FROM (SELECT fish_type, SUM(remaining) AS quantity,
+                 SUM(remaining * unit_cost) AS value,
+                 SUM(CASE WHEN unit_cost IS NULL THEN remaining ELSE 0 END) AS unknown,
+                 COUNT(*) AS open_lots, MIN(day) AS oldest
+          FROM cost_lots WHERE remaining > 0 GROUP BY fish_type) AS lots
+    LEFT JOIN stock ON stock.fish_type = lots.fish_type
+    ORDER BY lots.fish_type
+    '''):
+        fish_type, quantity, value, unknown, open_lots, oldest, stock_quantity = row
+        known = quantity - unknown
+        fish.append({
+            'fish_type': fish_type,
+            'quantity': round(quantity, 3),
+            'value': round(value or 0, 2),
+            'average_cost': round(value / known, 2) if value and known > EPSILON else None,
+            'unknown_cost_quantity': round(unknown, 3),
+            'open_lots': open_lots,
+            'oldest_lot': oldest,
+            'stock_quantity': stock_quantity,
+        })
+        totals['quantity'] += quantity
+        totals['value'] += value or 0
+        totals['unknown_cost_quantity'] += unknown
+    return {'fish': fish, 'totals': {name: round(value, 3 if name != 'value' else 2)
+                                     for name, value in totals.items()}}
+
+
+def summary_totals(conn):
+    """(cost of goods sold, realised margin) over all sales with a known cost,
+    as of the last sync"""
+    revenue, cost = conn.execute('SELECT revenue, cost FROM cost_state').fetchone()
+    return cost, revenue - cost
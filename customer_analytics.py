@@ -0,0 +1,251 @@
+"""Per-customer purchase rollups, top customers and RFM segments.
+
+A buyer is whoever bought: bills carry a customer, sales only a purchaser
+name and contact. Both are keyed on the phone number (buyer_key), or on the
+lower-cased name when there is none, so a wholesale buyer entered through
+either screen lands on one row; customer_id is filled in when a customer
+with that phone exists.
+
+customer_stats holds first and last purchase date, the number of purchases
+(bills plus OUT sales entries) and total spend per buyer, and
+customer_fish_stats the quantity and spend per buyer and fish, from which
+favourite_fish (most spent on) is kept. Insert triggers on sales, bills
+and bill_items keep both current (see init_db); like the customer ledger,
+rows are never updated or deleted by the app, and rebuild_customer_stats()
+recomputes everything after manual edits.
+
+RFM scores are quintiles (1-5) of last purchase date (recency), number of
+purchases (frequency) and total spend (monetary). The quintile boundaries
+are read with index seeks and a buyer's score is one plus the number of
+boundaries its value is above, so ties never straddle two scores. Top-N
+lists walk the matching index; segment sizes need one pass over all
+buyers, which the app caches until customer_stats changes.
+"""
+from datetime import date
+
+SORTS = {
+    'spend': 'total_spend DESC',
+    'frequency': 'orders DESC, total_spend DESC',
+    'recent': 'last_purchase DESC, total_spend DESC',
+}
+MAX_TOP = 1000
+
+# Score ranges per segment; the first matching rule wins and anyone left
+# over "needs attention"
+SEGMENTS = (
+    ('champions', {'r': (4, 5), 'f': (4, 5), 'm': (4, 5)}),
+    ('loyal', {'r': (3, 5), 'f': (4, 5)}),
+    ('big_spenders', {'m': (5, 5)}),
+    ('new', {'r': (4, 5), 'f': (1, 2)}),
+    ('at_risk', {'r': (1, 2), 'f': (3, 5)}),
+    ('lost', {'r': (1, 2)}),
+)
+OTHER_SEGMENT = 'needs_attention'
+SEGMENT_NAMES = tuple(name for name, _ in SEGMENTS) + (OTHER_SEGMENT,)
+
+RFM_COLUMNS = (('r', 'last_purchase'), ('f', 'orders'), ('m', 'total_spend'))
+
+
+def buyer_key_sql(name, phone):
+    """SQL expression for the buyer key of a name and phone expression"""
+    return f"COALESCE(NULLIF(TRIM({phone}), ''), 'name:' || LOWER(TRIM({name})))"
+
+
+def favourite_sql(key):
+    """SQL subquery for the favourite fish of the buyer key expression"""
+    return f'''SELECT fish_type FROM customer_fish_stats WHERE buyer_key = {key}
+               ORDER BY spend DESC, fish_type LIMIT 1'''
+
+
+def rebuild_customer_stats(conn):
+    """Recompute customer_stats and customer_fish_stats from bills and
+    sales; call inside a write transaction"""
+    bill_key = buyer_key_sql('customers.name', 'customers.phone')
+    sale_key = buyer_key_sql('purchaser_name', 'purchaser_contact')
+    conn.execute('DELETE FROM customer_stats')
+    conn.execute('DELETE FROM customer_fish_stats')
+    conn.execute(f'''
+    INSERT INTO customer_stats
+        (buyer_key, customer_id, name, phone, first_purchase, last_purchase, orders, total_spend)
+    SELECT buyer_key, MIN(customer_id), MAX(name), MAX(phone), MIN(day), MAX(day),
+           COUNT(*), SUM(spend)
+    FROM (
+        SELECT {bill_key} AS buyer_key, customers.id AS customer_id, customers.name,
+               customers.phone, bills.bill_date AS day, bills.total_amount AS spend
+        FROM bills JOIN customers ON customers.id = bills.customer_id
+        UNION ALL
+        SELECT {sale_key}, (SELECT MIN(id) FROM customers WHERE phone = purchaser_contact),
+               purchaser_name, purchaser_contact, date, total_price
+        FROM sales WHERE transaction_type = 'OUT'
+    )
+    GROUP BY buyer_key
+    ''')
+    conn.execute(f'''
+    INSERT INTO customer_fish_stats (buyer_key, fish_type, quantity, spend)
+    SELECT buyer_key, fish_type, SUM(quantity), SUM(spend)
+    FROM (
+        SELECT {bill_key} AS buyer_key, bill_items.fish_name AS fish_type,
+               bill_items.quantity, bill_items.total_price AS spend
+        FROM bill_items
+        JOIN bills ON bills.id = bill_items.bill_id
+        JOIN customers ON customers.id = bills.customer_id
+        UNION ALL
+        SELECT {sale_key}, fish_type, quantity, total_price
+        FROM sales WHERE transaction_type = 'OUT'
+    )
+    GROUP BY buyer_key, fish_type
+    ''')
+    conn.execute(f'''
+    UPDATE customer_stats SET favourite_fish = ({favourite_sql('customer_stats.buyer_key')})
+    ''')
+
+
+def check_customer_stats(conn):
+    """Number of buyers whose stored purchases or spend differ from bills
+    and sales"""
+    bill_key = buyer_key_sql('customers.name', 'customers.phone')
+    sale_key = buyer_key_sql('purchaser_name', 'purchaser_contact')
+    return conn.execute(f'''
+    WITH actual AS (
+        SELECT buyer_key, COUNT(*) AS orders, SUM(spend) AS spend
+        FROM (
+            SELECT {bill_key} AS buyer_key, bills.total_amount AS spend
+            FROM bills JOIN customers ON customers.id = bills.customer_id
+            UNION ALL
+            SELECT {sale_key}, total_price FROM sales WHERE transaction_type = 'OUT'
+        )
+        GROUP BY buyer_key
+    )
+    SELECT
+        (SELECT COUNT(*) FROM actual LEFT JOIN customer_stats AS stored USING (buyer_key)
+         WHERE stored.buyer_key IS NULL OR stored.orders != actual.orders
+            OR ABS(stored.total_spend - actual.spend) > 0.005)
+      + (SELECT COUNT(*) FROM customer_stats
+         WHERE buyer_key NOT IN (SELECT buyer_key FROM actual))
+    ''').fetchone()[0]
+
+
+def rfm_boundaries(conn):
+    """{score letter: [4 quintile boundaries]} read with index seeks"""
+    count = conn.execute('SELECT COUNT(*) FROM customer_stats').fetchone()[0]
+    boundaries = {}
+    for letter, column in RFM_COLUMNS:
+        values = []
+        for k in range(1, 5):
+            row = conn.execute(f'SELECT {column} FROM customer_stats ORDER BY {column} '
+                               f'LIMIT 1 OFFSET ?', (count * k // 5,)).fetchone()
+            values.append(row[0] if row else None)
+        boundaries[letter] = values
+    return boundaries
+
+
+def score(value, bounds):
+    return 1 + sum(1 for bound in bounds if bound is not None and value > bound)
+
+
+def segment_of(scores):
+    for name, rule in SEGMENTS:
+        if all(low <= scores[letter] <= high for letter, (low, high) in rule.items()):
+            return name
+    return OTHER_SEGMENT
+
+
+def score_sql(column, bounds):
+    return ' + '.join(['1'] + [f'({column} > ?)' for _ in bounds]), list(bounds)
+
+
+def rule_sql(rule, boundaries):
+    """A segment rule as plain column comparisons: score >= k is
+    value > boundary k-1, so no score has to be computed per row"""
+    columns = dict(RFM_COLUMNS)
+    terms, params = [], []
+    for letter, (low, high) in rule.items():
+        bounds = boundaries[letter]
+        if low > 1:
+            terms.append(f'{columns[letter]} > ?')
+            params.append(bounds[low - 2])
+        if high < 5:
+            terms.append(f'{columns[letter]} <= ?')
+            params.append(bounds[high - 1])
+    return ' AND '.join(terms) or '1', params
+
+
+def segment_sql(segment, boundaries):
+    """WHERE clause selecting one segment's buyers, and its parameters"""
+    terms, params = [], []
+    for name, rule in SEGMENTS:
+        sql, rule_params = rule_sql(rule, boundaries)
+        if name == segment:
+            terms.append(f'({sql})')
+            params.extend(rule_params)
+            break
+        terms.append(f'NOT ({sql})')
+        params.extend(rule_params)
+    return ' AND '.join(terms), params
+
+
+def rfm_summary(conn):
+    """Quintile boundaries and the number of buyers in each segment.
+
+    This is the one part that reads every buyer (one grouped pass), so the
+    app caches it until customer_stats changes.
+    """
+    boundaries = rfm_boundaries(conn)
+    expressions, params = [], []
+    for letter, column in RFM_COLUMNS:
+        sql, bound_params = score_sql(column, boundaries[letter])
+        expressions.append(sql)
+        params.extend(bound_params)
+    counts = dict.fromkeys(SEGMENT_NAMES, 0)
+    if boundaries['r'][0] is not None:
+        for r, f, m, count in conn.execute(f'''
+        SELECT {', '.join(expressions)}, COUNT(*) FROM customer_stats GROUP BY 1, 2, 3
+        ''', params):
+            counts[segment_of({'r': r, 'f': f, 'm': m})] += count
+    return {'boundaries': boundaries, 'segments': counts}
+
+
+def customer_report(conn, summary, top=20, sort='spend', segment=None, as_of=None):
+    """Top buyers, optionally of one segment, scored against an
+    rfm_summary()"""
+    as_of = as_of or date.today()
+    boundaries = summary['boundaries']
+    query = '''SELECT *, CAST(julianday(?) - julianday(last_purchase) AS INTEGER) AS recency_days
+               FROM customer_stats'''
+    params = [as_of.isoformat()]
+    if segment:
+        where, where_params = segment_sql(segment, boundaries)
+        query += f' WHERE {where}'
+        params.extend(where_params)
+    query += f' ORDER BY {SORTS[sort]} LIMIT ?'
+    params.append(top)
+
+    customers = []
+    # An empty segment would otherwise be a full scan to find nothing
+    rows = conn.execute(query, params) if not segment or summary['segments'][segment] else ()
+    for row in rows:
+        scores = {letter: score(row[column], boundaries[letter])
+                  for letter, column in RFM_COLUMNS}
+        customers.append({
+            'buyer_key': row['buyer_key'],
+            'customer_id': row['customer_id'],
+            'name': row['name'],
+            'phone': row['phone'],
+            'first_purchase': row['first_purchase'],
+            'last_purchase': row['last_purchase'],
+            'recency_days': row['recency_days'],
+            'orders': row['orders'],
+            'total_spend': round(row['total_spend'], 2),
+            'average_order': round(row['total_spend'] / row['orders'], 2) if row['orders'] else 0,
+            'favourite_fish': row['favourite_fish'],
+            'rfm': f"{scores['r']}{scores['f']}{scores['m']}",
+            'segment': segment_of(scores),
+        })
+    return {
+        'as_of': as_of.isoformat(),
+        'sort': sort,
+        'segment': segment,
+        'customers': customers,
+        'segments': summary['segments'],
+        'boundaries': boundaries,
+    }
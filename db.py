@@ -0,0 +1,284 @@
+import os
+import random
+import sqlite3
+import threading
+import time
+
+# Path to the SQLite database (override with DATABASE_PATH for testing)
+DATABASE = os.environ.get('DATABASE_PATH', 'database.db')
+
+BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+
+# Applied once when a connection is opened, not on every request
+PRAGMAS = [
+    ('journal_mode', 'WAL'),
+    ('synchronous', 'NORMAL'),
+    ('busy_timeout', BUSY_TIMEOUT_MS),
+    ('cache_size', -16000),        # ~16MB page cache per connection
+    ('mmap_size', 128 * 1024 * 1024),
+    ('temp_store', 'MEMORY'),
+]
+
+# Called as listener(cursor, sql, parameters, seconds, rows) once per statement
+# run through a pooled connection, when it has finished: seconds covers
+# execute plus fetching, parameters is None for executemany (see metrics.py
+# and slow_queries.py)
+statement_listeners = []
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor that reports each statement's time and row count to
+    statement_listeners.
+
+    A SELECT does most of its work while rows are fetched, so it is reported
+    once the rows are exhausted, or when the cursor is reused, closed or
+    garbage collected.
+    """
+
+    _sql = None
+
+    def _begin(self, sql, parameters):
+        self._finish()
+        self._sql, self._parameters, self._seconds, self._rows = sql, parameters, 0.0, 0
+
+    def _finish(self):
+        sql, self._sql = self._sql, None
+        if sql is not None:
+            for listener in statement_listeners:
+                listener(self, sql, self._parameters, self._seconds, self._rows)
+
+    def _run(self, method, sql, parameters, listener_parameters):
+        if not statement_listeners:
+            return method(sql, parameters)
+        self._begin(sql, listener_parameters)
+        started = time.perf_counter()
+        try:
+            method(sql, parameters)
+        except BaseException:
+            self._seconds += time.perf_counter() - started
+            self._finish()
+            raise
+        self._seconds += time.perf_counter() - started
+        if self.description is None:
+            self._rows = max(self.rowcount, 0)
+            self._finish()
+        return self
+
+    def execute(self, sql, parameters=()):
+        return self._run(super().execute, sql, parameters, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self._run(super().executemany, sql, seq_of_parameters, None)
+
+    def _fetch(self, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        self._seconds += time.perf_counter() - started
+        return result
+
+    def fetchone(self):
+        if self._sql is None:
+            return super().fetchone()
+        row = self._fetch(super().fetchone)
+        if row is None:
+            self._finish()
+        else:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        if self._sql is None:
+            return super().fetchmany(size)
+        rows = self._fetch(super().fetchmany, size)
+        self._rows += len(rows)
+        if len(rows) < size:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        if self._sql is None:
+            return super().fetchall()
+        rows = self._fetch(super().fetchall)
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def __next__(self):
+        if self._sql is None:
+            return super().__next__()
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self._finish()
+        except Exception:
+            pass
+
+
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection that goes back to the pool on close()
+
+    Handlers keep calling conn.close() as before; the pool decides whether
+    the connection is kept for reuse or really closed.
+    """
+
+    pool = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    # sqlite3.Connection.execute bypasses Cursor.execute, so route the
+    # shortcuts through cursor() to keep them timed
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def really_close(self):
+        super().close()
+
+
+class ConnectionPool:
+    """Per-process pool of pre-tuned SQLite connections"""
+
+    def __init__(self, database, max_idle=8):
+        self.database = database
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+        self._pid = os.getpid()
+        self._stats = {
+            'opened': 0,
+            'closed': 0,
+            'checkouts': 0,
+            'reused': 0,
+            'in_use': 0,
+            'discarded_after_fork': 0,
+        }
+
+    def _check_fork(self):
+        # Connections must never be shared across fork (gunicorn --preload);
+        # drop anything inherited from the parent and start fresh
+        pid = os.getpid()
+        if pid != self._pid:
+            self._stats['discarded_after_fork'] += len(self._idle)
+            self._idle = []
+            self._stats['in_use'] = 0
+            self._pid = pid
+
+    def _open(self):
+        conn = sqlite3.connect(self.database, timeout=BUSY_TIMEOUT_MS / 1000,
+                               check_same_thread=False,
+                               factory=PooledConnection)
+        for name, value in PRAGMAS:
+            conn.execute(f'PRAGMA {name} = {value}')
+        conn.pool = self
+        self._stats['opened'] += 1
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            self._check_fork()
+            self._stats['checkouts'] += 1
+            self._stats['in_use'] += 1
+            if self._idle:
+                self._stats['reused'] += 1
+                conn = self._idle.pop()
+                conn.row_factory = sqlite3.Row
+                return conn
+            conn = self._open()
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def release(self, conn):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            # Broken connection, don't hand it out again
+            with self._lock:
+                self._stats['in_use'] -= 1
+                self._stats['closed'] += 1
+            conn.really_close()
+            return
+
+        with self._lock:
+            self._check_fork()
+            self._stats['in_use'] = max(self._stats['in_use'] - 1, 0)
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+            self._stats['closed'] += 1
+        conn.really_close()
+
+    def close_all(self):
+        """Close idle connections, e.g. in the gunicorn master before forking"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._stats['closed'] += len(idle)
+        for conn in idle:
+            conn.really_close()
+
+    def stats(self):
+        with self._lock:
+            self._check_fork()
+            stats = dict(self._stats)
+            stats['idle'] = len(self._idle)
+            stats['max_idle'] = self.max_idle
+            stats['pid'] = self._pid
+            stats['database'] = self.database
+        return stats
+
+
+pool = ConnectionPool(DATABASE, max_idle=int(os.environ.get('DB_POOL_SIZE', 8)))
+
+
+def get_db_connection():
+    return pool.acquire()
+
+
+def is_busy_error(error):
+    message = str(error)
+    return 'database is locked' in message or 'database is busy' in message
+
+
+def run_in_transaction(work, retries=5, backoff=0.01):
+    """Run work(conn) inside a short BEGIN IMMEDIATE transaction.
+
+    The write lock is taken up front so nothing inside work() has to upgrade
+    a read lock. If the database is still busy after busy_timeout the whole
+    transaction is retried with jittered exponential backoff, up to
+    `retries` times. Any other exception rolls back and propagates.
+    """
+    for attempt in range(retries + 1):
+        conn = get_db_connection()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = work(conn)
+            conn.commit()
+            return result
+        except sqlite3.OperationalError as e:
+            conn.rollback()
+            if not is_busy_error(e) or attempt == retries:
+                raise
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        time.sleep(backoff * (2 ** attempt) * random.uniform(0.5, 1.5))
@@ -0,0 +1,140 @@
+"""Streaming CSV/NDJSON exports.
+
+Rows are pulled from the cursor BATCH_SIZE at a time and encoded into
+chunks of about CHUNK_BYTES, so memory use stays flat however many rows a
+table has. Bills are exported with their items: one CSV line per item with
+the bill columns repeated, or one NDJSON object per bill with an "items"
+list. Receipt images are never included, only their hash and size.
+"""
+import csv
+import io
+import json
+import zlib
+
+BATCH_SIZE = 1000
+CHUNK_BYTES = 64 * 1024
+GZIP_LEVEL = 6
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+EXPORTS = {
+    'sales': {
+        'query': '''SELECT id, date, purchaser_name, purchaser_contact, fish_type,
+                           transaction_type, quantity, unit_price, total_price, timestamp
+                    FROM sales''',
+        'date_column': 'date',
+        'order': 'id',
+    },
+    'inventory': {
+        'query': '''SELECT id, date, supplier_name, supplier_contact, fish_type,
+                           transaction_type, quantity, unit_price, total_price, timestamp
+                    FROM inventory''',
+        'date_column': 'date',
+        'order': 'id',
+    },
+    'bills': {
+        'query': '''SELECT b.id AS bill_id, b.customer_id, c.name AS customer_name,
+                           c.phone AS customer_phone, b.bill_date, b.subtotal, b.tax,
+                           b.total_amount, b.previous_balance, b.amount_paid, b.balance_due,
+                           b.created_at,
+                           i.id AS item_id, i.fish_item_id, i.fish_name, i.quantity,
+                           i.unit_price, i.total_price
+                    FROM bills b
+                    LEFT JOIN customers c ON c.id = b.customer_id
+                    LEFT JOIN bill_items i ON i.bill_id = b.id''',
+        'date_column': 'b.bill_date',
+        'order': 'b.id, i.id',
+        # Columns from here on belong to the item
+        'nest_from': 'item_id',
+    },
+    'transactions': {
+        'query': '''SELECT id, transaction_type, payment_method, amount, client_name,
+                           client_phone, image_name, image_type, image_hash, image_size,
+                           notes, created_at, local_date
+                    FROM financial_transactions''',
+        'date_column': 'local_date',
+        'order': 'id',
+    },
+}
+
+
+def open_export(conn, table, start_date=None, end_date=None):
+    """Execute the export query for table; dates are inclusive YYYY-MM-DD"""
+    spec = EXPORTS[table]
+    query = spec['query'] + ' WHERE 1=1'
+    params = []
+    if start_date:
+        query += f" AND {spec['date_column']} >= ?"
+        params.append(start_date)
+    if end_date:
+        query += f" AND {spec['date_column']} <= ?"
+        params.append(end_date)
+    query += f" ORDER BY {spec['order']}"
+    return conn.execute(query, params)
+
+
+def iter_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
+
+
+def nest_items(columns, rows, nest_from):
+    """Group consecutive joined rows into one dict per parent with an items list"""
+    split = columns.index(nest_from)
+    parent_columns, item_columns = columns[:split], columns[split:]
+    parent = None
+    for row in rows:
+        row = tuple(row)
+        if parent is None or row[0] != parent[parent_columns[0]]:
+            if parent is not None:
+                yield parent
+            parent = dict(zip(parent_columns, row[:split]))
+            parent['items'] = []
+        if row[split] is not None:
+            parent['items'].append(dict(zip(item_columns, row[split:])))
+    if parent is not None:
+        yield parent
+
+
+def encode(cursor, table, fmt):
+    """Yield the export as UTF-8 chunks of about CHUNK_BYTES"""
+    columns = [d[0] for d in cursor.description]
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        write = writer.writerow
+        records = iter_rows(cursor)
+    else:
+        def write(record):
+            buffer.write(json.dumps(record))
+            buffer.write('\n')
+        nest_from = EXPORTS[table].get('nest_from')
+        if nest_from:
+            records = nest_items(columns, iter_rows(cursor), nest_from)
+        else:
+            records = (dict(zip(columns, row)) for row in iter_rows(cursor))
+
+    for record in records:
+        write(record)
+        if buffer.tell() >= CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode()
+
+
+def gzip_chunks(chunks, level=GZIP_LEVEL):
+    """Compress a stream of byte chunks into a single gzip member"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,172 @@
+"""Opt-in group commit for high-rate writes.
+
+With GROUP_COMMIT=1, write jobs from request threads are queued to a single
+writer thread per process. The writer runs up to GROUP_COMMIT_MAX_BATCH
+queued jobs in one transaction, then commits once. It waits at most
+GROUP_COMMIT_MAX_LATENCY_MS after the first job for more to arrive. Each
+job runs inside its own SAVEPOINT, so a job that raises (e.g.
+InsufficientStock) is rolled back alone and its caller gets that exception.
+The other jobs in the batch still commit.
+
+Batching only happens when several requests write at once in one process,
+i.e. with threaded workers (gunicorn --threads) or the async mode.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+
+from db import get_db_connection, is_busy_error, run_in_transaction
+
+ENABLED = os.environ.get('GROUP_COMMIT', '0') in ('1', 'true')
+MAX_BATCH = int(os.environ.get('GROUP_COMMIT_MAX_BATCH', 64))
+MAX_LATENCY_MS = float(os.environ.get('GROUP_COMMIT_MAX_LATENCY_MS', 5))
+# How long run() waits for its batch before giving up with TimeoutError
+TIMEOUT_S = float(os.environ.get('GROUP_COMMIT_TIMEOUT_S', 30))
+
+# Upper bounds of the batch size histogram buckets
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+
+class GroupCommitWriter:
+    def __init__(self, max_batch=MAX_BATCH, max_latency_ms=MAX_LATENCY_MS, begin_retries=5):
+        self.max_batch = max_batch
+        self.max_latency = max_latency_ms / 1000
+        self.begin_retries = begin_retries
+        self._lock = threading.Lock()
+        self._queue = None
+        self._thread = None
+        self._pid = None
+        self._stats = {
+            'batches': 0,
+            'jobs': 0,
+            'job_errors': 0,
+            'failed_commits': 0,
+            'max_batch_size': 0,
+            'commit_seconds': 0.0,
+            'batch_size_histogram': {str(b): 0 for b in BATCH_BUCKETS + ('+Inf',)},
+        }
+
+    def _ensure_started(self):
+        # The writer thread doesn't survive fork, so each worker starts its own
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def submit(self, work):
+        """Queue work(conn) for the next batch, returning a Future"""
+        self._ensure_started()
+        future = Future()
+        self._queue.put((work, future))
+        return future
+
+    def run(self, work, timeout=TIMEOUT_S):
+        """Queue work(conn) and block until its batch has committed"""
+        return self.submit(work).result(timeout)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._commit(batch)
+            except Exception as e:
+                # Keep the writer alive; whoever is still waiting gets the error
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def _begin(self, conn):
+        for attempt in range(self.begin_retries + 1):
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                return
+            except sqlite3.OperationalError as e:
+                if not is_busy_error(e) or attempt == self.begin_retries:
+                    raise
+                time.sleep(0.005 * (2 ** attempt))
+
+    def _commit(self, batch):
+        started = time.perf_counter()
+        results = []
+        conn = None
+        try:
+            conn = get_db_connection()
+            self._begin(conn)
+            for work, _ in batch:
+                conn.execute('SAVEPOINT job')
+                try:
+                    results.append((work(conn), None))
+                    conn.execute('RELEASE job')
+                except Exception as e:
+                    conn.execute('ROLLBACK TO job')
+                    conn.execute('RELEASE job')
+                    results.append((None, e))
+            conn.commit()
+        except Exception as e:
+            # Nothing in this batch was written
+            if conn is not None and conn.in_transaction:
+                conn.rollback()
+            results = [(None, e)] * len(batch)
+            with self._lock:
+                self._stats['failed_commits'] += 1
+        finally:
+            if conn is not None:
+                conn.close()
+
+        self._record(len(batch), sum(1 for _, error in results if error),
+                     time.perf_counter() - started)
+        for (_, future), (result, error) in zip(batch, results):
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def _record(self, size, errors, seconds):
+        with self._lock:
+            stats = self._stats
+            stats['batches'] += 1
+            stats['jobs'] += size
+            stats['job_errors'] += errors
+            stats['commit_seconds'] += seconds
+            stats['max_batch_size'] = max(stats['max_batch_size'], size)
+            bucket = next((str(b) for b in BATCH_BUCKETS if size <= b), '+Inf')
+            stats['batch_size_histogram'][bucket] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['batch_size_histogram'] = dict(self._stats['batch_size_histogram'])
+        stats['enabled'] = ENABLED
+        stats['max_batch'] = self.max_batch
+        stats['max_latency_ms'] = self.max_latency * 1000
+        stats['queued'] = self._queue.qsize() if self._queue else 0
+        stats['mean_batch_size'] = (stats['jobs'] / stats['batches']) if stats['batches'] else 0
+        return stats
+
+
+writer = GroupCommitWriter()
+
+
+def execute_write(work):
+    """Run work(conn) in a write transaction, via the group-commit writer
+    when it is enabled, and return its result"""
+    if ENABLED:
+        return writer.run(work)
+    return run_in_transaction(work)
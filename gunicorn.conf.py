@@ -0,0 +1,14 @@
+# Loaded automatically by `gunicorn app:app` (see Procfile).
+
+
+def on_starting(server):
+    # Apply schema migrations once in the master, before any worker forks,
+    # instead of racing in every worker
+    from app import init_db
+    init_db()
+
+
+def when_ready(server):
+    # Workers open their own connections; don't keep the master's around
+    from db import pool
+    pool.close_all()
@@ -0,0 +1,83 @@
+"""Customer ledger.
+
+customers.balance is what the customer owes right now and customer_ledger
+holds one statement line per bill or finance entry with the running
+balance after it. Both are kept current by triggers on bills and
+financial_transactions (see init_db), so reading a balance is a primary-key
+lookup. A bill debits its total and credits the amount paid on it; a
+finance "in" is a payment received (credit), an "out" is money paid to the
+customer (debit).
+"""
+
+
+def find_customer_by_phone(conn, phone):
+    """Id of the customer with this phone number, or None.
+
+    When the same number was entered for several customers the oldest one
+    wins, so every bill and payment for that number lands on one ledger.
+    """
+    if not phone:
+        return None
+    row = conn.execute('SELECT MIN(id) FROM customers WHERE phone = ?', (phone,)).fetchone()
+    return row[0]
+
+
+def rebuild_ledger(conn):
+    """Rebuild customer_ledger and customers.balance from bills and finance.
+
+    Finance entries not yet linked to a customer are linked by phone number
+    first. One linear pass: the running balance is a window sum. Call
+    inside a write transaction.
+    """
+    conn.execute('''
+    UPDATE financial_transactions
+    SET customer_id = (SELECT MIN(id) FROM customers WHERE phone = client_phone)
+    WHERE customer_id IS NULL AND client_phone IS NOT NULL AND client_phone != ''
+    ''')
+    conn.execute('DELETE FROM customer_ledger')
+    conn.execute('''
+    INSERT INTO customer_ledger
+        (customer_id, entry_date, source, source_id, description, debit, credit,
+         balance, created_at)
+    SELECT customer_id, entry_date, source, source_id, description, debit, credit,
+           SUM(debit - credit) OVER (PARTITION BY customer_id ORDER BY created_at, source, source_id
+                                     ROWS UNBOUNDED PRECEDING),
+           created_at
+    FROM (
+        SELECT bills.customer_id, bills.bill_date AS entry_date, 'bill' AS source,
+               bills.id AS source_id, 'Bill #' || bills.id AS description,
+               bills.total_amount AS debit, COALESCE(bills.amount_paid, 0) AS credit,
+               bills.created_at
+        FROM bills JOIN customers ON customers.id = bills.customer_id
+        UNION ALL
+        SELECT t.customer_id, t.local_date, 'transaction', t.id,
+               CASE t.transaction_type WHEN 'in' THEN 'Payment received' ELSE 'Paid out' END
+                   || ' (' || t.payment_method || ')',
+               CASE t.transaction_type WHEN 'out' THEN t.amount ELSE 0 END,
+               CASE t.transaction_type WHEN 'in' THEN t.amount ELSE 0 END,
+               t.created_at
+        FROM financial_transactions AS t JOIN customers ON customers.id = t.customer_id
+    )
+    ORDER BY created_at, source, source_id
+    ''')
+    conn.execute('''
+    UPDATE customers
+    SET balance = COALESCE((SELECT balance FROM customer_ledger
+                            WHERE customer_id = customers.id
+                            ORDER BY id DESC LIMIT 1), 0)
+    ''')
+
+
+def check_ledger(conn):
+    """Customers whose stored balance differs from their ledger lines.
+
+    Returns a list of (customer_id, stored balance, ledger total).
+    """
+    return conn.execute('''
+    SELECT customers.id, customers.balance, COALESCE(totals.total, 0)
+    FROM customers
+    LEFT JOIN (SELECT customer_id, SUM(debit - credit) AS total
+               FROM customer_ledger GROUP BY customer_id) AS totals
+           ON totals.customer_id = customers.id
+    WHERE ABS(customers.balance - COALESCE(totals.total, 0)) > 0.005
+    ''').fetchall()
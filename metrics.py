@@ -0,0 +1,182 @@
+"""Request and SQL metrics in Prometheus text format.
+
+Each process aggregates in memory and writes its totals to its own file in
+METRICS_DIR (atomically, at most once per FLUSH_INTERVAL seconds). /metrics
+sums every file, so counts from all gunicorn workers are included. Files of
+workers that have exited are kept so counters never go backwards; clear
+METRICS_DIR when deploying.
+"""
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+from flask import g, has_request_context
+
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'nayak-fish-metrics'))
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+HELP = {
+    'http_requests_total': ('counter', 'Requests by endpoint, method and status code.'),
+    'http_request_duration_seconds': ('histogram', 'Time spent in the Flask handler.'),
+    'http_request_sql_seconds': ('histogram', 'Time spent executing SQL per request.'),
+    'http_request_queue_seconds': ('histogram', 'Time between X-Request-Start and the handler.'),
+    'http_response_size_bytes': ('histogram', 'Response body size (streamed bodies excluded).'),
+    'sqlite_statement_duration_seconds': ('histogram', 'SQLite statement execution time.'),
+}
+
+_OPERATION = re.compile(r'\s*(\w+)')
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._last_flush = 0.0
+
+    @staticmethod
+    def _key(name, labels):
+        return json.dumps([name, sorted(labels.items())])
+
+    def inc(self, name, labels, value=1):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = {'buckets': list(buckets),
+                                                'counts': [0] * len(buckets),
+                                                'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(hist['buckets']):
+                if value <= bound:
+                    hist['counts'][i] += 1
+                    break
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def flush(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_flush < FLUSH_INTERVAL:
+            return
+        with self._lock:
+            snapshot = json.dumps({'counters': self._counters, 'histograms': self._histograms})
+            self._last_flush = now
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = os.path.join(METRICS_DIR, f'metrics_{os.getpid()}.json')
+        fd, tmp_path = tempfile.mkstemp(dir=METRICS_DIR, prefix='.metrics-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(snapshot)
+        os.replace(tmp_path, path)
+
+    def collect(self):
+        """Sum the flushed totals of every process"""
+        self.flush(force=True)
+        counters, histograms = {}, {}
+        for path in glob.glob(os.path.join(METRICS_DIR, 'metrics_*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for key, value in data['counters'].items():
+                counters[key] = counters.get(key, 0) + value
+            for key, hist in data['histograms'].items():
+                total = histograms.get(key)
+                if total is None or total['buckets'] != hist['buckets']:
+                    histograms[key] = {'buckets': hist['buckets'], 'counts': list(hist['counts']),
+                                       'sum': hist['sum'], 'count': hist['count']}
+                    continue
+                total['counts'] = [a + b for a, b in zip(total['counts'], hist['counts'])]
+                total['sum'] += hist['sum']
+                total['count'] += hist['count']
+        return counters, histograms
+
+    def render(self):
+        counters, histograms = self.collect()
+        lines = []
+        emitted = set()
+
+        def header(name):
+            if name not in emitted and name in HELP:
+                kind, text = HELP[name]
+                lines.append(f'# HELP {name} {text}')
+                lines.append(f'# TYPE {name} {kind}')
+                emitted.add(name)
+
+        for key in sorted(counters):
+            name, labels = json.loads(key)
+            header(name)
+            lines.append(f'{name}{format_labels(labels)} {counters[key]}')
+        for key in sorted(histograms):
+            name, labels = json.loads(key)
+            hist = histograms[key]
+            header(name)
+            cumulative = 0
+            for bound, count in zip(hist['buckets'], hist['counts']):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_labels(labels + [["le", repr(float(bound))]])} {cumulative}')
+            lines.append(f'{name}_bucket{format_labels(labels + [["le", "+Inf"]])} {hist["count"]}')
+            lines.append(f'{name}_sum{format_labels(labels)} {hist["sum"]}')
+            lines.append(f'{name}_count{format_labels(labels)} {hist["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+registry = Registry()
+
+
+def record_statement(cursor, sql, parameters, seconds, rows):
+    """db.statement_listeners hook"""
+    match = _OPERATION.match(sql)
+    operation = match.group(1).upper() if match else 'OTHER'
+    registry.observe('sqlite_statement_duration_seconds', {'operation': operation}, seconds)
+    if has_request_context():
+        g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+
+
+def request_started(request):
+    g.request_started = time.perf_counter()
+    g.sql_seconds = 0.0
+    # Set by nginx/heroku-style routers as t=<microseconds> or milliseconds
+    start = request.headers.get('X-Request-Start', '').lstrip('t=')
+    if start.replace('.', '', 1).isdigit():
+        started = float(start)
+        started /= 1e6 if started > 1e14 else 1e3
+        g.queue_seconds = max(time.time() - started, 0.0)
+
+
+def request_finished(request, response):
+    if 'request_started' not in g:
+        return response
+    labels = {'endpoint': request.endpoint or 'unmatched', 'method': request.method}
+    registry.observe('http_request_duration_seconds', labels,
+                     time.perf_counter() - g.request_started)
+    registry.observe('http_request_sql_seconds', labels, g.get('sql_seconds', 0.0))
+    if 'queue_seconds' in g:
+        registry.observe('http_request_queue_seconds', labels, g.queue_seconds)
+    registry.inc('http_requests_total', dict(labels, status=str(response.status_code)))
+    if not response.is_streamed:
+        registry.observe('http_response_size_bytes', labels,
+                         response.calculate_content_length() or 0, SIZE_BUCKETS)
+    registry.flush()
+    return response
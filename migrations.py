@@ -0,0 +1,59 @@
+"""Schema migrations keyed on PRAGMA user_version.
+
+Migrations are functions registered with a version number and applied in
+order, each in its own BEGIN IMMEDIATE transaction together with the
+user_version bump, so a failed migration leaves the schema at the previous
+version. When the database is already current, run() costs one PRAGMA read
+and takes no lock. Several processes starting at once are safe: the
+version is re-read after the write lock is taken.
+"""
+
+
+class Migrator:
+    def __init__(self):
+        self.migrations = {}
+
+    def migration(self, version):
+        """Decorator registering fn(conn) as the migration to `version`"""
+        def register(fn):
+            if version in self.migrations:
+                raise ValueError(f'Duplicate migration {version}')
+            self.migrations[version] = fn
+            return fn
+        return register
+
+    @property
+    def latest(self):
+        return max(self.migrations, default=0)
+
+    @staticmethod
+    def current_version(conn):
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
+    def pending(self, conn):
+        current = self.current_version(conn)
+        return [version for version in sorted(self.migrations) if version > current]
+
+    def run(self, conn, analyze=True):
+        """Apply pending migrations; returns the versions applied"""
+        applied = []
+        for version in self.pending(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                # Another process may have got here first
+                if self.current_version(conn) >= version:
+                    conn.rollback()
+                    continue
+                self.migrations[version](conn)
+                conn.execute(f'PRAGMA user_version = {int(version)}')
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(version)
+
+        if applied and analyze:
+            # Fresh statistics so the planner uses the new indexes
+            conn.execute('ANALYZE')
+            conn.commit()
+        return applied
@@ -0,0 +1,133 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from db import DATABASE
+
+# Receipt images live on disk next to the database, named by their SHA-256
+# so identical uploads are stored once and a stored file never changes
+RECEIPT_DIR = os.environ.get(
+    'RECEIPT_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(DATABASE)), 'receipts'))
+
+CHUNK_SIZE = 64 * 1024
+
+# A receipt is stored before its financial_transactions row is inserted, so
+# a file younger than this may belong to a request still in flight
+ORPHAN_GRACE_SECONDS = int(os.environ.get('RECEIPT_ORPHAN_GRACE_SECONDS', 3600))
+
+
+def receipt_path(digest):
+    return os.path.join(RECEIPT_DIR, digest[:2], digest)
+
+
+def _store_chunks(chunks):
+    """Write chunks to the store, returning (digest, size)"""
+    os.makedirs(RECEIPT_DIR, exist_ok=True)
+    sha = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=RECEIPT_DIR, prefix='.upload-')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in chunks:
+                sha.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+
+        digest = sha.hexdigest()
+        path = receipt_path(digest)
+        if os.path.exists(path):
+            os.unlink(tmp_path)  # already stored
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        return digest, size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+def store_receipt(stream):
+    """Copy a file-like upload into the store without reading it all at once"""
+    return _store_chunks(iter(lambda: stream.read(CHUNK_SIZE), b''))
+
+
+def store_blob(blob):
+    """Copy an open sqlite3.Blob into the store chunk by chunk"""
+    return _store_chunks(iter(lambda: blob.read(CHUNK_SIZE), b''))
+
+
+def migrate_blobs(conn, batch_size=100):
+    """Move image_data BLOBs out of financial_transactions into the store.
+
+    Each batch is committed on its own so the migration can be interrupted
+    and resumed. Returns (rows moved, bytes moved).
+    """
+    moved = moved_bytes = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id FROM financial_transactions
+            WHERE image_data IS NOT NULL AND image_hash IS NULL
+            LIMIT ?
+        ''', (batch_size,)).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        for row in rows:
+            with conn.blobopen('financial_transactions', 'image_data', row['id'],
+                               readonly=True) as blob:
+                digest, size = store_blob(blob)
+            updates.append((digest, size, row['id']))
+            moved_bytes += size
+
+        conn.executemany('''
+            UPDATE financial_transactions
+            SET image_hash = ?, image_size = ?, image_data = NULL
+            WHERE id = ?
+        ''', updates)
+        conn.commit()
+        moved += len(updates)
+    return moved, moved_bytes
+
+
+def find_orphans(conn, grace_seconds=ORPHAN_GRACE_SECONDS):
+    """Stored files no financial_transactions row points at: receipts whose
+    insert failed after the upload was stored, and temp files left by
+    interrupted uploads. Returns [(path, size)], skipping anything modified
+    in the last grace_seconds."""
+    if not os.path.isdir(RECEIPT_DIR):
+        return []
+    referenced = {row[0] for row in conn.execute(
+        'SELECT DISTINCT image_hash FROM financial_transactions WHERE image_hash IS NOT NULL')}
+    cutoff = time.time() - grace_seconds
+    orphans = []
+    for root, _, files in os.walk(RECEIPT_DIR):
+        for name in files:
+            if name in referenced:
+                continue
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime < cutoff:
+                orphans.append((path, stat.st_size))
+    return orphans
+
+
+def remove_orphans(orphans):
+    """Delete find_orphans() results; returns (files, bytes) removed"""
+    removed = removed_bytes = 0
+    for path, size in orphans:
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            continue
+        removed += 1
+        removed_bytes += size
+    return removed, removed_bytes
@@ -0,0 +1,165 @@
+"""Slow-query log.
+
+Statements that take longer than SLOW_QUERY_MS (execute plus fetching) are
+appended to SLOW_QUERY_LOG as one JSON object per line, with the normalised
+SQL, the shape of the parameters, the duration, the rows returned and the
+EXPLAIN QUERY PLAN. All workers append to the same file, so top() reports
+across the whole deployment. Set SLOW_QUERY_MS=-1 to turn the log off.
+"""
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from datetime import datetime
+
+from db import DATABASE
+
+THRESHOLD_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+LOG_PATH = os.environ.get('SLOW_QUERY_LOG', os.path.join(
+    os.path.dirname(os.path.abspath(DATABASE)), 'slow_queries.log'))
+
+# Statements EXPLAIN QUERY PLAN can describe
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_IN_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize(sql):
+    """SQL with literals replaced by ? and whitespace collapsed"""
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _SPACE.sub(' ', sql).strip()
+    return _IN_LIST.sub('(?, ...)', sql)
+
+
+def fingerprint(normalized):
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12]
+
+
+def parameter_shape(parameters):
+    """Types of the bound parameters, never their values"""
+    def name(value):
+        return 'null' if value is None else type(value).__name__
+
+    if parameters is None:
+        return 'executemany'
+    if isinstance(parameters, dict):
+        return {key: name(value) for key, value in parameters.items()}
+    return [name(value) for value in parameters]
+
+
+def format_plan(rows):
+    """EXPLAIN QUERY PLAN rows as indented lines, like the sqlite3 shell"""
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node_id] + detail)
+    return lines
+
+
+class SlowQueryLog:
+    def __init__(self, path, threshold_ms):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self._lock = threading.Lock()
+        # Plans are captured once per fingerprint per process
+        self._plans = {}
+
+    def record(self, cursor, sql, parameters, seconds, rows):
+        """db.statement_listeners hook"""
+        duration_ms = seconds * 1000
+        if self.threshold_ms < 0 or duration_ms < self.threshold_ms:
+            return
+        normalized = normalize(sql)
+        key = fingerprint(normalized)
+        entry = {
+            'at': datetime.now().isoformat(timespec='seconds'),
+            'pid': os.getpid(),
+            'fingerprint': key,
+            'sql': normalized,
+            'parameters': parameter_shape(parameters),
+            'duration_ms': round(duration_ms, 3),
+            'rows': rows,
+            'plan': self._plan(cursor, key, sql, parameters),
+        }
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def _plan(self, cursor, key, sql, parameters):
+        if key in self._plans:
+            return self._plans[key]
+        plan = None
+        if parameters is not None and sql.lstrip().upper().startswith(EXPLAINABLE):
+            try:
+                # A plain cursor, so the EXPLAIN itself isn't timed and logged
+                explain = sqlite3.Cursor(cursor.connection)
+                plan = format_plan(explain.execute('EXPLAIN QUERY PLAN ' + sql, parameters))
+            except sqlite3.Error:
+                pass
+        self._plans[key] = plan
+        return plan
+
+    def entries(self):
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return []
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue  # partially written line
+        return entries
+
+    def top(self, limit=20, sort='total'):
+        """Logged statements grouped by fingerprint, worst first.
+
+        sort is one of 'total' (summed duration), 'max' or 'count'.
+        """
+        groups = {}
+        for entry in self.entries():
+            group = groups.get(entry['fingerprint'])
+            if group is None:
+                group = groups[entry['fingerprint']] = {
+                    'fingerprint': entry['fingerprint'],
+                    'sql': entry['sql'],
+                    'count': 0,
+                    'total_ms': 0.0,
+                    'max_ms': 0.0,
+                    'max_rows': 0,
+                    'parameters': [],
+                    'plan': None,
+                    'last_seen': None,
+                }
+            group['count'] += 1
+            group['total_ms'] += entry['duration_ms']
+            group['max_ms'] = max(group['max_ms'], entry['duration_ms'])
+            group['max_rows'] = max(group['max_rows'], entry['rows'])
+            if entry['parameters'] not in group['parameters']:
+                group['parameters'].append(entry['parameters'])
+            group['plan'] = entry['plan'] or group['plan']
+            group['last_seen'] = entry['at']
+
+        for group in groups.values():
+            group['total_ms'] = round(group['total_ms'], 3)
+            group['avg_ms'] = round(group['total_ms'] / group['count'], 3)
+        key = {'total': 'total_ms', 'max': 'max_ms', 'count': 'count'}[sort]
+        return sorted(groups.values(), key=lambda group: group[key], reverse=True)[:limit]
+
+    def clear(self):
+        with self._lock:
+            open(self.path, 'w').close()
+        self._plans.clear()
+
+
+slow_query_log = SlowQueryLog(LOG_PATH, THRESHOLD_MS)
@@ -9,12 +9,37 @@ document.addEventListener('DOMContentLoaded', function() {
   document.getElementById('print-bill-btn').addEventListener('click', printBill);
   document.getElementById('save-bill-btn').addEventListener('click', saveBillToBackend);
   document.getElementById('search-bills-btn').addEventListener('click', searchBills);
+  document.getElementById('customer-phone').addEventListener('change', loadCustomerBalance);
   
 });
 
 // Global variables
 let fishItems = [];
 let itemCounter = 0;
+let customerId = null;
+
+// Fill in the previous balance from the server ledger for a known phone number
+async function loadCustomerBalance() {
+  const phone = document.getElementById('customer-phone').value.trim();
+  customerId = null;
+  if (!phone) return;
+
+  try {
+    const matches = await (await fetch(`/api/customers/search?phone=${encodeURIComponent(phone)}`)).json();
+    const exact = matches.filter(customer => customer.phone === phone);
+    if (exact.length === 0) return;
+    customerId = Math.min(...exact.map(customer => customer.id));
+
+    const customer = await (await fetch(`/api/customers/${customerId}/balance`)).json();
+    document.getElementById('previous-balance').value = customer.balance.toFixed(2);
+    if (!document.getElementById('customer-name').value.trim()) {
+      document.getElementById('customer-name').value = customer.name;
+    }
+    calculateBill();
+  } catch (error) {
+    console.error('Could not load customer balance:', error);
+  }
+}
 
 
 // Add new fish item row
@@ -258,6 +283,7 @@ async function saveBillToBackend() {
 
   // Prepare bill data
   const billData = {
+    customer_id: customerId,
     customer_name: customerName,
     customer_phone: customerPhone,
     bill_date: billDate,
@@ -304,6 +330,7 @@ async function saveBillToBackend() {
     document.getElementById('fish-items-body').innerHTML = '';
     document.getElementById('amount-paid').value = '';
     document.getElementById('previous-balance').value = '0.00';
+    customerId = null;
     addFishItemRow(); // Add new empty row
     
     // Update calculations
@@ -1,24 +1,27 @@
  // 1. View Sales History
 document.addEventListener('DOMContentLoaded', async () => {
-    // Load summary data
-    const summaryResponse = await fetch('/api/sales/summary');
-    const summary = await summaryResponse.json();
+    // Only the sales history page has the dashboard widgets
+    if (!document.getElementById('monthlyTrendChart')) return;
+
+    // One request for the whole dashboard; the browser revalidates it with
+    // the ETag and gets a 304 when nothing has changed
+    const response = await fetch('/api/dashboard', { cache: 'no-cache' });
+    const dashboard = await response.json();
+    const summary = dashboard.summary;
     
     document.getElementById('total-sales').textContent = `₹${summary.total_sales.toFixed(2)}`;
     document.getElementById('total-purchases').textContent = `₹${summary.total_purchases.toFixed(2)}`;
     document.getElementById('profit').textContent = `₹${summary.profit.toFixed(2)}`;
     document.getElementById('total-transactions').textContent = summary.total_transactions;
     
-    // Load and render charts
-    await renderMonthlyTrendChart();
-    await renderFishTypeChart();
-    await loadRecentTransactions();
+    // Render charts and tables
+    renderMonthlyTrendChart(dashboard.monthly_trend);
+    renderFishTypeChart(dashboard.by_fish);
+    loadRecentTransactions(dashboard.recent_inventory);
+    loadStockLevels(dashboard.stock);
   });
   
-  async function renderMonthlyTrendChart() {
-    const response = await fetch('/api/sales/monthly-trend');
-    const trendData = await response.json();
-    
+  function renderMonthlyTrendChart(trendData) {
     const ctx = document.getElementById('monthlyTrendChart').getContext('2d');
     new Chart(ctx, {
       type: 'line',
@@ -58,10 +61,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     });
   }
   
-  async function renderFishTypeChart() {
-    const response = await fetch('/api/sales/by-fish');
-    const fishData = await response.json();
-    
+  function renderFishTypeChart(fishData) {
     const ctx = document.getElementById('fishTypeChart').getContext('2d');
     new Chart(ctx, {
       type: 'bar',
@@ -90,10 +90,7 @@ document.addEventListener('DOMContentLoaded', async () => {
     });
   }
   
-  async function loadRecentTransactions() {
-    const response = await fetch('/api/inventory?limit=5');
-    const transactions = await response.json();
-    
+  function loadRecentTransactions(transactions) {
     const tableBody = document.querySelector('#recentTransactions tbody');
     tableBody.innerHTML = transactions.map(item => `
       <tr>
@@ -106,11 +103,9 @@ document.addEventListener('DOMContentLoaded', async () => {
     `).join('');
   }
 
-  async function loadStockLevels() {
-    const response = await fetch('/api/stock');
-    const stock = await response.json();
-    
+  function loadStockLevels(stock) {
     const tableBody = document.querySelector('#stockLevels tbody');
+    if (!tableBody) return;
     tableBody.innerHTML = stock.map(item => `
       <tr>
         <td>${item.fish_type}</td>
@@ -119,12 +114,10 @@ document.addEventListener('DOMContentLoaded', async () => {
       </tr>
     `).join('');
   }
-  
-  // Call this in your DOMContentLoaded event
-  loadStockLevels();
 
   document.addEventListener('DOMContentLoaded', () => {
-    // Button event listeners
+    // Button event listeners (sales page only)
+    if (!document.getElementById('addSalesBtn')) return;
     
     document.getElementById('addSalesBtn').addEventListener('click', loadAddSalesForm);
     document.getElementById('stockBtn').addEventListener('click', loadCurrentStock);
@@ -0,0 +1,174 @@
+import json
+
+
+class InsufficientStock(Exception):
+    def __init__(self, fish_type, available, requested):
+        super().__init__(f'Insufficient stock. Available: {available}')
+        self.fish_type = fish_type
+        self.available = available
+        self.requested = requested
+
+
+def reserve_stock(conn, fish_type, quantity):
+    """Take quantity of fish_type out of stock, or raise InsufficientStock.
+
+    The availability check and the deduction are one conditional UPDATE, so
+    two counters can never both sell the last of a fish. Call it inside a
+    write transaction (see db.run_in_transaction). Returns what is left.
+    """
+    row = conn.execute('''UPDATE stock
+                          SET current_quantity = current_quantity - ?,
+                              last_updated = CURRENT_TIMESTAMP
+                          WHERE fish_type = ? AND current_quantity >= ?
+                          RETURNING current_quantity''',
+                       (quantity, fish_type, quantity)).fetchone()
+    if row is None:
+        available = conn.execute('SELECT current_quantity FROM stock WHERE fish_type = ?',
+                                 (fish_type,)).fetchone()
+        raise InsufficientStock(fish_type, available[0] if available else 0, quantity)
+    return row[0]
+
+
+# Stock ledger. stock_movements is an append-only log of every change to
+# stock (inventory, sales, bill items via triggers; resets and manual
+# adjustments explicitly). stock_checkpoints holds the quantity per fish at
+# the end of each shop day the fish moved, so stock as of any moment is one
+# checkpoint plus at most a day of movements. Timestamps are UTC
+# 'YYYY-MM-DD HH:MM:SS' strings, like CURRENT_TIMESTAMP.
+
+def record_adjustment(conn, fish_type, delta, source='adjustment'):
+    """Log a stock change that no inventory, sales or bill row explains"""
+    conn.execute('INSERT INTO stock_movements (fish_type, delta, at, source) '
+                 'VALUES (?, ?, CURRENT_TIMESTAMP, ?)', (fish_type, delta, source))
+
+
+def backfill_movements(conn):
+    """Fill stock_movements from the existing history, in one pass.
+
+    Stock that the history doesn't explain (earlier resets or manual edits)
+    is logged as one 'adjustment' per fish, so the ledger starts out
+    agreeing with the stock table.
+    """
+    conn.execute('''
+    INSERT INTO stock_movements (fish_type, delta, at, source, source_id)
+    SELECT fish_type, delta, at, source, source_id FROM (
+        SELECT fish_type,
+               CASE WHEN transaction_type = 'IN' THEN quantity ELSE -quantity END AS delta,
+               COALESCE(timestamp, CURRENT_TIMESTAMP) AS at, 'inventory' AS source, id AS source_id
+        FROM inventory
+        UNION ALL
+        SELECT fish_type, CASE WHEN transaction_type = 'IN' THEN quantity ELSE -quantity END,
+               COALESCE(timestamp, CURRENT_TIMESTAMP), 'sales', id
+        FROM sales
+        UNION ALL
+        SELECT bill_items.fish_name, -bill_items.quantity,
+               COALESCE(bills.created_at, CURRENT_TIMESTAMP), 'bill_items', bill_items.id
+        FROM bill_items JOIN bills ON bills.id = bill_items.bill_id
+    )
+    ORDER BY at
+    ''')
+    conn.execute('''
+    INSERT INTO stock_movements (fish_type, delta, at, source)
+    SELECT fish_type, SUM(delta), CURRENT_TIMESTAMP, 'adjustment' FROM (
+        SELECT fish_type, current_quantity AS delta FROM stock
+        UNION ALL
+        SELECT fish_type, -SUM(delta) FROM stock_movements GROUP BY fish_type
+    )
+    GROUP BY fish_type
+    HAVING ABS(SUM(delta)) > 1e-9
+    ''')
+
+
+def stock_as_of(conn, until, fish_type=None):
+    """{fish_type: quantity} counting every movement before `until` (UTC)"""
+    # Distinct fish by walking the (fish_type, at) index, not every movement
+    query = '''
+    WITH RECURSIVE fish (fish_type) AS (
+        SELECT MIN(fish_type) FROM stock_movements
+        UNION ALL
+        SELECT (SELECT MIN(fish_type) FROM stock_movements WHERE fish_type > fish.fish_type)
+        FROM fish WHERE fish.fish_type IS NOT NULL
+    )
+    SELECT fish.fish_type,
+           COALESCE(checkpoint.quantity, 0) + COALESCE((
+               SELECT SUM(delta) FROM stock_movements
+               WHERE stock_movements.fish_type = fish.fish_type
+                 AND at >= COALESCE(checkpoint.until, '') AND at < :until), 0)
+    FROM fish
+    LEFT JOIN stock_checkpoints AS checkpoint
+           ON checkpoint.fish_type = fish.fish_type
+          AND checkpoint.until = (SELECT MAX(until) FROM stock_checkpoints
+                                  WHERE fish_type = fish.fish_type AND until <= :until)
+    WHERE EXISTS (SELECT 1 FROM stock_movements
+                  WHERE stock_movements.fish_type = fish.fish_type AND at < :until)
+    '''
+    params = {'until': until}
+    if fish_type:
+        query += ' AND fish.fish_type = :fish_type'
+        params['fish_type'] = fish_type
+    return dict(conn.execute(query + ' ORDER BY fish.fish_type', params).fetchall())
+
+
+def checkpoint_range(conn, utc_offset_minutes):
+    """(last checkpoint, most recent shop-local midnight) as UTC timestamps;
+    checkpoints are due when the first is earlier than the second"""
+    boundary = conn.execute('SELECT datetime(date(?, ?), ?)',
+                            ('now', f'{utc_offset_minutes:+d} minutes',
+                             f'{-utc_offset_minutes:+d} minutes')).fetchone()[0]
+    watermark = conn.execute('SELECT MAX(until) FROM stock_checkpoints').fetchone()[0] or ''
+    return watermark, boundary
+
+
+def write_checkpoints(conn, utc_offset_minutes):
+    """Checkpoint every shop day that has ended since the last checkpoint.
+
+    Only fish that moved on a day get a row for it. Backdated movements
+    delete the checkpoints they fall before (trigger), and the next call
+    rebuilds from there. Returns the number of rows written. Call inside a
+    write transaction.
+    """
+    watermark, boundary = checkpoint_range(conn, utc_offset_minutes)
+    if watermark >= boundary:
+        return 0
+    to_local = f'{utc_offset_minutes:+d} minutes'
+    to_utc = f'{-utc_offset_minutes:+d} minutes'
+
+    base = stock_as_of(conn, watermark) if watermark else {}
+    cursor = conn.execute('''
+    INSERT INTO stock_checkpoints (fish_type, until, day, quantity)
+    SELECT daily.fish_type, datetime(daily.day, '+1 day', :to_utc), daily.day,
+           COALESCE(base.value, 0)
+               + SUM(daily.delta) OVER (PARTITION BY daily.fish_type ORDER BY daily.day)
+    FROM (SELECT fish_type, date(at, :to_local) AS day, SUM(delta) AS delta
+          FROM stock_movements
+          WHERE at >= :watermark AND at < :boundary
+          GROUP BY fish_type, day) AS daily
+    LEFT JOIN json_each(:base) AS base ON base.key = daily.fish_type
+    ''', {'to_utc': to_utc, 'to_local': to_local, 'watermark': watermark,
+          'boundary': boundary, 'base': json.dumps(base)})
+    return cursor.rowcount
+
+
+def verify_stock(conn, fix=False):
+    """Rebuild current stock from the ledger and compare with the stock table.
+
+    Returns [(fish_type, stock quantity, ledger quantity)] for every fish
+    that differs. With fix=True the stock table is set to the ledger values.
+    """
+    drift = conn.execute('''
+    SELECT fish_type, SUM(stored), SUM(ledger) FROM (
+        SELECT fish_type, current_quantity AS stored, 0 AS ledger FROM stock
+        UNION ALL
+        SELECT fish_type, 0, delta FROM stock_movements
+    )
+    GROUP BY fish_type
+    HAVING ABS(SUM(stored) - SUM(ledger)) > 1e-6
+    ORDER BY fish_type
+    ''').fetchall()
+    if fix and drift:
+        conn.executemany('''
+        INSERT INTO stock (fish_type, current_quantity) VALUES (?, ?)
+        ON CONFLICT (fish_type) DO UPDATE
+        SET current_quantity = excluded.current_quantity, last_updated = CURRENT_TIMESTAMP
+        ''', [(fish_type, ledger) for fish_type, _, ledger in drift])
+    return [tuple(row) for row in drift]